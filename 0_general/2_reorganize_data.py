@@ -7,7 +7,6 @@ import argparse
 import logging
 import os
 import json
-import subprocess
 import shutil
 import itertools
 from joblib import Parallel, delayed
@@ -36,6 +35,115 @@ def buildArgsParser():
         help='If set, produces verbose output.')
     return p
 
+# Spatial axes of the reorganized images: the closest orientation to RAS+ (as "mrconvert -strides 1,2,3"),
+# obtained by permuting and flipping the voxel axes, the affine being updated so that every voxel keeps
+# its scanner position.
+CANONICAL_AXCODES = ('R', 'A', 'S')
+
+def canonical_transform(affine):
+    """Orientation transform (nibabel ornt: output axis and flip of each input axis) of the spatial axes
+    of an image to the closest canonical orientation"""
+    ornt = nib.orientations.io_orientation(affine)
+    return nib.orientations.ornt_transform(ornt, nib.orientations.axcodes2ornt(CANONICAL_AXCODES))
+
+def is_identity(transform):
+    return np.array_equal(transform, [[0, 1], [1, 1], [2, 1]])
+
+def reorient_direction(direction:str, transform):
+    """BIDS direction of a voxel axis ("i", "j-", ...) after the transform"""
+    axis = 'ijk'.index(direction[0])
+    sign = -1 if direction.endswith('-') else 1
+    sign *= int(transform[axis, 1])
+    return 'ijk'[int(transform[axis, 0])] + ('-' if sign < 0 else '')
+
+def reorient_bvecs(bvecs, transform, affine, new_affine):
+    """FSL bvecs (3 x N) of the reoriented image. They are given along the voxel axes, the first one
+    flipped when the voxel to world matrix has a positive determinant (FSL radiological convention)."""
+    voxel = bvecs.copy()
+    if np.linalg.det(affine[:3, :3]) > 0:
+        voxel[0] = -voxel[0]
+    reoriented = np.empty_like(voxel)
+    for axis, (new_axis, flip) in enumerate(transform):
+        reoriented[int(new_axis)] = flip * voxel[axis]
+    if np.linalg.det(new_affine[:3, :3]) > 0:
+        reoriented[0] = -reoriented[0]
+    return reoriented
+
+def reorient_image(source_file:str, target_file:str, transform):
+    """Write the image source_file with its voxel axes permuted and flipped by transform to target_file
+
+    The data is streamed one volume at a time (3D image or each volume of a 4D series) from the source
+    to the target, as stored (data type, scaling), so that the memory is that of one volume. The image
+    is written under a temporary name and renamed once complete."""
+    tmp_file = os.path.join(os.path.dirname(target_file), '.tmp' + str(os.getpid()) + '_' + os.path.basename(target_file))
+    try:
+        with nib.openers.ImageOpener(source_file) as fin, nib.openers.ImageOpener(tmp_file, 'wb') as fout:
+            # Header as stored (data offset, scaling), with its extensions
+            hdr = nib.load(source_file).header_class.from_fileobj(fin)
+            shape = hdr.get_data_shape()
+            dtype = hdr.get_data_dtype()
+            affine = hdr.get_best_affine()
+
+            new_affine = affine @ nib.orientations.inv_ornt_aff(transform, shape[:3])
+            new_shape = list(shape)
+            for axis, (new_axis, _) in enumerate(transform):
+                new_shape[int(new_axis)] = shape[axis]
+            new_hdr = hdr.copy()
+            new_hdr.set_data_shape(new_shape)
+            new_hdr.set_qform(new_affine, int(hdr['qform_code']))
+            new_hdr.set_sform(new_affine, int(hdr['sform_code']))
+            new_hdr.set_dim_info(*[None if axis is None else int(transform[axis, 0]) for axis in hdr.get_dim_info()])
+
+            volume_bytes = int(np.prod(shape[:3])) * dtype.itemsize
+            offset = int(hdr.get_data_offset())
+            new_hdr.write_to(fout)
+            fout.write(b'\x00' * (offset - fout.tell()))
+            fin.seek(offset)
+            for _ in range(int(np.prod(shape[3:]))):
+                buffer = fin.read(volume_bytes)
+                if len(buffer) != volume_bytes:
+                    raise ValueError('Truncated image: "{0}".'.format(source_file))
+                volume = np.frombuffer(buffer, dtype).reshape(shape[:3], order='F')
+                fout.write(nib.orientations.apply_orientation(volume, transform).tobytes(order='F'))
+        os.replace(tmp_file, target_file)
+    finally:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+
+def reorganize_series(source:str, target:str, sidecars:list):
+    """Copy the image <source>.nii.gz and its sidecars (".json", ".bval", ".bvec") to target in the
+    canonical orientation, the voxel directions of the json (phase and slice encoding) and the bvecs
+    being reoriented with the image. The image is written last: a target image is a complete series."""
+    img = nib.load(source + ".nii.gz")
+    transform = canonical_transform(img.affine)
+    new_affine = img.affine @ nib.orientations.inv_ornt_aff(transform, img.shape[:3])
+    logging.info('Reorienting "{0}": {1} -> {2}.'.format(
+        source, ''.join(nib.aff2axcodes(img.affine)), ''.join(nib.aff2axcodes(new_affine))))
+
+    for ext in sidecars:
+        if ext == ".json" and not is_identity(transform):
+            with open(source + ext) as json_file:
+                j = json.load(json_file)
+            for key in ('PhaseEncodingDirection', 'SliceEncodingDirection'):
+                if key in j:
+                    j[key] = reorient_direction(j[key], transform)
+            with open(target + ext, 'w') as outfile:
+                json.dump(j, outfile, indent=4)
+        elif ext == ".bvec" and not is_identity(transform):
+            bvecs = np.loadtxt(source + ext, ndmin=2)
+            reoriented = reorient_bvecs(bvecs, transform, img.affine, new_affine)
+            if np.array_equal(reoriented, bvecs):
+                shutil.copyfile(source + ext, target + ext)
+            else:
+                np.savetxt(target + ext, reoriented, fmt='%.6g')
+        else:
+            shutil.copyfile(source + ext, target + ext)
+
+    if is_identity(transform):
+        shutil.copyfile(source + ".nii.gz", target + ".nii.gz")
+    else:
+        reorient_image(source + ".nii.gz", target + ".nii.gz", transform)
+
 def reorganize_data_fnct(data_path:str, subject:str, session:str, isVerbose:bool, isForce:bool):
     """Reorganization script
 
@@ -85,6 +193,9 @@ def reorganize_data_fnct(data_path:str, subject:str, session:str, isVerbose:bool
     anat_folder = os.path.join(source_folder, "anat")
     logging.info('Reorganizing folder: "{0}".'.format(anat_folder))
 
+    # Series copied and reoriented concurrently: (source, target, sidecars) without extension
+    series = []
+
     if os.path.exists(anat_folder):
         anat_json_files = np.sort([f for f in os.listdir(anat_folder)
                                 if os.path.isfile(os.path.join(anat_folder, f))
@@ -178,19 +289,16 @@ def reorganize_data_fnct(data_path:str, subject:str, session:str, isVerbose:bool
         files = ["*_T1w", "*_T2w"]
         for f in files:
             nii_filename = os.path.join(anat_folder, subject + "_" + session + f + ".nii.gz")
-            json_filename = os.path.join(anat_folder, subject + "_" + session + f + ".json")
 
             nii_files = glob.glob(nii_filename)
-            json_files = glob.glob(json_filename)
 
-            for idx, nii_file in enumerate(nii_files):
+            # sidecar of each image: same name, ".json"
+            for nii_file in nii_files:
                 target_nii_filename = os.path.join(target_folder_anat, os.path.basename(nii_file))
-                target_json_filename = os.path.join(target_folder_anat, os.path.basename(json_files[idx]))
 
                 if os.path.exists(nii_file):
                     if not os.path.exists(target_nii_filename):
-                        shutil.copyfile(json_files[idx], target_json_filename)
-                        subprocess.call("mrconvert -strides 1,2,3 -quiet -force " + nii_file + ".nii.gz " + target_nii_filename + ".nii.gz", shell=True)
+                        series.append((nii_file[:-len(".nii.gz")], target_nii_filename[:-len(".nii.gz")], [".json"]))
 
     ## DWI
     dwi_folder = os.path.join(source_folder, "dwi")
@@ -204,15 +312,14 @@ def reorganize_data_fnct(data_path:str, subject:str, session:str, isVerbose:bool
         target_PA_filename = os.path.join(target_folder_dwi, subject + "_" + session + "_dir-PA_dwi")
 
         if not os.path.exists(target_PA_filename + ".nii.gz"):
-            shutil.copyfile(os.path.join(PA_filename + ".json"), target_PA_filename  + ".json")
-            shutil.copyfile(os.path.join(PA_filename + ".bval"), target_PA_filename  + ".bval")
-            shutil.copyfile(os.path.join(PA_filename + ".bvec"), target_PA_filename  + ".bvec")
-            subprocess.call("mrconvert -strides 1,2,3 -quiet -force " + PA_filename + ".nii.gz " + target_PA_filename + ".nii.gz", shell=True)
+            series.append((PA_filename, target_PA_filename, [".json", ".bval", ".bvec"]))
         if not os.path.exists(target_AP_filename + ".nii.gz"):
-            shutil.copyfile(os.path.join(AP_filename + ".json"), target_AP_filename  + ".json")
-            shutil.copyfile(os.path.join(AP_filename + ".bval"), target_AP_filename  + ".bval")
-            shutil.copyfile(os.path.join(AP_filename + ".bvec"), target_AP_filename  + ".bvec")
-            subprocess.call("mrconvert -strides 1,2,3 -quiet -force " + AP_filename + ".nii.gz " + target_AP_filename + ".nii.gz", shell=True)
+            series.append((AP_filename, target_AP_filename, [".json", ".bval", ".bvec"]))
+
+    # In-process and I/O bound (gzip and numpy release the GIL): one thread per series
+    if series:
+        Parallel(n_jobs=len(series), prefer="threads")(
+            delayed(reorganize_series)(source, target, sidecars) for source, target, sidecars in series)
 
     logging.info('Reorganization done')
     return
@@ -10,8 +10,8 @@ from genericpath import isfile
 import logging
 import os
 import shutil
-import itertools
-from datetime import datetime
+from tools.run_ledger import run_step, select_sessions
+from tools.manifest import Manifest
 
 # Build Parser
 def buildArgsParser():
@@ -32,6 +32,12 @@ def buildArgsParser():
     p.add_argument('-f', action='store_true', dest='isForce',
     help='If set, overwrites output file.')
 
+    sel_g = p.add_argument_group('Selection options')
+    sel_g.add_argument('--only-failed', action='store_true', dest='only_failed',
+        help='If set, only runs the sessions that failed or were skipped (see tools/run_ledger.py).')
+    sel_g.add_argument('--only-pending', action='store_true', dest='only_pending',
+        help='If set, only runs the sessions that were never run or were interrupted.')
+
     log_g = p.add_argument_group('Logging options')
     log_g.add_argument(
         '-v', action='store_true', dest='isVerbose',
@@ -132,28 +138,12 @@ if __name__ == "__main__":
 
     subj_list = [subj for subj in args.subj]
     sess_list = [sess for sess in args.sess]
-    
-    if "all" in subj_list:
-        subjects = [s for s in os.listdir(data_path) if os.path.isdir(os.path.join(data_path, s)) if "sub-TIMESwp11s" in s]
-    else:
-        subjects = ['sub-' + subj for subj in subj_list]
-
-    if "all" in sess_list:
-        sessions = ["ses-T1", "ses-T2", "ses-T3", "ses-T4"]
-    else:
-        sessions = ['ses-' + sess for sess in sess_list]
-    
-    for subj, sess in itertools.product(subjects, sessions):
-            transfer_local(data_path, out_path, subj, sess, isForce)
-
-    # date = datetime.now()
-    # formatted_datetime = date.strftime("%Y-%m-%d-%H-%M-%S")
-    # fail_list_filename = f"fail_list_01_copy_data_locally_{formatted_datetime}.txt"
-    # for subj, sess in itertools.product(subjects, sessions):
-    #     try:
-    #         transfer_local(data_path, out_path, subj, sess, isForce)
-    #     except Exception as e:
-    #         with open(fail_list_filename, "+a") as f:
-    #             f.write(f"{subj} {sess} \n")
-    #             f.write(f"{str(e)} \n")
 
+    # The runs are recorded in the ledger of the local copy
+    script = '01_copy_data_locally'
+    manifest = Manifest(data_path)
+    pairs = manifest.select(subj_list, sess_list)
+    if not args.isForce:
+        pairs = manifest.incomplete(script, pairs)
+    for subj, sess in select_sessions(out_path, script, pairs, args.only_failed, args.only_pending):
+        run_step(out_path, script, subj, sess, transfer_local, data_path, out_path, subj, sess, isForce)
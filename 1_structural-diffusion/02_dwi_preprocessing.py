@@ -7,14 +7,16 @@ import logging
 import os
 import json
 import shutil
-import subprocess
 import time
 import os.path
 import nibabel as nib
 import numpy as np
-import itertools
-from datetime import datetime
 from tools.registration_ants import *
+from tools.command import run_cmd, merge_resources
+from tools.run_ledger import run_step, select_sessions
+from tools.manifest import Manifest
+from tools.outputs import is_valid, save_image
+from tools.staging import Stager
 import resource
 
 def buildArgsParser():
@@ -28,18 +30,26 @@ def buildArgsParser():
 
     p.add_argument('--data_path', default='/mnt/Hummel-Data/TI/mri/51T', dest='data_path',
         help="Subjects folder path. ['%(default)s']")
+    p.add_argument('--scratch', default=None, dest='scratch',
+        help="Local folder (i.e. NVMe scratch) where the sessions are staged, see tools/staging.py.")
 
-    current_working_directory = os.getcwd()
+    eddy_folder = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'eddy')
 
-    p.add_argument('--acqparams_file', default= current_working_directory + '/eddy/acqparams.txt', 
+    p.add_argument('--acqparams_file', default= os.path.join(eddy_folder, 'acqparams.txt'), 
         help="Aquisition paramters file. ['%(default)s']") 
 
-    p.add_argument('--index_file', default= current_working_directory + '/eddy/eddy_index.txt', 
+    p.add_argument('--index_file', default= os.path.join(eddy_folder, 'eddy_index.txt'), 
         help="Aquisition paramters file. ['%(default)s']")
 
     p.add_argument('-f', action='store_true', dest='isForce', 
     help='If set, overwrites output file.')
 
+    sel_g = p.add_argument_group('Selection options')
+    sel_g.add_argument('--only-failed', action='store_true', dest='only_failed',
+        help='If set, only runs the sessions that failed or were skipped (see tools/run_ledger.py).')
+    sel_g.add_argument('--only-pending', action='store_true', dest='only_pending',
+        help='If set, only runs the sessions that were never run or were interrupted.')
+
     log_g = p.add_argument_group('Logging options')
     log_g.add_argument(
         '-v', action='store_true', dest='isVerbose',
@@ -73,7 +83,7 @@ def pre_proc(data_path:str, subj:str, sess:str, isForce:bool):
         dwi_target_folder = os.path.join(session_folder, "01_dwi", subj, sess, "dwi", "preproc")
         dwi_out = os.path.join(dwi_target_folder,subj + "_" + sess + "_dwi")
 
-        if os.path.isfile(dwi_out + ".nii.gz") and not isForce:
+        if is_valid(dwi_out + ".nii.gz") and not isForce:
             logging.info('Preprocessing already done.')
             return    
 
@@ -87,17 +97,18 @@ def pre_proc(data_path:str, subj:str, sess:str, isForce:bool):
         print('#### Degibbs ####')
         dwi_ap_degibbs_filename = os.path.join(dwi_target_folder,subj + "_" + sess + "_dir-AP_degibbsDwi.nii.gz")
         json_file = os.path.join(dwi_target_folder,subj + "_" + sess + "_dir-AP_degibbsDwi.json")
-        if os.path.isfile(dwi_ap_degibbs_filename) and not isForce:
+        if is_valid(dwi_ap_degibbs_filename) and not isForce:
             logging.info('mrdegibbs AP already done.')
         else:
             mrdegibbs_cmd = "mrdegibbs " + dwi_ap_filename + " " + dwi_ap_degibbs_filename
             logging.info('mrdegibbs command: "{0}".'.format(mrdegibbs_cmd))
-            subprocess.call(mrdegibbs_cmd, shell=True)
+            resources = run_cmd(mrdegibbs_cmd, outputs=[dwi_ap_degibbs_filename])
             with open(json_file, 'w') as outfile:
                 j = {
                     'Origin function': mrdegibbs_cmd,
                     'Description': 'degibbs ap',
                     'dwi_ap_filename': dwi_ap_degibbs_filename,
+                    'Resources': resources,
                     'Time' : time.asctime()
                     }
                 json.dump(j, outfile)
@@ -105,17 +116,18 @@ def pre_proc(data_path:str, subj:str, sess:str, isForce:bool):
         dwi_pa_degibbs_filename = os.path.join(dwi_target_folder,subj + "_" + sess + "_dir-PA_degibbsDwi.nii.gz")
         json_file = os.path.join(dwi_target_folder,subj + "_" + sess + "_dir-PA_degibbsDwi.json")
             
-        if os.path.isfile(dwi_pa_degibbs_filename) and not isForce:
+        if is_valid(dwi_pa_degibbs_filename) and not isForce:
             logging.info('mrdegibbs PA already done.')
         else:
             mrdegibbs_cmd = "mrdegibbs " + dwi_pa_filename + " " + dwi_pa_degibbs_filename
             logging.info('mrdegibbs command: "{0}".'.format(mrdegibbs_cmd))
-            subprocess.call(mrdegibbs_cmd, shell=True)
+            resources = run_cmd(mrdegibbs_cmd, outputs=[dwi_pa_degibbs_filename])
             with open(json_file, 'w') as outfile:
                 j = {
                     'Origin function': mrdegibbs_cmd,
                     'Description': 'degibbs pa',
                     'dwi_pa_filename': dwi_pa_degibbs_filename,
+                    'Resources': resources,
                     'Time' : time.asctime()
                     }
                 json.dump(j, outfile)        
@@ -131,10 +143,10 @@ def pre_proc(data_path:str, subj:str, sess:str, isForce:bool):
         b0s_filename = os.path.join(dwi_target_folder, subj + "_" + sess + "_dir-APPA_b0s.nii.gz")
         b0s = np.stack([dwi_ap.get_fdata()[:,:,:,0], dwi_pa.get_fdata()[:,:,:,0]],axis=3)
         json_file = os.path.join(dwi_target_folder,subj + "_" + sess + "_dir-APPA_b0s.json")
-        if os.path.isfile(b0s_filename) and not isForce:
+        if is_valid(b0s_filename) and not isForce:
             logging.info('B0s extracted already done.')
         else:
-            nib.Nifti1Image(b0s, dwi_pa.affine, dwi_pa.header).to_filename(b0s_filename)
+            save_image(nib.Nifti1Image(b0s, dwi_pa.affine, dwi_pa.header), b0s_filename)
             orig_func_label = "nib.Nifti1Image(b0s, dwi_pa.affine, dwi_pa.header).to_filename(" + b0s_filename + ")"
             with open(json_file, 'w') as outfile:
                 j = {
@@ -149,10 +161,10 @@ def pre_proc(data_path:str, subj:str, sess:str, isForce:bool):
         b0s_mean_filename = os.path.join(dwi_target_folder, subj + "_" + sess + "_dir-APPA_meanB0.nii.gz")
         b0_mean = np.mean(b0s,axis=3)
         json_file = os.path.join(dwi_target_folder, subj + "_" + sess + "_dir-APPA_mean0.json")
-        if os.path.isfile(b0s_mean_filename) and not isForce:
+        if is_valid(b0s_mean_filename) and not isForce:
             logging.info('B0 mean extracted already done.')
         else:
-            nib.Nifti1Image(b0_mean,dwi_pa.affine, dwi_pa.header).to_filename(b0s_mean_filename)
+            save_image(nib.Nifti1Image(b0_mean,dwi_pa.affine, dwi_pa.header), b0s_mean_filename)
             orig_func_label = "nib.Nifti1Image(b0_mean,dwi_pa.affine, dwi_pa.header).to_filename(" + b0s_mean_filename + ")"
             with open(json_file, 'w') as outfile:
                 j = {
@@ -169,17 +181,18 @@ def pre_proc(data_path:str, subj:str, sess:str, isForce:bool):
         print('#### Bet ####')
         b0s_mean_brain_filename = os.path.join(dwi_target_folder,subj + "_" + sess + "_dir-APPA_meanB0brain.nii.gz")
         json_file = os.path.join(dwi_target_folder,subj + "_" + sess + "_dir-APPA_meanB0brain.json")
-        if os.path.isfile(b0s_mean_brain_filename) and not isForce:
+        if is_valid(b0s_mean_brain_filename) and not isForce:
             logging.info('Bet already done.')
         else:
             bet_cmd = "bet " + b0s_mean_filename + " " + b0s_mean_brain_filename + " -f 0.4 -g 0"
             logging.info('Bet command: "{0}".'.format(bet_cmd))
-            subprocess.call(bet_cmd, shell=True)
+            resources = run_cmd(bet_cmd, outputs=[b0s_mean_brain_filename])
             with open(json_file, 'w') as outfile:
                 j = {
                     'Origin function': bet_cmd,
                     'Description': 'bet on mean b0',
                     'bet meanb0_filename': b0s_mean_brain_filename,
+                    'Resources': resources,
                     'Time' : time.asctime()
                     }
                 json.dump(j, outfile)
@@ -192,7 +205,7 @@ def pre_proc(data_path:str, subj:str, sess:str, isForce:bool):
         print('#### Topup ####')
         topup_out =  os.path.join(dwi_target_folder,subj + "_" + sess + "_topup")
         json_file = os.path.join(dwi_target_folder,subj + "_" + sess + "_topup_fieldcoef.json")
-        if os.path.isfile(topup_out + "_fieldcoef.nii.gz") and not isForce:
+        if is_valid(topup_out + "_fieldcoef.nii.gz") and not isForce:
                 logging.info('Topup already done.')
         else:
             topup_cmd = "topup --imain=" + b0s_filename + \
@@ -200,12 +213,13 @@ def pre_proc(data_path:str, subj:str, sess:str, isForce:bool):
             " --out=" + topup_out +\
             " --config=b02b0.cnf --subsamp=1" 
             logging.info('Topup command: "{0}".'.format(topup_cmd))
-            subprocess.call(topup_cmd, shell=True)
+            resources = run_cmd(topup_cmd, outputs=[topup_out + "_fieldcoef.nii.gz"])
             with open(json_file, 'w') as outfile:
                 j = {
                     'Origin function': topup_cmd,
                     'Description': 'topup on b0',
                     'topup field coefficient file': (topup_out + "_fieldcoef.nii.gz"),
+                    'Resources': resources,
                     'Time' : time.asctime()
                     }
                 json.dump(j, outfile)        
@@ -218,12 +232,12 @@ def pre_proc(data_path:str, subj:str, sess:str, isForce:bool):
         print('#### Eddy ####')
         eddy_out=os.path.join(dwi_target_folder,subj + "_" + sess + "_eddy")
         json_file = os.path.join(dwi_target_folder,subj + "_" + sess + "_eddy.json")
-        if os.path.isfile(eddy_out + ".nii.gz") and not isForce:
+        if is_valid(eddy_out + ".nii.gz") and not isForce:
             logging.info('Eddy already done.')
         else:   
             eddy_cmd ="eddy_openmp --imain=" + dwi_ap_degibbs_filename + " --mask=" + b0s_mean_brain_filename + " --index=" + args.index_file + " --mb=2 --acqp=" + args.acqparams_file +  " --bvals=" + os.path.join(dwi_raw_folder,subj + "_" + sess + "_dwi_AP_1.bval") + " --topup=" + topup_out + " --bvecs=" + os.path.join(dwi_raw_folder,subj + "_" + sess + "_dwi_AP_1.bvec") + " --out=" + eddy_out  + " --data_is_shelled" 
             logging.info('Eddy command: "{0}".'.format(eddy_cmd))
-            subprocess.call(eddy_cmd, shell=True)
+            resources = run_cmd(eddy_cmd, outputs=[eddy_out + ".nii.gz", eddy_out + ".eddy_rotated_bvecs"])
             # Copy(source, destination) data and right -> corrected bvec and bval : everything we need will be in derivatives
             shutil.copy(eddy_out + ".eddy_rotated_bvecs", dwi_out + ".bvec") 
             shutil.copy(os.path.join(dwi_raw_folder, subj + "_" + sess + "_dwi_AP_1.bval"), dwi_out + ".bval")
@@ -232,6 +246,7 @@ def pre_proc(data_path:str, subj:str, sess:str, isForce:bool):
                     'Origin function': eddy_cmd,
                     'Description': 'eddy on b0',
                     'eddy file': (eddy_out + ".nii.gz"),
+                    'Resources': resources,
                     'Time' : time.asctime()
                     }
                 json.dump(j, outfile)        
@@ -243,21 +258,22 @@ def pre_proc(data_path:str, subj:str, sess:str, isForce:bool):
         print('#### Debias ####')
         biasField_out=os.path.join(dwi_target_folder,subj + "_" + sess + "_meanB0brain")
         json_file = os.path.join(dwi_target_folder,subj + "_" + sess + "_meanB0brain_bias.json")
-        if os.path.isfile(biasField_out + "_bias.nii.gz") and not isForce:
+        if is_valid(biasField_out + "_bias.nii.gz") and not isForce:
             logging.info('Debias already done.')
         else:
             fast_cmd="fast -t 2 -n 3 -H 0.1 -I 4 -l 20.0 -b -o " + biasField_out + " " + " " + b0s_mean_brain_filename
             logging.info('Fast debias command: "{0}".'.format(fast_cmd))
-            subprocess.call(fast_cmd, shell=True)
+            fast_resources = run_cmd(fast_cmd, outputs=[biasField_out + "_bias.nii.gz"])
 
             fslmaths_cmd = "fslmaths " + eddy_out + " -div " + biasField_out + "_bias.nii.gz " + dwi_out
             logging.info('Apply debias command: "{0}".'.format(fslmaths_cmd))
-            subprocess.call(fslmaths_cmd, shell=True)
+            resources = merge_resources(fast_resources, run_cmd(fslmaths_cmd, outputs=[dwi_out + ".nii.gz"]))
             with open(json_file, 'w') as outfile:
                 j = {
                     'Origin function': fslmaths_cmd, 
                     'Description': 'debias field on b0',
                     'eddy file': (biasField_out + "_bias.nii.gz"),
+                    'Resources': resources,
                     'Time' : time.asctime()
                     }
                 json.dump(j, outfile)       
@@ -277,18 +293,18 @@ def pre_proc(data_path:str, subj:str, sess:str, isForce:bool):
         # If doesn't existe creat a directory trash
         if not os.path.isdir(folder_trash):
             cmd_trash_dir = 'mkdir ' + folder_trash
-            subprocess.call(cmd_trash_dir, shell=True)
+            run_cmd(cmd_trash_dir)
 
         # Put the file on it if exist
         for file in files_to_move:
             file_to_move = os.path.join(dwi_target_folder, subj + "_" + sess + file)
             if os.path.exists(file_to_move):
                 cmd_move = "mv " + file_to_move + " " + folder_trash
-                subprocess.call(cmd_move, shell=True)
+                run_cmd(cmd_move)
         
         if os.path.exists(b0s_filename[:-6]+"topup_log"):
             cmd_move = "mv " + b0s_filename[:-6]+"topup_log" + " " + folder_trash
-            subprocess.call(cmd_move, shell=True)
+            run_cmd(cmd_move)
 
         
         #------------------------------------------------------------#
@@ -299,14 +315,14 @@ def pre_proc(data_path:str, subj:str, sess:str, isForce:bool):
         meanB0_filename = os.path.join(dwi_target_folder, subj + "_" + sess + "_dwi_mean-b0.nii.gz")
         meanB0bet_filename = os.path.join(dwi_target_folder, subj + "_" + sess + "_dwi_mean-b0_bet.nii.gz")
         json_file = os.path.join(dwi_target_folder, subj + "_" + sess + "_dwi_mean-b0.json")
-        if os.path.isfile(meanB0_filename) and not isForce:
+        if is_valid(meanB0_filename) and not isForce:
             logging.info('mean b0 already extracted: "{0}".'.format(meanB0_filename))
         else:
             dwi = nib.load(dwi_out + ".nii.gz")
             bval = np.loadtxt(dwi_out + ".bval")
             b0s = dwi.get_fdata()[:,:,:,bval==0]
             meanB0 = np.mean(b0s, axis=3)
-            nib.Nifti1Image(meanB0,dwi.affine,dwi.header).to_filename(meanB0_filename)
+            save_image(nib.Nifti1Image(meanB0,dwi.affine,dwi.header), meanB0_filename)
 
             orig_func_label = "nib.Nifti1Image(meanB0,dwi.affine,dwi.header).to_filename(" + meanB0_filename + ") with dwi --> dwi = nib.load(" + dwi_out + ".nii.gz)"
             with open(json_file, 'w') as outfile:
@@ -331,12 +347,13 @@ def pre_proc(data_path:str, subj:str, sess:str, isForce:bool):
             bet_cmd = "bet " + meanB0_filename + " " + meanB0bet_filename + " -f 0.4 -g 0 -m"
             logging.info('Bet command: "{0}".'.format(bet_cmd))
             print(bet_cmd)
-            subprocess.call(bet_cmd, shell=True)
+            resources = run_cmd(bet_cmd, outputs=[meanB0bet_filename])
             with open(json_file, 'w') as outfile:
                 j = {
                     'Origin function': bet_cmd,
                     'Description': 'bet on mean b0',
                     'b0bet_filename': meanB0bet_filename,
+                    'Resources': resources,
                     'Time' : time.asctime()
                     }
                 json.dump(j, outfile)
@@ -356,25 +373,15 @@ if __name__ == "__main__":
 
     data_path = args.data_path
 
-    if "all" in subj_list:
-        subjects = [s for s in os.listdir(data_path) if os.path.isdir(os.path.join(data_path, s)) if "sub-51T" in s]
-    else:
-        subjects = ['sub-' + subj for subj in subj_list]
-    
-    
     sess_list = [sess for sess in args.sess]
-    if "all" in sess_list:
-       sessions = ["ses-T1", "ses-T2", "ses-T3", "ses-T4"]
-    else:
-        sessions = ['ses-' + sess for sess in sess_list]
     
-    date = datetime.now()
-    formatted_datetime = date.strftime("%Y-%m-%d-%H-%M-%S")
-    fail_list_filename = f"fail_list_02_dwi_preprocessing_{formatted_datetime}.txt"
-    for subj, sess in itertools.product(subjects, sessions):        
-            try:
-                pre_proc(data_path, subj, sess, isForce)
-            except Exception as e:
-                with open(fail_list_filename, "+a") as f:
-                    f.write(f"{subj} {sess} \n")
-                    f.write(f"{str(e)} \n")
+    script = '02_dwi_preprocessing'
+    manifest = Manifest(data_path)
+    pairs = manifest.select(subj_list, sess_list, 'dwi')
+    if not args.isForce:
+        pairs = manifest.incomplete(script, pairs)
+    stager = Stager(data_path, args.scratch, script)
+    for subj, sess in stager.sessions(select_sessions(data_path, script, pairs, args.only_failed, args.only_pending)):
+        run_step(data_path, script, subj, sess, pre_proc, stager.path(subj, sess), subj, sess, isForce)
+        stager.write_back(subj, sess)
+    stager.close()
@@ -8,15 +8,13 @@ import logging
 import os
 import json
 import shutil
-import subprocess
 import time
-import itertools
 import os.path
-import nibabel as nib
-import numpy as np
-from utils import *
 from tools.registration_ants import *
-from datetime import datetime
+from tools.command import run_cmd
+from tools.run_ledger import run_step, select_sessions
+from tools.manifest import Manifest
+from tools.outputs import is_valid
 
 def buildArgsParser():
     p = argparse.ArgumentParser(
@@ -35,6 +33,12 @@ def buildArgsParser():
     p.add_argument('-f', action='store_true', dest='isForce',
     help='If set, overwrites output file.')
 
+    sel_g = p.add_argument_group('Selection options')
+    sel_g.add_argument('--only-failed', action='store_true', dest='only_failed',
+        help='If set, only runs the sessions that failed or were skipped (see tools/run_ledger.py).')
+    sel_g.add_argument('--only-pending', action='store_true', dest='only_pending',
+        help='If set, only runs the sessions that were never run or were interrupted.')
+
     log_g = p.add_argument_group('Logging options')
     log_g.add_argument(
         '-v', action='store_true', dest='isVerbose',
@@ -90,18 +94,19 @@ def lesionTransplantation_anat(data_path:str, output_path:str, subj:str, sess:st
     ### %%%%%%%%%%%%%%%%%%%%%%%%%%%% Flip anat image %%%%%%%%%%%%%%%%%%%%%%%%%%%% ###
     anat_file_flipped = os.path.join(output_lesion_transpl_folder, subj + "_" + sess + "_acq-mprage_T1w_flipped.nii.gz")
     json_file = os.path.join(output_lesion_transpl_folder, subj + "_" + sess + "_acq-mprage_T1w_flipped.json")
-    if os.path.isfile(anat_file_flipped):
+    if is_valid(anat_file_flipped):
         print("Non affected hemi already flipped")
     else:
         fslswapdim_cmd = "fslswapdim " + anat_file + " -x y z " + anat_file_flipped
         print(fslswapdim_cmd)
         logging.info('fslswapdim command: "{0}".'.format(fslswapdim_cmd))
-        subprocess.call(fslswapdim_cmd, shell=True)
+        resources = run_cmd(fslswapdim_cmd, outputs=[anat_file_flipped])
         with open(json_file, 'w') as outfile:
             j = {
                 'Origin function': fslswapdim_cmd,
                 'Description': 'Flipped non affected hemisphere',
                 'Anat_filename': anat_file_flipped,
+                'Resources': resources,
                 'Time' : time.asctime()
                 }
             json.dump(j, outfile)
@@ -110,18 +115,19 @@ def lesionTransplantation_anat(data_path:str, output_path:str, subj:str, sess:st
     ### %%%%%%%%%%%%%%%%%%%%% image within the lesion mask %%%%%%%%%%%%%%%%%%%%% ###
     lesion_extracted_T1w_file = os.path.join(output_lesion_folder, subj + "_" + sess + "_T1w_label-lesion_extracted_T1w.nii.gz")
     json_file = os.path.join(output_lesion_folder, subj + "_" + sess + "_T1w_label-lesion_extracted_T1w.json")
-    if os.path.isfile(lesion_extracted_T1w_file):
+    if is_valid(lesion_extracted_T1w_file):
         print("Voxels within the mask already extracted")
     else:
         fslmaths_cmd = "fslmaths " + anat_file_flipped + " -mul " + output_lesion_file + " " + lesion_extracted_T1w_file
         print(fslmaths_cmd)
         logging.info('fslmaths command: "{0}".'.format(fslmaths_cmd))
-        subprocess.call(fslmaths_cmd, shell=True)
+        resources = run_cmd(fslmaths_cmd, outputs=[lesion_extracted_T1w_file])
         with open(json_file, 'w') as outfile:
             j = {
                 'Origin function': fslmaths_cmd,
                 'Description': 'Select voxels within mask',
                 'Anat_filename': lesion_extracted_T1w_file,
+                'Resources': resources,
                 'Time' : time.asctime()
                 }
             json.dump(j, outfile)
@@ -130,55 +136,58 @@ def lesionTransplantation_anat(data_path:str, output_path:str, subj:str, sess:st
     ### %%%%% in order to obtain the reference image for the coregistration %%%% ###
     inversed_lesion_mask_file = os.path.join(output_lesion_folder, subj + "_" + sess + "_T1w_label-lesion_roi_inversed.nii.gz")
     json_file = os.path.join(output_lesion_folder, subj + "_" + sess + "_T1w_label-lesion_roi_inversed.json")
-    if os.path.isfile(inversed_lesion_mask_file):
+    if is_valid(inversed_lesion_mask_file):
         print(inversed_lesion_mask_file)
         print("Lesion mask already inverted")
     else:
         fslmaths_cmd = "fslmaths " + output_lesion_file + " -sub 1 -abs " + inversed_lesion_mask_file
         print(fslmaths_cmd)
         logging.info('fslmaths command: "{0}".'.format(fslmaths_cmd))
-        subprocess.call(fslmaths_cmd, shell=True)
+        resources = run_cmd(fslmaths_cmd, outputs=[inversed_lesion_mask_file])
         with open(json_file, 'w') as outfile:
             j = {
                 'Origin function': fslmaths_cmd,
                 'Description': 'Lesion mask inversion',
                 'Anat_filename': inversed_lesion_mask_file,
+                'Resources': resources,
                 'Time' : time.asctime()
                 }
             json.dump(j, outfile)
 
     tmp_anat_without_lesion_mask_file = os.path.join(output_lesion_transpl_folder, subj + "_" + sess + '_T1w_without_lesion_mask.nii.gz')
     json_file = os.path.join(output_lesion_transpl_folder, subj + "_" + sess + '_T1w_without_lesion_mask.json')
-    if os.path.isfile(tmp_anat_without_lesion_mask_file):
+    if is_valid(tmp_anat_without_lesion_mask_file):
         print("Voxels within the mask already extracted")
     else:
         fslmaths_cmd = "fslmaths " + anat_file + " -mul " + inversed_lesion_mask_file + " " + tmp_anat_without_lesion_mask_file
         print(fslmaths_cmd)
         logging.info('fslmaths command: "{0}".'.format(fslmaths_cmd))
-        subprocess.call(fslmaths_cmd, shell=True)
+        resources = run_cmd(fslmaths_cmd, outputs=[tmp_anat_without_lesion_mask_file])
         with open(json_file, 'w') as outfile:
             j = {
                 'Origin function': fslmaths_cmd,
                 'Description': 'Lesion removed from the anatomical image',
                 'Anat_filename': tmp_anat_without_lesion_mask_file,
+                'Resources': resources,
                 'Time' : time.asctime()
                 }
             json.dump(j, outfile)
 
     anat_no_coregistered_lesion_file = os.path.join(output_lesion_transpl_folder, subj + "_" + sess + '_T1w_with_no_coregistered_lesion.nii.gz')
     json_file = os.path.join(output_lesion_transpl_folder, subj + "_" + sess + '_T1w_with_no_coregistered_lesion.json')
-    if os.path.isfile(anat_no_coregistered_lesion_file):
+    if is_valid(anat_no_coregistered_lesion_file):
         print("Voxels within the mask already extracted")
     else:
         fslmaths_cmd = "fslmaths " + tmp_anat_without_lesion_mask_file + " -add " + lesion_extracted_T1w_file + " " + anat_no_coregistered_lesion_file
         print(fslmaths_cmd)
         logging.info('fslmaths command: "{0}".'.format(fslmaths_cmd))
-        subprocess.call(fslmaths_cmd, shell=True)
+        resources = run_cmd(fslmaths_cmd, outputs=[anat_no_coregistered_lesion_file])
         with open(json_file, 'w') as outfile:
             j = {
                 'Origin function': fslmaths_cmd,
                 'Description': 'Anatomical image with transplanted region',
                 'Anat_filename': anat_no_coregistered_lesion_file,
+                'Resources': resources,
                 'Time' : time.asctime()
                 }
             json.dump(j, outfile)
@@ -186,18 +195,19 @@ def lesionTransplantation_anat(data_path:str, output_path:str, subj:str, sess:st
     ### %%%%%%%%%%%%%%%%%%%%%%%%%%%% Flip lesion mask %%%%%%%%%%%%%%%%%%%%%%%%%%% ###
     inversed_lesion_mask_flipped = os.path.join(output_lesion_folder, subj + "_" + sess + "_T1w_label-lesion_roi_inversed_flipped.nii.gz")
     json_file = os.path.join(output_lesion_folder, subj + "_" + sess + "_T1w_label-lesion_roi_inversed_flipped.json")
-    if os.path.isfile(inversed_lesion_mask_flipped):
+    if is_valid(inversed_lesion_mask_flipped):
         print("Non affected hemi already flipped")
     else:
         fslswapdim_cmd = "fslswapdim " + inversed_lesion_mask_file + " -x y z " + inversed_lesion_mask_flipped
         print(fslswapdim_cmd)
         logging.info('fslswapdim command: "{0}".'.format(fslswapdim_cmd))
-        subprocess.call(fslswapdim_cmd, shell=True)
+        resources = run_cmd(fslswapdim_cmd, outputs=[inversed_lesion_mask_flipped])
         with open(json_file, 'w') as outfile:
             j = {
                 'Origin function': fslswapdim_cmd,
                 'Description': 'Flipped inversed lesion mask',
                 'Anat_filename': inversed_lesion_mask_flipped,
+                'Resources': resources,
                 'Time' : time.asctime()
                 }
             json.dump(j, outfile)
@@ -205,18 +215,19 @@ def lesionTransplantation_anat(data_path:str, output_path:str, subj:str, sess:st
     ### %%%%%%%%%%%% Flip extracted healthy tissue within lesion mask %%%%%%%%%%% ###
     lesion_extracted_T1w_flipped = os.path.join(output_lesion_folder, subj + "_" + sess + "_T1w_label-lesion_extracted_T1w_flipped.nii.gz")
     json_file = os.path.join(output_lesion_folder, subj + "_" + sess + "_T1w_label-lesion_extracted_T1w_flipped.json")
-    if os.path.isfile(lesion_extracted_T1w_flipped):
+    if is_valid(lesion_extracted_T1w_flipped):
         print("Non affected hemi already flipped")
     else:
         fslswapdim_cmd = "fslswapdim " + lesion_extracted_T1w_file + " -x y z " + lesion_extracted_T1w_flipped
         print(fslswapdim_cmd)
         logging.info('fslswapdim command: "{0}".'.format(fslswapdim_cmd))
-        subprocess.call(fslswapdim_cmd, shell=True)
+        resources = run_cmd(fslswapdim_cmd, outputs=[lesion_extracted_T1w_flipped])
         with open(json_file, 'w') as outfile:
             j = {
                 'Origin function': fslswapdim_cmd,
                 'Description': 'Flipped extracted healthy tissue within lesion mask',
                 'Anat_filename': lesion_extracted_T1w_flipped,
+                'Resources': resources,
                 'Time' : time.asctime()
                 }
             json.dump(j, outfile)
@@ -226,36 +237,38 @@ def lesionTransplantation_anat(data_path:str, output_path:str, subj:str, sess:st
     ### %%%%%%% in order to obtain the input image for the coregistration %%%%%% ###
     tmp_anat_flipped_without_lesion_mask_file = os.path.join(output_lesion_transpl_folder, subj + "_" + sess + '_T1w_flipped_without_lesion_mask.nii.gz')
     json_file = os.path.join(output_lesion_transpl_folder, subj + "_" + sess + '_T1w_flipped_without_lesion_mask.json')
-    if os.path.isfile(tmp_anat_flipped_without_lesion_mask_file):
+    if is_valid(tmp_anat_flipped_without_lesion_mask_file):
         print("Voxels within the mask already extracted")
     else:
         fslmaths_cmd = "fslmaths " + anat_file_flipped + " -mul " + inversed_lesion_mask_flipped + " " + tmp_anat_flipped_without_lesion_mask_file
         print(fslmaths_cmd)
         logging.info('fslmaths command: "{0}".'.format(fslmaths_cmd))
-        subprocess.call(fslmaths_cmd, shell=True)
+        resources = run_cmd(fslmaths_cmd, outputs=[tmp_anat_flipped_without_lesion_mask_file])
         with open(json_file, 'w') as outfile:
             j = {
                 'Origin function': fslmaths_cmd,
                 'Description': 'Lesion removed from the flipped anatomical image',
                 'Anat_filename': tmp_anat_flipped_without_lesion_mask_file,
+                'Resources': resources,
                 'Time' : time.asctime()
                 }
             json.dump(j, outfile)
 
     anat_flipped_no_coregistered_lesion_file = os.path.join(output_lesion_transpl_folder, subj + "_" + sess + '_T1w_flipped_with_no_coregistered_lesion.nii.gz')
     json_file = os.path.join(output_lesion_transpl_folder, subj + "_" + sess + '_T1w_flipped_with_no_coregistered_lesion.json')
-    if os.path.isfile(anat_flipped_no_coregistered_lesion_file):
+    if is_valid(anat_flipped_no_coregistered_lesion_file):
         print("Voxels within the mask already extracted")
     else:
         fslmaths_cmd = "fslmaths " + tmp_anat_flipped_without_lesion_mask_file + " -add " + lesion_extracted_T1w_flipped + " " + anat_flipped_no_coregistered_lesion_file
         print(fslmaths_cmd)
         logging.info('fslmaths command: "{0}".'.format(fslmaths_cmd))
-        subprocess.call(fslmaths_cmd, shell=True)
+        resources = run_cmd(fslmaths_cmd, outputs=[anat_flipped_no_coregistered_lesion_file])
         with open(json_file, 'w') as outfile:
             j = {
                 'Origin function': fslmaths_cmd,
                 'Description': 'Flipped anatomical image with transplanted region',
                 'Anat_filename': anat_flipped_no_coregistered_lesion_file,
+                'Resources': resources,
                 'Time' : time.asctime()
                 }
             json.dump(j, outfile)
@@ -263,7 +276,7 @@ def lesionTransplantation_anat(data_path:str, output_path:str, subj:str, sess:st
     ### %%%%%%%%%%%%%%%%%%%%% Coregistration of hemispheres %%%%%%%%%%%%%%%%%%%%% ###
     nonAffected2affected_brain_hemi_file = os.path.join(output_lesion_transpl_folder, subj + "_" + sess + "_T1w_flipped2T1w_without_les.nii.gz")
     json_file = os.path.join(output_lesion_transpl_folder, subj + "_" + sess + "_T1w_flipped2T1w_without_les.json")
-    if os.path.isfile(nonAffected2affected_brain_hemi_file) and not isForce:
+    if is_valid(nonAffected2affected_brain_hemi_file) and not isForce:
         logging.info('ANTS already performed: "{0}".'.format(nonAffected2affected_brain_hemi_file))
     else:
         input_file = anat_flipped_no_coregistered_lesion_file
@@ -273,12 +286,13 @@ def lesionTransplantation_anat(data_path:str, output_path:str, subj:str, sess:st
         original_file = os.path.join(output_lesion_transpl_folder, subj + "_" + sess + '_T1w_flipped_with_no_coregistered_lesion.nii.gz')
         ref_file = anat_no_coregistered_lesion_file
         inv = False
-        registerAnts(input_file, output_file, warp_folder, warp_name, original_file, ref_file, inv)
+        resources = registerAnts(input_file, output_file, warp_folder, warp_name, original_file, ref_file, inv)
         with open(json_file, 'w') as outfile:
             j = {
                 'Origin function': "registerAnts with registration_ants.py" + input_file + "&" + output_file + " ",
                 'Description': 'Non affected hemisphere coregistered on the affected one',
                 'Anat_filename': nonAffected2affected_brain_hemi_file,
+                'Resources': resources,
                 'Time' : time.asctime()
                 }
             json.dump(j, outfile)
@@ -286,18 +300,19 @@ def lesionTransplantation_anat(data_path:str, output_path:str, subj:str, sess:st
     ### %%%%%%%%%%%%%%%%%%%%%%% Select voxels within mask %%%%%%%%%%%%%%%%%%%%%% ###
     lesion_extracted_T1w_coregistered_file = os.path.join(output_lesion_folder, subj + "_" + sess + "_T1w_label-lesion_extracted_T1w_coregistered.nii.gz")
     json_file = os.path.join(output_lesion_folder, subj + "_" + sess + "_T1w_label-lesion_extracted_T1w_coregistered.json")
-    if os.path.isfile(lesion_extracted_T1w_coregistered_file):
+    if is_valid(lesion_extracted_T1w_coregistered_file):
         print("Voxels within the mask already extracted")
     else:
         fslmaths_cmd = "fslmaths " + nonAffected2affected_brain_hemi_file + " -mul " + output_lesion_file + " " + lesion_extracted_T1w_coregistered_file
         print(fslmaths_cmd)
         logging.info('fslmaths command: "{0}".'.format(fslmaths_cmd))
-        subprocess.call(fslmaths_cmd, shell=True)
+        resources = run_cmd(fslmaths_cmd, outputs=[lesion_extracted_T1w_coregistered_file])
         with open(json_file, 'w') as outfile:
             j = {
                 'Origin function': fslmaths_cmd,
                 'Description': 'Select voxels within mask',
                 'Anat_filename': lesion_extracted_T1w_file,
+                'Resources': resources,
                 'Time' : time.asctime()
                 }
             json.dump(j, outfile)
@@ -305,18 +320,19 @@ def lesionTransplantation_anat(data_path:str, output_path:str, subj:str, sess:st
     ### %%%%%%%%%% Substitute original voxels with the extracted ones %%%%%%%%%% ###
     anat_transplanted_lesion_file = os.path.join(output_lesion_transpl_folder, subj + "_" + sess + '_T1w_with_transplanted_lesion.nii.gz')
     json_file = os.path.join(output_lesion_transpl_folder, subj + "_" + sess + '_T1w_with_transplanted_lesion.json')
-    if os.path.isfile(anat_transplanted_lesion_file):
+    if is_valid(anat_transplanted_lesion_file):
         print("Voxels within the mask already extracted")
     else:
         fslmaths_cmd = "fslmaths " + tmp_anat_without_lesion_mask_file + " -add " + lesion_extracted_T1w_coregistered_file + " " + anat_transplanted_lesion_file
         print(fslmaths_cmd)
         logging.info('fslmaths command: "{0}".'.format(fslmaths_cmd))
-        subprocess.call(fslmaths_cmd, shell=True)
+        resources = run_cmd(fslmaths_cmd, outputs=[anat_transplanted_lesion_file])
         with open(json_file, 'w') as outfile:
             j = {
                 'Origin function': fslmaths_cmd,
                 'Description': 'Anatomical image with transplanted region',
                 'Anat_filename': anat_transplanted_lesion_file,
+                'Resources': resources,
                 'Time' : time.asctime()
                 }
             json.dump(j, outfile)
@@ -339,16 +355,6 @@ if __name__ == "__main__":
     data_path = args.data_path
     output_path = args.output_path
 
-    if "all" in subj_list:
-        subjects = [s for s in os.listdir(data_path) if os.path.isdir(os.path.join(data_path, s)) if "sub-TIMESwp11s" in s]
-    else:
-        subjects = ['sub-' + subj for subj in subj_list]
-
-    if "all" in sess_list:
-        sessions = ["ses-T1", "ses-T2", "ses-T3", "ses-T4"]
-    else:
-        sessions = ['ses-' + sess for sess in sess_list]
-
     #Parallel(n_jobs=4)(delayed(lesionTransplantation_anat)(subj, sess, data_path, output_path, isForce)
                           #for subj, sess in itertools.product(subjects, sessions))
     
@@ -362,16 +368,13 @@ if __name__ == "__main__":
     #         with open("fail_list_02_lesionTransplantation.txt", "+a") as f:
     #             f.write(f"{subj} {sess} \n")
 
-    date = datetime.now()
-    formatted_datetime = date.strftime("%Y-%m-%d-%H-%M-%S")
-    fail_list_filename = f"fail_list_02_lesionTransplantation_{formatted_datetime}.txt"
-    for subj, sess in itertools.product(subjects, sessions):
-            try:
-                lesionTransplantation_anat(data_path, output_path, subj, sess, isForce)
-            except Exception as e:
-                with open(fail_list_filename, "+a") as f:
-                    f.write(f"{subj} {sess} \n")
-                    f.write(f"{str(e)} \n")
+    script = '03_lesionTransplantation_anat'
+    manifest = Manifest(data_path)
+    pairs = manifest.select(subj_list, sess_list, 'anat')
+    if not args.isForce:
+        pairs = manifest.incomplete(script, pairs)
+    for subj, sess in select_sessions(data_path, script, pairs, args.only_failed, args.only_pending):
+        run_step(data_path, script, subj, sess, lesionTransplantation_anat, data_path, output_path, subj, sess, isForce)
 
 
         # if (subj == "sub-TIMESwp11s027" and sess == "ses-T2") or \
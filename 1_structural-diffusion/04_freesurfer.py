@@ -30,15 +30,14 @@ import argparse
 import logging
 import os
 import json
-import subprocess
-import nibabel as nib
-import numpy as np
 import os.path
 import shutil
 import time
-import itertools
 from tools.registration_ants import *
-from datetime import datetime
+from tools.command import run_cmd
+from tools.run_ledger import run_step, select_sessions
+from tools.manifest import Manifest
+from tools.outputs import is_valid
 
 def buildArgsParser():
     p = argparse.ArgumentParser(
@@ -55,6 +54,12 @@ def buildArgsParser():
     p.add_argument('-f', action='store_true', dest='isForce',
     help='If set, overwrites output file.')
 
+    sel_g = p.add_argument_group('Selection options')
+    sel_g.add_argument('--only-failed', action='store_true', dest='only_failed',
+        help='If set, only runs the sessions that failed or were skipped (see tools/run_ledger.py).')
+    sel_g.add_argument('--only-pending', action='store_true', dest='only_pending',
+        help='If set, only runs the sessions that were never run or were interrupted.')
+
     log_g = p.add_argument_group('Logging options')
     log_g.add_argument(
         '-v', action='store_true', dest='isVerbose',
@@ -98,17 +103,18 @@ def freesurfer_func(data_path:str, subj:str, sess:str, isForce:bool, lesion:bool
     t1_for_fs = os.path.join(freesurfer_folder,subj + "-" + sess, 'mri', "orig", "001.mgz")
     json_file = os.path.join(freesurfer_folder,subj + "-" + sess, 'mri', "orig", "001.json")
     
-    if os.path.isfile(t1_for_fs) and not isForce:
+    if is_valid(t1_for_fs) and not isForce:
         logging.info('T1 for freesurfer already converted')
     else: 
         mr_convert_cmd = "mrconvert " + t1_for_fs_pre + " " + t1_for_fs 
         logging.info('mr convert command: "{0}".'.format(mr_convert_cmd))
-        subprocess.call(mr_convert_cmd, shell=True)
+        resources = run_cmd(mr_convert_cmd, outputs=[t1_for_fs])
         with open(json_file, 'w') as outfile:
             j = {
                 'Origin function': mr_convert_cmd,
                 'Description': 'Conversion of T1 for freesurfer',
                 'Anat_filename': t1_for_fs,
+                'Resources': resources,
                 'Time' : time.asctime()
                 }
             json.dump(j, outfile)
@@ -119,25 +125,41 @@ def freesurfer_func(data_path:str, subj:str, sess:str, isForce:bool, lesion:bool
 
     print('#### recon all ####')
     fs_output = os.path.join(freesurfer_folder, "brain.mgz")
-    if os.path.isfile(fs_output) and not isForce:
+    if is_valid(fs_output) and not isForce:
          logging.info('Freesurfer already run')
     else: 
          reconall_cmd = "recon-all -all -subjid " + subj + "-" + sess + " -openmp 12 -brainstem-structures" ## PB HERE
          logging.info('recon all command: "{0}".'.format(reconall_cmd))
-         subprocess.call(reconall_cmd, shell=True)
+         resources = run_cmd(reconall_cmd, outputs=[os.path.join(freesurfer_folder, subj + "-" + sess, "mri", "aparc.a2009s+aseg.mgz")])
+         with open(os.path.join(freesurfer_folder, subj + "-" + sess, 'mri', "recon-all.json"), 'w') as outfile:
+             j = {
+                 'Origin function': reconall_cmd,
+                 'Description': 'Freesurfer recon all',
+                 'Resources': resources,
+                 'Time' : time.asctime()
+                 }
+             json.dump(j, outfile)
 
     #------------------------------------------------------------#
     #### 3 SEGMENT BS CMD #### 
     #------------------------------------------------------------#
     print('#### segment BS ####')
     fs_bs_output = os.path.join(freesurfer_folder, "brainstemSsLabels.v13.mgz")
-    if os.path.isfile(fs_bs_output) and not isForce:
+    if is_valid(fs_bs_output) and not isForce:
          logging.info('Freesurfer already run')
     else: 
          #segment_bs_cmd = "segmentBS.sh " + subj + "-" + sess + " " + freesurfer_folder #FOR FREESURFER v 7
          segment_bs_cmd = "recon-all -s " + subj + "-" + sess + " -brainstem-structures" #FOR FREESURFER v 6
          logging.info('segment BS command: "{0}".'.format(segment_bs_cmd))
-         subprocess.call(segment_bs_cmd, shell=True)
+         resources = run_cmd(segment_bs_cmd)
+         with open(os.path.join(freesurfer_folder, subj + "-" + sess, 'mri', "brainstem-structures.json"), 'w') as outfile:
+             j = {
+                 'Origin function': segment_bs_cmd,
+                 'Description': 'Freesurfer brainstem segmentation',
+                 'Resources': resources,
+                 'Time' : time.asctime()
+                 }
+             json.dump(j, outfile)
 
 if __name__ == "__main__":  
     print('Starting free surfer module...')
@@ -152,28 +174,13 @@ if __name__ == "__main__":
 
     data_path = args.data_path
 
-    if "all" in subj_list:
-        subjects = [s for s in os.listdir(data_path) if os.path.isdir(os.path.join(data_path, s)) if "sub-51T" in s]
-    else:
-        subjects = ['sub-' + subj for subj in subj_list]
-
-    if "all" in sess_list:
-        sessions = ["ses-T1", "ses-T2", "ses-T3", "ses-T4"] 
-    else:
-        sessions = ['ses-' + sess for sess in sess_list]
-    
-
-    date = datetime.now()
-    formatted_datetime = date.strftime("%Y-%m-%d-%H-%M-%S")
-    fail_list_filename = f"fail_list_03_freesurfer_{formatted_datetime}.txt"
-    for subj, sess in itertools.product(subjects, sessions):
-        
+    script = '04_freesurfer'
+    manifest = Manifest(data_path)
+    pairs = manifest.select(subj_list, sess_list, 'anat')
+    if not args.isForce:
+        pairs = manifest.incomplete(script, pairs)
+    for subj, sess in select_sessions(data_path, script, pairs, args.only_failed, args.only_pending):
         if (not (subj in ("sub-TIMESwp11s036"))) & \
             (not (subj in ("sub-TIMESwp11s063"))):
-            try:
-                freesurfer_func(data_path, subj, sess, args.isForce, args.lesion)
-            except Exception as e:
-                with open(fail_list_filename, "+a") as f:
-                    f.write(f"{subj} {sess} \n")
-                    f.write(f"{str(e)} \n")
+            run_step(data_path, script, subj, sess, freesurfer_func, data_path, subj, sess, args.isForce, args.lesion)
 
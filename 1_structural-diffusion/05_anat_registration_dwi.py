@@ -8,13 +8,30 @@ import logging
 import os
 import json
 import time
-import subprocess
+import glob
 import nibabel as nib
 import numpy as np
 import os.path
-import itertools
-from datetime import datetime
 from tools.registration_ants import *
+from tools.command import run_cmd
+from tools.run_ledger import run_step, select_sessions
+from tools.manifest import Manifest
+from tools.outputs import is_valid, save_image
+from tools.header_resample import resample_labels
+from tools.fs_tissues import tissue_fractions
+from tools.staging import Stager
+
+# Sources of the T1 brain and tissue maps (--tissues)
+TISSUE_SOURCES = ('fast', 'freesurfer', 'auto')
+
+def tissue_source(json_file:str):
+    ''' Source of the T1 brain of a session from its sidecar, 'fast' for the sidecars written before the
+        sources (bet), None if it was never computed '''
+    try:
+        with open(json_file) as f:
+            return json.load(f).get('Tissue source', 'fast')
+    except (OSError, ValueError):
+        return None
 
 def buildArgsParser():
     p = argparse.ArgumentParser(
@@ -27,15 +44,32 @@ def buildArgsParser():
 
     p.add_argument('--data_path', default='/mnt/Hummel-Data/TI/mri/51T', dest='data_path',
         help="Subjects folder path. ['%(default)s']")
+    p.add_argument('--scratch', default=None, dest='scratch',
+        help="Local folder (i.e. NVMe scratch) where the sessions are staged, see tools/staging.py.")
 
     p.add_argument('-f', action='store_false', dest='isForce',
     help='If set, overwrites output file.')
+    p.add_argument('--tiered', action='store_true', dest='isTiered',
+    help='If set, the T1 to b0 warp is computed with the quick SyN, and with the full SyN only if the\n'
+         'quick one has a NMI below --nmi_threshold (see tools/registration_ants.py).')
+    p.add_argument('--nmi_threshold', type=float, default=NMI_THRESHOLD, dest='nmi_threshold',
+        help="NMI of the registered T1 and the mean b0 under which the full SyN is run. ['%(default)s']")
+    p.add_argument('--tissues', choices=TISSUE_SOURCES, default='fast', dest='tissues',
+        help="Source of the T1 brain and tissue maps of the 5TT image: bet and fast, the aseg and brainmask of\n"
+             "freesurfer (04_freesurfer.py, with the sub-cortical GM), or freesurfer if they exist. ['%(default)s']")
+
+    sel_g = p.add_argument_group('Selection options')
+    sel_g.add_argument('--only-failed', action='store_true', dest='only_failed',
+        help='If set, only runs the sessions that failed or were skipped (see tools/run_ledger.py).')
+    sel_g.add_argument('--only-pending', action='store_true', dest='only_pending',
+        help='If set, only runs the sessions that were never run or were interrupted.')
 
     log_g = p.add_argument_group('Logging options')
     log_g.add_argument('-v', action='store_false', dest='isVerbose', help='If set, produces verbose output.')
     return p
 
-def anat_reg_dwi(data_path:str, subj:str, sess:str, isForce:bool):
+def anat_reg_dwi(data_path:str, subj:str, sess:str, isForce:bool, tiered:bool=False, threshold:float=NMI_THRESHOLD,
+                 tissues:str='fast'):
     ''' Function computing registration from T1w space to dwi space
     
         Parameters
@@ -48,6 +82,11 @@ def anat_reg_dwi(data_path:str, subj:str, sess:str, isForce:bool):
             Current session
         isForce :
             Boolean indicating if files have to be overwritten
+        tiered, threshold :
+            Tiered registration of the T1 to b0 warp and its NMI threshold (see registerAnts)
+        tissues :
+            Source of the T1 brain and tissue maps: 'fast' (bet and fast), 'freesurfer' (aseg and brainmask
+            of recon-all, see tools/fs_tissues.py) or 'auto' (freesurfer if its outputs exist)
     '''
 
     session_folder = os.path.join(data_path, "derivatives", "01_dwi", subj, sess)
@@ -77,14 +116,14 @@ def anat_reg_dwi(data_path:str, subj:str, sess:str, isForce:bool):
         # Mean b0: in preproc check if exists otherwise do it
         meanB0_filename = os.path.join(preproc_folder, subj + "_" + sess + "_meanB0.nii.gz") 
         json_file = os.path.join(preproc_folder, subj + "_" + sess + "_meanB0.json")
-        if os.path.isfile(meanB0_filename) and not isForce:
+        if is_valid(meanB0_filename) and not isForce:
             logging.info('mean b0 already extracted: "{0}".'.format(meanB0_filename))
         else: 
             dwi = nib.load(dwi_base_filename + ".nii.gz") 
             bval = np.loadtxt(dwi_base_filename + ".bval")
             b0s = dwi.get_fdata()[:,:,:,bval==0]
             meanB0 = np.mean(b0s, axis=3)
-            nib.Nifti1Image(meanB0,dwi.affine,dwi.header).to_filename(meanB0_filename)
+            save_image(nib.Nifti1Image(meanB0,dwi.affine,dwi.header), meanB0_filename)
 
             orig_func_label = "nib.Nifti1Image(meanB0,dwi.affine,dwi.header).to_filename(" + meanB0_filename + ") with dwi --> dwi = nib.load(" + dwi_base_filename + ".nii.gz)"
             with open(json_file, 'w') as outfile:
@@ -101,18 +140,19 @@ def anat_reg_dwi(data_path:str, subj:str, sess:str, isForce:bool):
         # Code taken from script https://gitlab.epfl.ch/ebeanato/mcgrase_times/-/blob/main/functions/reg_mcGRASE_proc.py line 194
         meanB0bet_filename = os.path.join(preproc_folder, subj + "_" + sess + "_dwi_mean-b0_bet.nii.gz")
         json_file = os.path.join(preproc_folder, subj + "_" + sess + "_dwi_mean-b0_bet.json")
-        if os.path.isfile(meanB0bet_filename) and not isForce:
+        if is_valid(meanB0bet_filename) and not isForce:
             logging.info('mean b0 bet already done.: "{0}".'.format(meanB0bet_filename))
         else: 
             bet_cmd = "bet " + meanB0_filename + " " + meanB0bet_filename + " -f 0.4 -g 0 -m"
             logging.info('Bet command: "{0}".'.format(bet_cmd))
             print(bet_cmd)
-            subprocess.call(bet_cmd, shell=True)
+            resources = run_cmd(bet_cmd, outputs=[meanB0bet_filename])
             with open(json_file, 'w') as outfile:
                 j = {
                     'Origin function': bet_cmd,
                     'Description': 'bet on mean b0',
                     'b0bet_filename': meanB0bet_filename,
+                    'Resources': resources,
                     'Time' : time.asctime()
                     }
                 json.dump(j, outfile)
@@ -125,62 +165,125 @@ def anat_reg_dwi(data_path:str, subj:str, sess:str, isForce:bool):
         t1_raw = os.path.join(data_path, subj, sess, "anat", subj + "_" + sess + "_T1w.nii.gz")
         t1_base_filename = os.path.join(anat_folder, subj + "_" + sess + "_acq-mprage_T1w") # in derivatives/anat
         
-        print('#### T1 bet ####')
+        # Brain and tissue maps of the T1: bet and fast, or the FreeSurfer segmentation (tools/fs_tissues.py),
+        # which also gives the sub-cortical GM of the 5TT image
+        fs_aseg = os.path.join(freesurfer_folder, "mri", "aseg.mgz")
+        fs_brainmask = os.path.join(freesurfer_folder, "mri", "brainmask.mgz")
+        if tissues == 'auto':
+            tissues = 'freesurfer' if is_valid(fs_aseg) and is_valid(fs_brainmask) else 'fast'
+        pve_labels = ["CSF", "GM", "WM"] + (["SGM"] if tissues == 'freesurfer' else [])
         t1_brain_filename = t1_base_filename + "brain.nii.gz"
-        json_file = t1_base_filename + "brain.json"
-    
-        if os.path.isfile(t1_brain_filename) and not isForce:
-            logging.info('T1w brain already extracted: "{0}".'.format(t1_brain_filename))
-        else:
-            bet_cmd = "bet " + t1_raw +" " + t1_brain_filename + " -B -f 0.2 -g -0.2 -o -m -s -v"
-            logging.info('t1 Bet command: "{0}".'.format(bet_cmd))
-            subprocess.call(bet_cmd, shell=True)
-            with open(json_file, 'w') as outfile:
-                j = {
-                    'Origin function': bet_cmd,
-                    'Description': 'bet on T1',
-                    'Anat_filename': t1_brain_filename,
-                    'Time' : time.asctime()
-                    }
-                json.dump(j, outfile)            
 
-        # Fast on anat/T1w - segmentation into tissue types
-        print('#### fast on anat/T1w ####') 
-        if os.path.isfile(t1_brain_filename[:-7] +"PveWM.nii.gz")  and not isForce:
-            logging.info('Fast already performed: "{0}".'.format(t1_brain_filename[:-7] +"PveWM.nii.gz"))
+        # Session processed with the other source: the T1 to b0 warp and the images registered with it come
+        # from the previous T1 brain (and the 5TT has or lacks the sub-cortical GM), they are all computed again
+        previous_source = tissue_source(t1_base_filename + "brain.json")
+        if is_valid(t1_brain_filename) and previous_source not in (None, tissues):
+            logging.warning('Tissue source changed from {0} to {1}: T1 brain, warp T1w2meanB0_ants and dwi space images computed again.'
+                            .format(previous_source, tissues))
+            stale_files = glob.glob(os.path.join(session_folder, "warps", "T1w2meanB0_ants*")) + \
+                glob.glob(os.path.join(preproc_folder, subj + "_" + sess + "_acq-mprage_T1w*_dwi.nii.gz"))
+            for stale_file in stale_files:
+                os.remove(stale_file)
+            isForce = True
+
+        if tissues == 'freesurfer':
+            print('#### T1 brain and tissues from freesurfer ####')
+            pve_files = [t1_brain_filename[:-7] + "Pve" + label_pve + ".nii.gz" for label_pve in pve_labels]
+            if all(is_valid(f) for f in [t1_brain_filename] + pve_files) and not isForce:
+                logging.info('T1w brain and tissues already extracted: "{0}".'.format(t1_brain_filename))
+            else:
+                start = time.perf_counter()
+                fractions, brain = tissue_fractions(fs_aseg, fs_brainmask, t1_raw)
+                t1_img = nib.load(t1_raw)
+                t1_brain = np.asanyarray(t1_img.dataobj).reshape(t1_img.shape[:3]) * brain
+                save_image(nib.Nifti1Image(t1_brain, t1_img.affine, t1_img.header), t1_brain_filename)
+                for label_pve, pve_file in zip(pve_labels, pve_files):
+                    pve_img = nib.Nifti1Image(fractions[label_pve], t1_img.affine, t1_img.header)
+                    pve_img.set_data_dtype(np.float32)
+                    save_image(pve_img, pve_file)
+                orig_func_label = "tissue_fractions(" + fs_aseg + "," + fs_brainmask + "," + t1_raw + ")"
+                resources = {'Command': 'tissue_fractions', 'Wall time (s)': round(time.perf_counter() - start, 3)}
+
+                with open(t1_base_filename + "brain.json", 'w') as outfile:
+                    j = {
+                        'Origin function': orig_func_label,
+                        'Description': 'T1 masked by the freesurfer brain mask',
+                        'Anat_filename': t1_brain_filename,
+                        'Tissue source': tissues,
+                        'Resources': resources,
+                        'Time' : time.asctime()
+                        }
+                    json.dump(j, outfile)
+                for label_pve in pve_labels:
+                    with open(t1_base_filename + "Pve" + label_pve + ".json", 'w') as outfile:
+                        j = {
+                            'Origin function': orig_func_label,
+                            'Description': 'freesurfer aseg on T1, partial volume ' + label_pve + ' file',
+                            'Anat_filename': t1_brain_filename,
+                            'Tissue source': tissues,
+                            'Time' : time.asctime()
+                            }
+                        json.dump(j, outfile)
         else:
-            fast_cmd = "fast -n 3 -t 1 -g -v -o " + t1_brain_filename[:-7] + " " + t1_brain_filename
-            logging.info('Fast command: "{0}".'.format(fast_cmd))
-            subprocess.call(fast_cmd, shell=True)
-            
-            print('Cleaning ...')
-            # Place file in a folder trash if not used
-            files_to_move = ["_seg_0.nii.gz", "_seg_1.nii.gz", "_seg_2.nii.gz", "_seg.nii.gz", "_pveseg.nii.gz", "_mixeltype.nii.gz", "_mask.nii.gz", "_overlay.nii.gz", "_skull.nii.gz"]
-            folder_trash = os.path.join(anat_folder, 'trash')
-            if not os.path.isdir(folder_trash):
-                cmd_trash_dir = 'mkdir ' + folder_trash
-                subprocess.call(cmd_trash_dir, shell=True)
-            for file in files_to_move:
-                file_to_move = os.path.join(anat_folder, t1_brain_filename[:-7] + file) 
-                if os.path.exists(file_to_move):
-                    cmd_move = "mv " + t1_brain_filename[:-7] + file + " " + folder_trash
-                    subprocess.call(cmd_move, shell=True)
-            
-            # Rename the ones that will be used
-            os.rename(t1_brain_filename[:-7] + "_pve_0.nii.gz", t1_brain_filename[:-7] +"PveCSF.nii.gz")
-            os.rename(t1_brain_filename[:-7] + "_pve_1.nii.gz", t1_brain_filename[:-7] +"PveGM.nii.gz")
-            os.rename(t1_brain_filename[:-7] + "_pve_2.nii.gz", t1_brain_filename[:-7] +"PveWM.nii.gz")
-
-            for label_pve in ["CSF", "GM", "WM"]:
-                json_file = t1_base_filename + "Pve" + label_pve + ".json"
+            print('#### T1 bet ####')
+            json_file = t1_base_filename + "brain.json"
+    
+            if is_valid(t1_brain_filename) and not isForce:
+                logging.info('T1w brain already extracted: "{0}".'.format(t1_brain_filename))
+            else:
+                bet_cmd = "bet " + t1_raw +" " + t1_brain_filename + " -B -f 0.2 -g -0.2 -o -m -s -v"
+                logging.info('t1 Bet command: "{0}".'.format(bet_cmd))
+                resources = run_cmd(bet_cmd, outputs=[t1_brain_filename])
                 with open(json_file, 'w') as outfile:
                     j = {
-                        'Origin function': fast_cmd,
-                        'Description': 'fast on T1, segmentation ' + label_pve + ' file',
+                        'Origin function': bet_cmd,
+                        'Description': 'bet on T1',
                         'Anat_filename': t1_brain_filename,
+                        'Tissue source': tissues,
+                        'Resources': resources,
                         'Time' : time.asctime()
                         }
-                    json.dump(j, outfile)             
+                    json.dump(j, outfile)            
+
+            # Fast on anat/T1w - segmentation into tissue types
+            print('#### fast on anat/T1w ####') 
+            if is_valid(t1_brain_filename[:-7] +"PveWM.nii.gz")  and not isForce:
+                logging.info('Fast already performed: "{0}".'.format(t1_brain_filename[:-7] +"PveWM.nii.gz"))
+            else:
+                fast_cmd = "fast -n 3 -t 1 -g -v -o " + t1_brain_filename[:-7] + " " + t1_brain_filename
+                logging.info('Fast command: "{0}".'.format(fast_cmd))
+                resources = run_cmd(fast_cmd, outputs=[t1_brain_filename[:-7] + "_pve_" + str(i) + ".nii.gz" for i in range(3)])
+            
+                print('Cleaning ...')
+                # Place file in a folder trash if not used
+                files_to_move = ["_seg_0.nii.gz", "_seg_1.nii.gz", "_seg_2.nii.gz", "_seg.nii.gz", "_pveseg.nii.gz", "_mixeltype.nii.gz", "_mask.nii.gz", "_overlay.nii.gz", "_skull.nii.gz"]
+                folder_trash = os.path.join(anat_folder, 'trash')
+                if not os.path.isdir(folder_trash):
+                    cmd_trash_dir = 'mkdir ' + folder_trash
+                    run_cmd(cmd_trash_dir)
+                for file in files_to_move:
+                    file_to_move = os.path.join(anat_folder, t1_brain_filename[:-7] + file) 
+                    if os.path.exists(file_to_move):
+                        cmd_move = "mv " + t1_brain_filename[:-7] + file + " " + folder_trash
+                        run_cmd(cmd_move)
+            
+                # Rename the ones that will be used
+                os.rename(t1_brain_filename[:-7] + "_pve_0.nii.gz", t1_brain_filename[:-7] +"PveCSF.nii.gz")
+                os.rename(t1_brain_filename[:-7] + "_pve_1.nii.gz", t1_brain_filename[:-7] +"PveGM.nii.gz")
+                os.rename(t1_brain_filename[:-7] + "_pve_2.nii.gz", t1_brain_filename[:-7] +"PveWM.nii.gz")
+
+                for label_pve in ["CSF", "GM", "WM"]:
+                    json_file = t1_base_filename + "Pve" + label_pve + ".json"
+                    with open(json_file, 'w') as outfile:
+                        j = {
+                            'Origin function': fast_cmd,
+                            'Description': 'fast on T1, segmentation ' + label_pve + ' file',
+                            'Anat_filename': t1_brain_filename,
+                            'Tissue source': tissues,
+                            'Resources': resources,
+                            'Time' : time.asctime()
+                            }
+                        json.dump(j, outfile)             
 
         #------------------------------------------------------------#
         #### 3 REGISTRATION #### 
@@ -191,7 +294,7 @@ def anat_reg_dwi(data_path:str, subj:str, sess:str, isForce:bool):
         print('#### T1 raw-> b0 ####')
         output_file = os.path.join(preproc_folder,subj + "_" + sess + "_acq-mprage_T1w_dwi.nii.gz")
         json_file = os.path.join(preproc_folder,subj + "_" + sess + "_acq-mprage_T1w_dwi.json")
-        if os.path.isfile(output_file) and not isForce: 
+        if is_valid(output_file) and not isForce: 
             logging.info('ANTS already performed: "{0}".'.format(output_file))
         else:
             input_file = t1_raw
@@ -199,13 +302,15 @@ def anat_reg_dwi(data_path:str, subj:str, sess:str, isForce:bool):
             warp_name = "T1w2meanB0_ants"
             original_file = t1_brain_filename
             ref_file = meanB0bet_filename
-            registerAnts(input_file, output_file, warp_folder, warp_name, original_file, ref_file)
+            resources = registerAnts(input_file, output_file, warp_folder, warp_name, original_file, ref_file, tiered=tiered, threshold=threshold)
             orig_func_label = "registerAnts(" + input_file + "," +  output_file + "," + warp_folder + "," + warp_name + "," + original_file + "," + ref_file + ")"
             with open(json_file, 'w') as outfile:
                 j = {
                     'Origin function': orig_func_label,
                     'Description': 'register T1 to b0',
                     'Anat_filename': output_file,
+                    'Registration tier': registration_tier(warp_folder, warp_name),
+                    'Resources': resources,
                     'Time' : time.asctime()
                     }
                 json.dump(j, outfile)
@@ -213,17 +318,17 @@ def anat_reg_dwi(data_path:str, subj:str, sess:str, isForce:bool):
 
         # register tissue maps from t1 to b0
         print('#### T1 CSF -> b0 ####')
-        if os.path.isfile(os.path.join(preproc_folder, subj + "_" + sess + "_acq-mprage_T1wPveCSF_dwi.nii.gz")) and not isForce:
+        if all(is_valid(os.path.join(preproc_folder, subj + "_" + sess + "_acq-mprage_T1wPve" + label_pve + "_dwi.nii.gz")) for label_pve in pve_labels) and not isForce:
             logging.info('WARP already aplied: "{0}".'.format(os.path.join(preproc_folder,subj + "_" + sess + "_acq-mprage_T1wPveCSF.nii.gz")))
         else:
             warp_folder = os.path.join(session_folder, "warps")
             warp_name = "T1w2meanB0_ants"
             original_file = t1_brain_filename
             ref_file = meanB0bet_filename
-            for label_pve in ["CSF", "GM", "WM"]:
+            for label_pve in pve_labels:
                 input_file = t1_brain_filename[:-7] + "Pve" + label_pve + ".nii.gz"
                 output_file = os.path.join(preproc_folder, subj + "_" + sess + "_acq-mprage_T1wPve" + label_pve + "_dwi.nii.gz")
-                registerAnts(input_file, output_file, warp_folder, warp_name, original_file, ref_file) 
+                resources = registerAnts(input_file, output_file, warp_folder, warp_name, original_file, ref_file, tiered=tiered, threshold=threshold)
                 orig_func_label = "registerAnts(" + input_file + "," +  output_file + "," + warp_folder + "," + warp_name + "," + original_file + "," + ref_file + ")"
 
                 json_file = os.path.join(preproc_folder, subj + "_" + sess + "_acq-mprage_T1wPve" + label_pve + ".json")
@@ -232,6 +337,8 @@ def anat_reg_dwi(data_path:str, subj:str, sess:str, isForce:bool):
                         'Origin function': orig_func_label,
                         'Description': 'registering tissue types from T1 to b0 ' + label_pve + ' file',
                         'Anat_filename': output_file,
+                        'Registration tier': registration_tier(warp_folder, warp_name),
+                        'Resources': resources,
                         'Time' : time.asctime()
                         }
                     json.dump(j, outfile)  
@@ -241,15 +348,20 @@ def anat_reg_dwi(data_path:str, subj:str, sess:str, isForce:bool):
         print('#### Create 5 tissue type file ####')
         tt5_file = os.path.join(preproc_folder,subj + "_" + sess + "_acq-mprage_T1wPve5tt_dwi.nii.gz")
         json_file = os.path.join(preproc_folder,subj + "_" + sess + "_acq-mprage_T1wPve5tt_dwi.json")
-        if os.path.isfile(tt5_file) and not isForce:
+        if is_valid(tt5_file) and not isForce:
             logging.info('5TT file already generated: "{0}".'.format(tt5_file))
         else:
             csf = nib.load(os.path.join(preproc_folder,subj + "_" + sess + "_acq-mprage_T1wPveCSF_dwi.nii.gz"))
             gm = nib.load(os.path.join(preproc_folder,subj + "_" + sess + "_acq-mprage_T1wPveGM_dwi.nii.gz"))
             wm = nib.load(os.path.join(preproc_folder,subj + "_" + sess + "_acq-mprage_T1wPveWM_dwi.nii.gz"))
             empty = np.zeros(csf.shape)
-            tt5 = np.stack([gm.get_fdata(),empty,wm.get_fdata(),csf.get_fdata(),empty],axis=3)
-            nib.Nifti1Image(tt5, gm.affine, gm.header).to_filename(tt5_file)
+            # Sub-cortical GM: only segmented by freesurfer, within the GM of fast otherwise
+            if "SGM" in pve_labels:
+                sgm = nib.load(os.path.join(preproc_folder,subj + "_" + sess + "_acq-mprage_T1wPveSGM_dwi.nii.gz")).get_fdata()
+            else:
+                sgm = empty
+            tt5 = np.stack([gm.get_fdata(),sgm,wm.get_fdata(),csf.get_fdata(),empty],axis=3)
+            save_image(nib.Nifti1Image(tt5, gm.affine, gm.header), tt5_file)
 
             orig_func_label = "nib.Nifti1Image(tt5, gm.affine, gm.header).to_filename(" + tt5_file + ")"
             with open(json_file, 'w') as outfile:
@@ -257,6 +369,7 @@ def anat_reg_dwi(data_path:str, subj:str, sess:str, isForce:bool):
                     'Origin function': orig_func_label,
                     'Description': 'create 5 tissue types file',
                     'tt5_filename': tt5_file,
+                    'Tissue source': tissues,
                     'Time' : time.asctime()
                     }
                 json.dump(j, outfile)
@@ -274,25 +387,46 @@ def anat_reg_dwi(data_path:str, subj:str, sess:str, isForce:bool):
 
         # aparc+aseg+bss (brain stem segmentation) to T1 space
         #--> to pass from freesurfer space to DWI space, it's best to do it in this order: freesurfer->T1->DWI
+        # The FreeSurfer volumes share the conformed grid: they are resampled together to the T1 grid through
+        # their headers (nearest neighbour, as mri_vol2vol --regheader --interp nearest, see tools/header_resample.py)
         print('#### fs -> T1 -> dwi ####')
         aparcaseg = os.path.join(freesurfer_folder, "mri", "aparc.a2009s+aseg")
         aparcasegbsssub = os.path.join(os.path.join(anat_folder, subj + "_" + sess + "_acq-mprage_T1w") + "AparcA2009sAsegBSS.nii.gz")
         aparcasegsub = os.path.join(os.path.join(anat_folder, subj + "_" + sess + "_acq-mprage_T1w") + "AparcA2009sAseg.nii.gz")
         bsssub = os.path.join(os.path.join(anat_folder, subj + "_" + sess + "_acq-mprage_T1w") + "BrainstemSsLabels.nii.gz") #pb here 
+        wmparc = os.path.join(anat_folder, subj + "_" + sess + "_acq-mprage_T1wWmparc.nii.gz")
+        wmparc_filename_bss = os.path.join(anat_folder, subj + "_" + sess + "_acq-mprage_T1wWmparcBSS.nii.gz")
+        fs_volumes = {
+            aparcasegsub: aparcaseg + ".mgz",
+            bsssub: os.path.join(freesurfer_folder, "mri", "brainstemSsLabels.v10.FSvoxelSpace.mgz"),
+            wmparc: os.path.join(freesurfer_folder, "mri", "wmparc.mgz")}
+
+        todo_aparcaseg = isForce or not (is_valid(aparcasegsub) and is_valid(aparcasegbsssub))
+        todo_wmparc = isForce or not (is_valid(wmparc) and is_valid(wmparc_filename_bss))
+        todo = []
+        if todo_aparcaseg:
+            todo += [aparcasegsub, bsssub]
+        if todo_wmparc:
+            todo += [wmparc, bsssub]
+        todo = list(dict.fromkeys(todo))
+        fs_labels = {}
+        if todo:
+            start = time.perf_counter()
+            t1_img = nib.load(t1_brain_filename)
+            for output_file, data in zip(todo, resample_labels([fs_volumes[f] for f in todo], t1_brain_filename)):
+                label_img = nib.Nifti1Image(data, t1_img.affine, t1_img.header)
+                label_img.set_data_dtype(data.dtype)
+                save_image(label_img, output_file)
+                fs_labels[output_file] = data
+            resample_label = "resample_labels(" + ",".join(fs_volumes[f] for f in todo) + "," + t1_brain_filename + ")"
+            resample_resources = {'Command': 'resample_labels', 'Wall time (s)': round(time.perf_counter() - start, 3)}
+
         json_file = os.path.join(os.path.join(anat_folder, subj + "_" + sess + "_acq-mprage_T1w") + "BrainstemSsLabels.json")
-        if os.path.isfile(aparcasegbsssub) and not isForce:
+        if not todo_aparcaseg:
             logging.info('aparc+aseg already in t1 space: "{0}".'.format(aparcasegbsssub))
         else:
-            vol2vol_cmd = "mri_vol2vol --targ " + t1_brain_filename + " --mov " + aparcaseg + ".mgz --o " + aparcasegsub + " --regheader --interp nearest"
-            logging.info('VOL2VOL command: "{0}".'.format(vol2vol_cmd))
-            subprocess.call(vol2vol_cmd, shell=True)
-
-            vol2vol_cmd = "mri_vol2vol --mov " + os.path.join(freesurfer_folder, "mri", "brainstemSsLabels.v10.FSvoxelSpace.mgz") + " --targ " + os.path.join(freesurfer_folder, "mri", "rawavg.mgz") + " --regheader --o "+ bsssub + " --no-save-reg --interp nearest"
-            subprocess.call(vol2vol_cmd, shell=True) 
-
-            aparcasegsub_img = nib.load(aparcasegsub)
-            bsssub_data = nib.load(bsssub).get_fdata()
-            aparcasegbsss_data = aparcasegsub_img.get_fdata()
+            bsssub_data = fs_labels[bsssub]
+            aparcasegbsss_data = fs_labels[aparcasegsub].copy()
             aparcasegbsss_data[aparcasegbsss_data==16] = 170 # brainstem
             aparcasegbsss_data[bsssub_data==171] = 171 # DCG
             aparcasegbsss_data[bsssub_data==172] = 172 # Vermis
@@ -302,12 +436,15 @@ def anat_reg_dwi(data_path:str, subj:str, sess:str, isForce:bool):
             aparcasegbsss_data[bsssub_data==177] = 177 # Vermis-White-Matter
             aparcasegbsss_data[bsssub_data==178] = 178 # SPC
             aparcasegbsss_data[bsssub_data==179] = 179 # Floculus
-            nib.Nifti1Image(aparcasegbsss_data, aparcasegsub_img.affine, aparcasegsub_img.header).to_filename(aparcasegbsssub)
+            label_img = nib.Nifti1Image(aparcasegbsss_data, t1_img.affine, t1_img.header)
+            label_img.set_data_dtype(aparcasegbsss_data.dtype)
+            save_image(label_img, aparcasegbsssub)
             with open(json_file, 'w') as outfile:
                 j = {
-                    'Origin function': vol2vol_cmd,
+                    'Origin function': resample_label,
                     'Description': 'brain stem segmentation',
                     'Anat_filename': bsssub,
+                    'Resources': resample_resources,
                     'Time' : time.asctime()
                     }
                 json.dump(j, outfile)
@@ -315,7 +452,7 @@ def anat_reg_dwi(data_path:str, subj:str, sess:str, isForce:bool):
         # aparc+aseg to dwi space
         dwi_aparc_filename = os.path.join(preproc_folder, subj + "_" + sess + "_acq-mprage_T1wAparcA2009sAseg_dwi.nii.gz")
         json_file = os.path.join(preproc_folder, subj + "_" + sess + "_acq-mprage_T1wAparcA2009sAseg_dwi.json")
-        if os.path.isfile(dwi_aparc_filename) and not isForce:
+        if is_valid(dwi_aparc_filename) and not isForce:
             logging.info('aparc+aseg already in dwi space: "{0}".'.format(dwi_aparc_filename))
         else:
             warp_folder = os.path.join(session_folder, "warps")
@@ -326,7 +463,7 @@ def anat_reg_dwi(data_path:str, subj:str, sess:str, isForce:bool):
             input_file = aparcasegsub
             output_file = dwi_aparc_filename
             interp_meth = "MultiLabel"
-            registerAnts(input_file, output_file, warp_folder, warp_name, original_file, ref_file, inv, interp_meth)
+            resources = registerAnts(input_file, output_file, warp_folder, warp_name, original_file, ref_file, inv, interp_meth, tiered=tiered, threshold=threshold)
             orig_func_label = "registerAnts(" + input_file + "," +  output_file + "," + \
                 warp_folder + "," + warp_name + "," + original_file + "," + ref_file + "," + interp_meth + ")"            
             with open(json_file, 'w') as outfile:
@@ -334,6 +471,8 @@ def anat_reg_dwi(data_path:str, subj:str, sess:str, isForce:bool):
                     'Origin function': orig_func_label,
                     'Description': 'register aparc+aseg to b0',
                     'Anat_filename': dwi_aparc_filename,
+                    'Registration tier': registration_tier(warp_folder, warp_name),
+                    'Resources': resources,
                     'Time' : time.asctime()
                     }
                 json.dump(j, outfile)            
@@ -342,7 +481,7 @@ def anat_reg_dwi(data_path:str, subj:str, sess:str, isForce:bool):
         # aparc+aseg+bss to dwi space
         dwi_aparcbss_filename = os.path.join(preproc_folder,subj + "_" + sess + "_acq-mprage_T1wAparcA2009sAsegBSS_dwi.nii.gz")
         json_file = os.path.join(preproc_folder,subj + "_" + sess + "_acq-mprage_T1wAparcA2009sAsegBSS_dwi.json")        
-        if os.path.isfile(dwi_aparcbss_filename) and not isForce:
+        if is_valid(dwi_aparcbss_filename) and not isForce:
             logging.info('aparc+aseg+bss already in dwi space: "{0}".'.format(dwi_aparcbss_filename))
         else:
             warp_folder = os.path.join(session_folder, "warps")
@@ -353,7 +492,7 @@ def anat_reg_dwi(data_path:str, subj:str, sess:str, isForce:bool):
             input_file = aparcasegbsssub
             output_file = dwi_aparcbss_filename
             interp_meth = "MultiLabel"
-            registerAnts(input_file, output_file, warp_folder, warp_name, original_file, ref_file, inv, interp_meth)
+            resources = registerAnts(input_file, output_file, warp_folder, warp_name, original_file, ref_file, inv, interp_meth, tiered=tiered, threshold=threshold)
             orig_func_label = "registerAnts(" + input_file + "," +  output_file + "," + \
                 warp_folder + "," + warp_name + "," + original_file + "," + ref_file + "," + interp_meth + ")"            
             with open(json_file, 'w') as outfile:
@@ -361,24 +500,19 @@ def anat_reg_dwi(data_path:str, subj:str, sess:str, isForce:bool):
                     'Origin function': orig_func_label,
                     'Description': 'register aparc+aseg+bss to b0',
                     'Anat_filename': dwi_aparcbss_filename,
+                    'Registration tier': registration_tier(warp_folder, warp_name),
+                    'Resources': resources,
                     'Time' : time.asctime()
                     }
                 json.dump(j, outfile) 
 
         # wmparc to t1 space
-        wmparc = os.path.join(anat_folder, subj + "_" + sess + "_acq-mprage_T1wWmparc.nii.gz")
-        wmparc_filename_bss = os.path.join(anat_folder, subj + "_" + sess + "_acq-mprage_T1wWmparcBSS.nii.gz")
         json_file = os.path.join(anat_folder, subj + "_" + sess + "_acq-mprage_T1wWmparcBSS.json")
-        if os.path.isfile(wmparc) and not isForce:
-            logging.info('wmparc in t1 space: "{0}".'.format(aparcasegbsssub))
+        if not todo_wmparc:
+            logging.info('wmparc in t1 space: "{0}".'.format(wmparc_filename_bss))
         else:
-            vol2vol_cmd = "mri_vol2vol --targ " + t1_brain_filename + " --mov " + os.path.join(freesurfer_folder, "mri", "wmparc") + ".mgz --o " + wmparc + " --regheader --interp nearest"
-            logging.info('VOL2VOL command: "{0}".'.format(vol2vol_cmd))
-            subprocess.call(vol2vol_cmd, shell=True)
-            bsssub_data = nib.load(bsssub).get_fdata()
-
-            wmparc_img = nib.load(wmparc)
-            wmparc_img_data = wmparc_img.get_fdata()
+            bsssub_data = fs_labels[bsssub]
+            wmparc_img_data = fs_labels[wmparc].copy()
             wmparc_img_data[wmparc_img_data==16] = 170 # brainstem
             wmparc_img_data[bsssub_data==171] = 171 # DCG
             wmparc_img_data[bsssub_data==172] = 172 # Vermis
@@ -388,12 +522,15 @@ def anat_reg_dwi(data_path:str, subj:str, sess:str, isForce:bool):
             wmparc_img_data[bsssub_data==177] = 177 # Vermis-White-Matter
             wmparc_img_data[bsssub_data==178] = 178 # SPC
             wmparc_img_data[bsssub_data==179] = 179 # Floculus
-            nib.Nifti1Image(wmparc_img_data, wmparc_img.affine, wmparc_img.header).to_filename(wmparc_filename_bss)
+            label_img = nib.Nifti1Image(wmparc_img_data, t1_img.affine, t1_img.header)
+            label_img.set_data_dtype(wmparc_img_data.dtype)
+            save_image(label_img, wmparc_filename_bss)
             with open(json_file, 'w') as outfile:
                 j = {
-                    'Origin function': vol2vol_cmd,
+                    'Origin function': resample_label,
                     'Description': 'wm parcellation in t1 space',
                     'Anat_filename': wmparc_filename_bss,
+                    'Resources': resample_resources,
                     'Time' : time.asctime()
                     }
                 json.dump(j, outfile)
@@ -402,7 +539,7 @@ def anat_reg_dwi(data_path:str, subj:str, sess:str, isForce:bool):
         dwi_wmparc_filename = os.path.join(preproc_folder,subj + "_" + sess + "_acq-mprage_T1wWmparc_dwi.nii.gz")
         dwi_wmparc_filename_bss = os.path.join(preproc_folder,subj + "_" + sess + "_acq-mprage_T1wWmparcBSS_dwi.nii.gz")
         json_file = os.path.join(preproc_folder,subj + "_" + sess + "_acq-mprage_T1wWmparcBSS_dwi.json")
-        if os.path.isfile(dwi_wmparc_filename) and os.path.isfile(dwi_wmparc_filename_bss) and not isForce:
+        if is_valid(dwi_wmparc_filename) and is_valid(dwi_wmparc_filename_bss) and not isForce:
             logging.info('wmparc already in dwi space: "{0}".'.format(dwi_wmparc_filename))
         else:
             warp_folder = os.path.join(session_folder, "warps")
@@ -414,7 +551,7 @@ def anat_reg_dwi(data_path:str, subj:str, sess:str, isForce:bool):
             input_file = wmparc
             output_file = dwi_wmparc_filename
             interp_meth = "MultiLabel"
-            registerAnts(input_file, output_file, warp_folder, warp_name, original_file, ref_file, inv, interp_meth)
+            resources = registerAnts(input_file, output_file, warp_folder, warp_name, original_file, ref_file, inv, interp_meth, tiered=tiered, threshold=threshold)
             orig_func_label = "registerAnts(" + input_file + "," +  output_file + "," + \
                 warp_folder + "," + warp_name + "," + original_file + "," + ref_file + "," + interp_meth + ")"            
             with open(json_file, 'w') as outfile:
@@ -422,6 +559,8 @@ def anat_reg_dwi(data_path:str, subj:str, sess:str, isForce:bool):
                     'Origin function': orig_func_label,
                     'Description': 'register wmparc to b0',
                     'Anat_filename': dwi_wmparc_filename,
+                    'Registration tier': registration_tier(warp_folder, warp_name),
+                    'Resources': resources,
                     'Time' : time.asctime()
                     }
                 json.dump(j, outfile)  
@@ -429,7 +568,7 @@ def anat_reg_dwi(data_path:str, subj:str, sess:str, isForce:bool):
             input_file = wmparc_filename_bss
             output_file = dwi_wmparc_filename_bss
             interp_meth = "MultiLabel"
-            registerAnts(input_file, output_file, warp_folder, warp_name, original_file, ref_file, inv, interp_meth)
+            resources = registerAnts(input_file, output_file, warp_folder, warp_name, original_file, ref_file, inv, interp_meth, tiered=tiered, threshold=threshold)
             orig_func_label = "registerAnts(" + input_file + "," +  output_file + "," + \
                 warp_folder + "," + warp_name + "," + original_file + "," + ref_file + "," + interp_meth + ")"            
             with open(json_file, 'w') as outfile:
@@ -437,6 +576,8 @@ def anat_reg_dwi(data_path:str, subj:str, sess:str, isForce:bool):
                     'Origin function': orig_func_label,
                     'Description': 'register wmparc+bss to b0',
                     'Anat_filename': dwi_aparcbss_filename,
+                    'Registration tier': registration_tier(warp_folder, warp_name),
+                    'Resources': resources,
                     'Time' : time.asctime()
                     }
                 json.dump(j, outfile)         
@@ -461,26 +602,17 @@ if __name__ == "__main__":
 
     data_path = args.data_path
 
-    if "all" in subj_list:
-        subjects = [s for s in os.listdir(data_path) if os.path.isdir(os.path.join(data_path, s)) if "sub-51T" in s]
-    else:
-        subjects = ['sub-' + subj for subj in subj_list]
-
-    if "all" in sess_list:
-        sessions = ["ses-T1", "ses-T2", "ses-T3", "ses-T4"]
-    else:
-        sessions = ['ses-' + sess for sess in sess_list]
-
-    date = datetime.now()
-    formatted_datetime = date.strftime("%Y-%m-%d-%H-%M-%S")
-    fail_list_filename = f"fail_list_04_anat_registration_dwi_{formatted_datetime}.txt"
-    for subj, sess in itertools.product(subjects, sessions):
+    script = '05_anat_registration_dwi'
+    manifest = Manifest(data_path)
+    pairs = manifest.select(subj_list, sess_list, 'dwi')
+    if not args.isForce:
+        pairs = manifest.incomplete(script, pairs)
+    stager = Stager(data_path, args.scratch, script)
+    for subj, sess in stager.sessions(select_sessions(data_path, script, pairs, args.only_failed, args.only_pending)):
         if (not (subj in ("sub-TIMESwp11s036"))) & \
             (not (subj in ("sub-TIMESwp11s063"))):        
-            try:
-                anat_reg_dwi(data_path, subj, sess, isForce)
-            except Exception as e:
-                with open(fail_list_filename, "+a") as f:
-                    f.write(f"{subj} {sess} \n")
-                    f.write(f"{str(e)} \n")
+            run_step(data_path, script, subj, sess, anat_reg_dwi, stager.path(subj, sess), subj, sess, isForce,
+                     args.isTiered, args.nmi_threshold, args.tissues)
+        stager.write_back(subj, sess)
+    stager.close()
 
@@ -8,13 +8,11 @@ import logging
 import os
 import json
 import time
-import nibabel as nib
-import numpy as np
 import os.path
-import itertools
-from joblib import Parallel, delayed
 from tools.registration_ants import *
-from datetime import datetime
+from tools.run_ledger import run_step, select_sessions
+from tools.manifest import Manifest
+from tools.outputs import is_valid
 
 
 def buildArgsParser():
@@ -31,6 +29,15 @@ def buildArgsParser():
 
     p.add_argument('-f', action='store_true', dest='isForce',
     help='If set, overwrites output file.')
+    p.add_argument('--longitudinal', action='store_true', dest='isLongitudinal',
+    help='If set, registers the lesions to MNI through the within-subject template of the T1w\n'
+         '(05_T1w2MNI_reg.py --longitudinal, see tools/registration_ants.py).')
+
+    sel_g = p.add_argument_group('Selection options')
+    sel_g.add_argument('--only-failed', action='store_true', dest='only_failed',
+        help='If set, only runs the sessions that failed or were skipped (see tools/run_ledger.py).')
+    sel_g.add_argument('--only-pending', action='store_true', dest='only_pending',
+        help='If set, only runs the sessions that were never run or were interrupted.')
 
     log_g = p.add_argument_group('Logging options')
     log_g.add_argument(
@@ -38,7 +45,12 @@ def buildArgsParser():
         help='If set, produces verbose output.')
     return p
 
-def lesion_reg(data_path:str, subj:str, sess:str, isForce:bool):
+def transpl_file(data_path:str, subj:str, sess:str):
+    ''' T1w with the transplanted lesion, registered to MNI instead of the T1w (as in 05_T1w2MNI_reg.py) '''
+    return os.path.join(data_path, "derivatives", "03_dwi", "0_lesion_transplantations_FW", subj, sess, "anat",
+                        "lesion_transplantation", subj + "_" + sess + "_T1w_with_transplanted_lesion.nii.gz")
+
+def lesion_reg(data_path:str, subj:str, sess:str, isForce:bool, template_sessions:list=None):
     ''' Function computing registration from T1w space to dwi space
     
         Parameters
@@ -51,6 +63,9 @@ def lesion_reg(data_path:str, subj:str, sess:str, isForce:bool):
             Current session
         isForce :
             Boolean indicating if files have to be overwritten
+        template_sessions :
+            Sessions of the subject whose within-subject template is registered to MNI (--longitudinal, the
+            template of the T1w of 05_T1w2MNI_reg.py), None to register the session alone
     '''
 
     session_folder = os.path.join(data_path, "derivatives","03_dwi","2_dwi_processing_FW", subj, sess)
@@ -64,7 +79,6 @@ def lesion_reg(data_path:str, subj:str, sess:str, isForce:bool):
         anat_folder = os.path.join(data_path, subj, sess, "anat")
         dwi_folder = os.path.join(session_folder, "dwi")
         warp_folder = os.path.join(session_folder, "warps")
-        lesion_transpl_folder = os.path.join(data_path, "derivatives", "03_dwi", "0_lesion_transplantations_FW", subj, sess, "anat", "lesion_transplantation")
         lesion_folder_dwi = os.path.join(data_path, "derivatives","07_lesions", subj, sess, "dwi")
         lesion_folder_mni = os.path.join(data_path, "derivatives","07_lesions", subj, sess, "mni")
         
@@ -79,7 +93,7 @@ def lesion_reg(data_path:str, subj:str, sess:str, isForce:bool):
         ##################
         t1_brain_filename = os.path.join(session_folder, "anat", subj + "_" + sess + "_acq-mprage_T1wBrain.nii.gz")
         meanB0bet_filename = os.path.join(dwi_folder, subj + "_" + sess + "_meanB0bet.nii.gz")
-        T1w_transpl_file = os.path.join(lesion_transpl_folder, subj + "_" + sess + "_T1w_with_transplanted_lesion.nii.gz")
+        T1w_transpl_file = transpl_file(data_path, subj, sess)
         MNI_file = "/usr/local/fsl/data/standard/MNI152_T1_1mm.nii.gz"
 
         lesion_list = ("acute", "combined", "old")
@@ -117,7 +131,7 @@ def lesion_reg(data_path:str, subj:str, sess:str, isForce:bool):
             # lesion to mni space 
                 # T1w tranplanted used here since lesion is not present in MNI and could lead to errors
             json_file = os.path.join(lesion_folder_mni, subj + "_" + sess + "_T1w_label-" + les + "lesion_roi_mni.json")
-            if (os.path.isdir(os.path.dirname(lesion_in)) and (not os.path.isfile(lesion_out_mni))) or isForce:
+            if (os.path.isdir(os.path.dirname(lesion_in)) and (not is_valid(lesion_out_mni))) or isForce:
                 warp_name = "T1wtranspl2MNI_ants"
                 original_file = T1w_transpl_file
                 ref_file = MNI_file
@@ -125,20 +139,31 @@ def lesion_reg(data_path:str, subj:str, sess:str, isForce:bool):
                 input_file = lesion_in
                 output_file = lesion_out_mni
                 interp_meth = "MultiLabel"
-                registerAnts(input_file, output_file, warp_folder, warp_name, original_file, ref_file, inv, interp_meth)
+                if template_sessions is None:
+                    registration = 'session'
+                    resources = registerAnts(input_file, output_file, warp_folder, warp_name, original_file, ref_file, inv, interp_meth)
+                else:
+                    # Same template and transforms as the T1w of the session in 05_T1w2MNI_reg.py
+                    registration = 'longitudinal'
+                    template_folder = os.path.join(data_path, "derivatives", "04_mni", subj, "template")
+                    session_files = {s: f for s, f in ((s, transpl_file(data_path, subj, s)) for s in template_sessions)
+                                     if is_valid(f)}
+                    session_files[sess] = original_file
+                    resources = registerAntsLongitudinal(input_file, output_file, template_folder, "T1wtranspl", sess,
+                                                         session_files, MNI_file, ref_file, inv, interp_meth)
                 if os.path.isfile(output_file):
                     with open(json_file, 'w') as outfile:
                         j = {
                             'Origin function': "registerAnts with registration_ants.py" + input_file + "&" + output_file + " ",
                             'Description': 'Register lesion to MNI space',
                             'Anat_filename': lesion_in,
+                            'Registration': registration,
+                            'Resources': resources,
                             'Time' : time.asctime()
                             }
                         json.dump(j, outfile)
             else:
-                with open(fail_list_filename, "+a") as failed_reg:
-                    mess = 'lesion already in mni space or not existing: "{0}".\n'.format(lesion_out_mni)
-                    failed_reg.write(mess)
+                logging.info('lesion already in mni space or not existing: "{0}".'.format(lesion_out_mni))
 
     else:
         raise FileNotFoundError("subj " + subj + ", sess " + sess + " not existing")
@@ -159,31 +184,21 @@ if __name__ == "__main__":
 
     data_path = args.data_path
 
-    if "all" in subj_list:
-        subjects = [s for s in os.listdir(data_path) if os.path.isdir(os.path.join(data_path, s)) if "sub-TIMESwp11s" in s]
-    else:
-        subjects = ['sub-' + subj for subj in subj_list]
-
-    if "all" in sess_list:
-        sessions = ["ses-T1", "ses-T2", "ses-T3", "ses-T4"]
-    else:
-        sessions = ['ses-' + sess for sess in sess_list]
-
     #Parallel(n_jobs=4)(delayed(anat_reg_dwi)(data_path, subj, sess, isForce)
     #                   for subj, sess in itertools.product(subjects, sessions))
     
     #for subj, sess in itertools.product(subjects, sessions):
            #lesion_reg(data_path, subj, sess, isForce)
         
-    date = datetime.now()
-    formatted_datetime = date.strftime("%Y-%m-%d-%H-%M-%S")
-    fail_list_filename = f"fail_list_04_lesion_registration_{formatted_datetime}.txt"
-    for subj, sess in itertools.product(subjects, sessions):
-        try:
-            lesion_reg(data_path, subj, sess, isForce)
-        except Exception as e:
-            with open(fail_list_filename, "+a") as failed_reg:
-                failed_reg.write(f"{str(e)} \n")
+    script = '05_lesion_registration'
+    manifest = Manifest(data_path)
+    pairs = manifest.select(subj_list, sess_list, 'anat')
+    if not args.isForce:
+        pairs = manifest.incomplete(script, pairs)
+    for subj, sess in select_sessions(data_path, script, pairs, args.only_failed, args.only_pending):
+        # All the sessions of the subject, whether they are selected or not
+        template_sessions = manifest.sessions(subj) if args.isLongitudinal else None
+        run_step(data_path, script, subj, sess, lesion_reg, data_path, subj, sess, isForce, template_sessions)
 
 
         # if (subj == "sub-TIMESwp11s017" and sess == "ses-T2") or \
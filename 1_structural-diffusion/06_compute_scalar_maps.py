@@ -4,18 +4,17 @@
 import argparse
 import logging
 import os
-import sys
 import json
-import subprocess
 import time
-import nibabel as nib
-import numpy as np
-from datetime import datetime
 
-import itertools
-
-sys.path.append('/home/bgrosjea/mnt/Hummel-Data/TI/mri/51T/barbara/uphummel_imaging_template/1_structural-diffusion')
 from tools.registration_ants import *
+from tools.run_ledger import run_step, select_sessions
+from tools.manifest import Manifest
+from tools.outputs import is_valid
+from tools.staging import Stager
+from tools.command import run_cmd
+from tools.dti_fit import fit_tensor
+from tools.dwi_shells import low_b_subset
 #from tools.lesionTransplantation_native import * # if lesion not tried 
 
 
@@ -30,11 +29,19 @@ def buildArgsParser():
 
     p.add_argument('--data_path', default='/mnt/Hummel-Data/TI/mri/51T', dest='data_path',
         help="Subjects folder path. ['%(default)s']")
+    p.add_argument('--scratch', default=None, dest='scratch',
+        help="Local folder (i.e. NVMe scratch) where the sessions are staged, see tools/staging.py.")
 
     p.add_argument('-f', action='store_true', dest='isForce',
     help='If set, overwrites output file.')
 
 
+    sel_g = p.add_argument_group('Selection options')
+    sel_g.add_argument('--only-failed', action='store_true', dest='only_failed',
+        help='If set, only runs the sessions that failed or were skipped (see tools/run_ledger.py).')
+    sel_g.add_argument('--only-pending', action='store_true', dest='only_pending',
+        help='If set, only runs the sessions that were never run or were interrupted.')
+
     log_g = p.add_argument_group('Logging options')
     log_g.add_argument(
         '-v', action='store_true', dest='isVerbose',
@@ -42,10 +49,21 @@ def buildArgsParser():
     
     p.add_argument('--l', action='store_true', dest='lesion', help='True if lesion, default = False')
 
+    fit_g = p.add_argument_group('Tensor fit options')
+    fit_g.add_argument('--fsl', action='store_true', dest='useFsl',
+        help='If set, fits the tensor with FSL dtifit instead of the in-process fitter.')
+    fit_g.add_argument('--fit_method', default='wls', choices=['ols', 'wls'], dest='fit_method',
+        help="Least-squares method of the in-process fitter. ['%(default)s']")
+    fit_g.add_argument('--n_jobs', type=int, default=-1, dest='n_jobs',
+        help="Number of worker processes of the in-process fitter, -1 for all cores. ['%(default)s']")
+    fit_g.add_argument('--bmax', type=float, default=1500, dest='bmax',
+        help="Highest b-value used for the tensor fit, 0 to use every shell. ['%(default)s']")
+
     return p 
   
 
-def scalar_maps_fnct(data_path:str, subj:str, sess:str, isForce:bool, lesion:bool, isVerbose:bool):
+def scalar_maps_fnct(data_path:str, subj:str, sess:str, isForce:bool, lesion:bool, isVerbose:bool,
+                     useFsl:bool=False, fit_method:str='wls', n_jobs:int=-1, bmax:float=1500):
     """Compute scalar maps including FA and MD maps"""
     
     session_folder = os.path.join(data_path, 'derivatives','01_dwi',subj, sess)
@@ -70,20 +88,41 @@ def scalar_maps_fnct(data_path:str, subj:str, sess:str, isForce:bool, lesion:boo
     FAMaps_file = dwi_out_proc + "_FA.nii.gz"
     bet_file = dwi_out_preproc + "_mean-b0_bet.nii.gz"
     
-    if os.path.isfile(FAMaps_file) and not isForce:
+    if is_valid(FAMaps_file) and not isForce:
         print("dtifit already performed on Subject")
     else:
-        dtifit_cmd = "dtifit --data=" + dwi_file + " --out=" + dwi_out_proc + " --mask=" + bet_file + \
-                     " --bvecs=" + bvec_dwi_file + " --bvals=" + bval_dwi_file
-        print(dtifit_cmd)
-        logging.info('dtifit command: "{0}".'.format(dtifit_cmd))
-        subprocess.call(dtifit_cmd, shell=True)
-        with open(dwi_out_proc + "_FA.json", 'w') as outfile:
-            j = {
-                "dtifit" : dtifit_cmd,
-                'Time' : time.asctime()
-                }
-            json.dump(j, outfile)
+        if bmax > 0:
+            # Cached b0 + low shells subset, built once per session and read by the fit
+            dwi_file, bval_dwi_file, bvec_dwi_file = low_b_subset(dwi_file, bval_dwi_file, bvec_dwi_file,
+                                                                   dwi_out_proc + "_bmax" + str(int(bmax)), bmax,
+                                                                   isForce=isForce)
+        if useFsl:
+            dtifit_cmd = "dtifit --data=" + dwi_file + " --out=" + dwi_out_proc + " --mask=" + bet_file + \
+                         " --bvecs=" + bvec_dwi_file + " --bvals=" + bval_dwi_file
+            print(dtifit_cmd)
+            logging.info('dtifit command: "{0}".'.format(dtifit_cmd))
+            resources = run_cmd(dtifit_cmd, outputs=[dwi_out_proc + "_FA.nii.gz"])
+            with open(dwi_out_proc + "_FA.json", 'w') as outfile:
+                j = {
+                    "dtifit" : dtifit_cmd,
+                    'Resources': resources,
+                    'Time' : time.asctime()
+                    }
+                json.dump(j, outfile)
+        else:
+            orig_func_label = "fit_tensor(" + dwi_file + ", " + bval_dwi_file + ", " + bvec_dwi_file + ", " + \
+                              bet_file + ", " + dwi_out_proc + ", " + fit_method + ", " + str(n_jobs) + ")"
+            print(orig_func_label)
+            logging.info('tensor fit: "{0}".'.format(orig_func_label))
+            fit_tensor(dwi_file, bval_dwi_file, bvec_dwi_file, bet_file, dwi_out_proc, fit_method, n_jobs)
+            with open(dwi_out_proc + "_FA.json", 'w') as outfile:
+                j = {
+                    'Origin function': orig_func_label,
+                    'Description': 'diffusion tensor fit (FA, MD, AD, RD, L1-3, V1-3, S0)',
+                    'FA_filename': FAMaps_file,
+                    'Time' : time.asctime()
+                    }
+                json.dump(j, outfile)
     #------------------------------------------------------------#
     #### 2 REGISTER LESION INTO DWI SPACE #### 
     #------------------------------------------------------------#
@@ -95,7 +134,7 @@ def scalar_maps_fnct(data_path:str, subj:str, sess:str, isForce:bool, lesion:boo
 
         les_dwi_file = os.path.join(lesion_folder, subj + "_" + sess + "_acq-mprage_T1w_label-lesion_roi_dwi.nii.gz")
 
-        warp_folder = os.path.join(output_session_folder, "warps")
+        warp_folder = os.path.join(session_folder, "warps")
         if not os.path.exists(warp_folder):
             os.makedirs(warp_folder)
 
@@ -103,22 +142,24 @@ def scalar_maps_fnct(data_path:str, subj:str, sess:str, isForce:bool, lesion:boo
         output_file = les_dwi_file
         json_file = os.path.join(lesion_folder, subj + "_" + sess + "_acq-mprage_T1w_label-lesion_roi_dwi.json")
         warp_name = 'T1w2mean_b0'
-        original_file_name = os.path.join(anat_folder, subj + "_" + sess + "_acq-mprage_T1w_bet.nii.gz")
+        original_file_name = os.path.join(anat_folder, subj + "_" + sess + "_acq-mprage_T1wbrain.nii.gz")
         ref_file = bet_file
-        warp_name = 'T1w_bet2mean_b0_bet_ants'
+        # Warp of the T1 brain to the mean b0 of 05_anat_registration_dwi
+        warp_name = 'T1w2meanB0_ants'
 
         interp_bool = "NearestNeighbor"
         origin_fnct = 'registerAnts(' + str(input_file) + ', ' + str(output_file) + ', ' + \
                     str(warp_folder) + ', ' + str(warp_name) + ', ' + str(original_file_name) + \
-                    ', ' + str(ref_file) + ', ' + str(interp_bool) + ')'
+                    ', ' + str(ref_file) + ', False, ' + str(interp_bool) + ')'
         print(origin_fnct)
-        registerAnts(input_file, output_file, warp_folder, warp_name, original_file_name, ref_file, interp_bool)
+        resources = registerAnts(input_file, output_file, warp_folder, warp_name, original_file_name, ref_file, False, interp_bool)
 
         with open(json_file, 'w') as outfile:
             j = {
                 'Origin function': origin_fnct,
                 'Description': 'Register lesion from anatomical to dwi space',
                 'DWI_filename': les_dwi_file,
+                'Resources': resources,
                 'Time' : time.asctime()
                 }
             json.dump(j, outfile)
@@ -140,25 +181,16 @@ if __name__ == "__main__":
 
     data_path = args.data_path
 
-    if "all" in subj_list:
-        subjects = [s for s in os.listdir(data_path) if os.path.isdir(os.path.join(data_path, s)) if "sub-51T" in s]
-    else:
-        subjects = ['sub-' + subj for subj in subj_list]
-    
-    
     sess_list = [sess for sess in args.sess]
-    if "all" in sess_list:
-       sessions = ["ses-T1", "ses-T2", "ses-T3", "ses-T4"]
-    else:
-        sessions = ['ses-' + sess for sess in sess_list]
     
-    date = datetime.now()
-    formatted_datetime = date.strftime("%Y-%m-%d-%H-%M-%S")
-    fail_list_filename = f"fail_list_06_compute_scalar_maps{formatted_datetime}.txt"
-    for subj, sess in itertools.product(subjects, sessions):        
-            try:
-                scalar_maps_fnct(data_path, subj, sess, isForce, lesion, args.isVerbose)
-            except Exception as e:
-                with open(fail_list_filename, "+a") as f:
-                    f.write(f"{subj} {sess} \n")
-                    f.write(f"{str(e)} \n")
+    script = '06_compute_scalar_maps'
+    manifest = Manifest(data_path)
+    pairs = manifest.select(subj_list, sess_list, 'dwi')
+    if not args.isForce:
+        pairs = manifest.incomplete(script + ' --l' if lesion else script, pairs)
+    stager = Stager(data_path, args.scratch, script)
+    for subj, sess in stager.sessions(select_sessions(data_path, script, pairs, args.only_failed, args.only_pending)):
+        run_step(data_path, script, subj, sess, scalar_maps_fnct, stager.path(subj, sess), subj, sess, isForce, lesion,
+                 args.isVerbose, args.useFsl, args.fit_method, args.n_jobs, args.bmax)
+        stager.write_back(subj, sess)
+    stager.close()
@@ -7,17 +7,18 @@ import argparse
 import logging
 import os
 import json
-import subprocess
-import nibabel as nib
-import numpy as np
 import os.path
 import shutil
 import time
 from copy import copy
 from genericpath import isfile
-import itertools
 from tools.registration_ants import *
-from datetime import datetime
+from tools.run_ledger import run_step, select_sessions
+from tools.manifest import Manifest
+from tools.outputs import is_valid
+from tools.staging import Stager
+from tools.command import run_cmd
+from tools.crop import bounding_box, crop_image, uncrop_image
 
 
 def buildArgsParser():
@@ -31,10 +32,23 @@ def buildArgsParser():
 
     p.add_argument('--data_path', default='/mnt/Hummel-Data/TI/mri/51T', dest='data_path',
         help="Subjects folder path. ['%(default)s']")
+    p.add_argument('--scratch', default=None, dest='scratch',
+        help="Local folder (i.e. NVMe scratch) where the sessions are staged, see tools/staging.py.")
 
     p.add_argument('-f', action='store_true', dest='isForce',
     help='If set, overwrites output file.')
 
+    p.add_argument('--no_crop', action='store_true', dest='noCrop',
+    help='If set, runs the MRtrix steps on the full field of view instead of the brain bounding box.')
+    p.add_argument('--crop_padding', type=int, default=5, dest='crop_padding',
+        help="Voxels added around the brain bounding box. ['%(default)s']")
+
+    sel_g = p.add_argument_group('Selection options')
+    sel_g.add_argument('--only-failed', action='store_true', dest='only_failed',
+        help='If set, only runs the sessions that failed or were skipped (see tools/run_ledger.py).')
+    sel_g.add_argument('--only-pending', action='store_true', dest='only_pending',
+        help='If set, only runs the sessions that were never run or were interrupted.')
+
     log_g = p.add_argument_group('Logging options')
     log_g.add_argument(
         '-v', action='store_true', dest='isVerbose',
@@ -42,7 +56,7 @@ def buildArgsParser():
     return p 
   
 
-def dwi_processing_func(data_path:str, subj:str, sess:str, isForce:bool):
+def dwi_processing_func(data_path:str, subj:str, sess:str, isForce:bool, crop:bool=True, crop_padding:int=5):
     ''' Function doing the tractography on the dwi data.
     
         Parameters
@@ -55,6 +69,10 @@ def dwi_processing_func(data_path:str, subj:str, sess:str, isForce:bool):
             Current session
         isForce :
             Boolean indicating if files have to be overwritten
+        crop :
+            Boolean indicating if the inputs are cropped to the brain bounding box
+        crop_padding :
+            Voxels added around the brain bounding box
     '''
     
     session_folder = os.path.join(data_path, "derivatives","01_dwi", subj, sess)
@@ -63,16 +81,65 @@ def dwi_processing_func(data_path:str, subj:str, sess:str, isForce:bool):
     # Input data are in preproc and output in proc
     preproc_folder = os.path.join(session_folder, "dwi", "preproc")
     proc_folder = os.path.join(session_folder, "dwi", "proc")
-    
+
+    # Inputs
+    dwi_base_filename = os.path.join(preproc_folder,subj + "_" + sess + "_dwi")
+    dwi_filename = dwi_base_filename + ".nii.gz"
+    tt5_file = os.path.join(preproc_folder,subj + "_" + sess + "_acq-mprage_T1wPve5tt_dwi.nii.gz")
+    t1_mask_filename = os.path.join(preproc_folder,subj + "_" + sess + "_acq-mprage_T1w_dwi.nii.gz")
+    wm_pve_filename = os.path.join(preproc_folder,subj + "_" + sess + "_acq-mprage_T1wPveWM_dwi.nii.gz")
+
+    # Outputs
+    fodWM_filename = os.path.join(proc_folder,subj + "_" + sess + "_fod.nii.gz")
+    fodGM_filename = os.path.join(proc_folder,subj + "_" + sess + "_fodGM.nii.gz")
+    fodCSF_filename = os.path.join(proc_folder,subj + "_" + sess + "_fodCSF.nii.gz")
+    fod_filenames = [fodWM_filename, fodGM_filename, fodCSF_filename]
+
+    #------------------------------------------------------------#
+    #### 0 CROP TO THE BRAIN BOUNDING BOX #### 
+    #------------------------------------------------------------#
+    # The voxel-wise MRtrix steps only run on the padded bounding box of the mean b0 brain mask.
+    # The cropped grid keeps the world coordinates so the tractogram is the same in both grids,
+    # only the fod files are padded back to the original grid at the end.
+
+    if crop:
+        print('#### crop to brain bounding box ####')
+        crop_folder = os.path.join(preproc_folder, "crop")
+        if not os.path.exists(crop_folder):
+            os.makedirs(crop_folder)
+
+        to_crop = [dwi_filename, tt5_file, t1_mask_filename, wm_pve_filename]
+        cropped = [os.path.join(crop_folder, os.path.basename(f)) for f in to_crop]
+        json_file = os.path.join(crop_folder, subj + "_" + sess + "_crop.json")
+
+        if all(is_valid(f) for f in cropped) and not isForce:
+            logging.info('crop already done.')
+        else:
+            mask_filename = dwi_base_filename + "_mean-b0_bet_mask.nii.gz"
+            if not os.path.isfile(mask_filename):
+                mask_filename = dwi_base_filename + "_mean-b0_bet.nii.gz"
+            bbox = bounding_box(mask_filename, crop_padding)
+            for in_file, out_file in zip(to_crop, cropped):
+                crop_image(in_file, out_file, bbox)
+            with open(json_file, 'w') as outfile:
+                j = {
+                    'Origin function': 'crop_image(..., bounding_box(' + mask_filename + ', ' + str(crop_padding) + '))',
+                    'Description': 'crop dwi, 5tt and masks to the brain bounding box',
+                    'Bounding box': bbox,
+                    'Cropped files': cropped,
+                    'Time' : time.asctime()
+                    }
+                json.dump(j, outfile)
+
+        dwi_filename, tt5_file, t1_mask_filename, wm_pve_filename = cropped
+        fod_filenames = [os.path.join(crop_folder, os.path.basename(f)) for f in fod_filenames]
+
     #------------------------------------------------------------#
     #### 1 DWI2RESPONSE MSMT 5TT CMD #### 
     #------------------------------------------------------------#
    
     print('#### dwi2response ####')
 
-    # Input
-    tt5_file = os.path.join(preproc_folder,subj + "_" + sess + "_acq-mprage_T1wPve5tt_dwi.nii.gz")
-    dwi_base_filename = os.path.join(preproc_folder,subj + "_" + sess + "_dwi")
     # Output 
     json_file = dwi_base_filename + "Resp.json"
     respWM_filename = dwi_base_filename + "RespWM.txt"
@@ -80,17 +147,18 @@ def dwi_processing_func(data_path:str, subj:str, sess:str, isForce:bool):
     respCSF_filename = dwi_base_filename + "RespCSF.txt"
 
     # If output already existes
-    if os.path.isfile(respWM_filename) and not isForce:
+    if is_valid(respWM_filename) and not isForce:
         logging.info('dwi2response already done.')
     else:         
-        dwi2response_cmd = "dwi2response msmt_5tt " + dwi_base_filename + ".nii.gz " + tt5_file + " " + respWM_filename + " " + respGM_filename + " " + respCSF_filename + " -fslgrad " + dwi_base_filename + ".bvec " + dwi_base_filename + ".bval -nthreads 8"
+        dwi2response_cmd = "dwi2response msmt_5tt " + dwi_filename + " " + tt5_file + " " + respWM_filename + " " + respGM_filename + " " + respCSF_filename + " -fslgrad " + dwi_base_filename + ".bvec " + dwi_base_filename + ".bval -nthreads 8"
         logging.info('dwi2response command.')
-        subprocess.call(dwi2response_cmd, shell=True)
+        resources = run_cmd(dwi2response_cmd, outputs=[respWM_filename, respGM_filename, respCSF_filename])
         with open(json_file, 'w') as outfile:
             j = {
                 'Origin function': dwi2response_cmd,
                 'Description': 'DWI 2 response',
                 'respWM_filename': respWM_filename,
+                'Resources': resources,
                 'Time' : time.asctime()
                 }
             json.dump(j, outfile)        
@@ -101,25 +169,21 @@ def dwi_processing_func(data_path:str, subj:str, sess:str, isForce:bool):
     #------------------------------------------------------------#
 
     print('#### dwi2fod ####')
-    # Input
-    t1_mask_filename = os.path.join(preproc_folder,subj + "_" + sess + "_acq-mprage_T1w_dwi.nii.gz")
-    # Outputs
-    fodWM_filename = os.path.join(proc_folder,subj + "_" + sess + "_fod.nii.gz")
-    fodGM_filename = os.path.join(proc_folder,subj + "_" + sess + "_fodGM.nii.gz")
-    fodCSF_filename = os.path.join(proc_folder,subj + "_" + sess + "_fodCSF.nii.gz")
+    fodWM_work, fodGM_work, fodCSF_work = fod_filenames
     json_file = os.path.join(proc_folder,subj + "_" + sess + "_fod.json")
 
-    if os.path.isfile(fodWM_filename) and not isForce:
+    if is_valid(fodWM_work) and not isForce:
         logging.info('dwi2fod already done,')
     else:
-        dwi2fod_cmd = "dwi2fod msmt_csd -mask " + t1_mask_filename + " " + dwi_base_filename + ".nii.gz " + respWM_filename + " " + fodWM_filename + " " + respGM_filename + " " + fodGM_filename + " " + respCSF_filename + " " + fodCSF_filename + " " + " -fslgrad " + dwi_base_filename + ".bvec " + dwi_base_filename + ".bval -nthreads 8"
+        dwi2fod_cmd = "dwi2fod msmt_csd -mask " + t1_mask_filename + " " + dwi_filename + " " + respWM_filename + " " + fodWM_work + " " + respGM_filename + " " + fodGM_work + " " + respCSF_filename + " " + fodCSF_work + " " + " -fslgrad " + dwi_base_filename + ".bvec " + dwi_base_filename + ".bval -nthreads 8"
         logging.info('dwi2fod command: "{0}".'.format(dwi2fod_cmd))
-        subprocess.call(dwi2fod_cmd, shell=True)
+        resources = run_cmd(dwi2fod_cmd, outputs=fod_filenames)
         with open(json_file, 'w') as outfile:
             j = {
                 'Origin function': dwi2fod_cmd,
                 'Description': 'DWI 2 FOD',
                 'fod filename': fodWM_filename,
+                'Resources': resources,
                 'Time' : time.asctime()
                 }
             json.dump(j, outfile)
@@ -130,25 +194,24 @@ def dwi_processing_func(data_path:str, subj:str, sess:str, isForce:bool):
    
     print('#### Streamline count  ####')
     streamlines_count=10000000
-    # Input
-    wm_pve_filename = os.path.join(preproc_folder,subj + "_" + sess + "_acq-mprage_T1wPveWM_dwi.nii.gz")
     # Outputs
     streamlines_filename = os.path.join(proc_folder,subj + "_" + sess + "_iFOD2.tck")
     json_file = os.path.join(proc_folder,subj + "_" + sess + "_iFOD2.json")
 
-    if os.path.isfile(streamlines_filename) and not isForce:
+    if is_valid(streamlines_filename) and not isForce:
         logging.info('tckgen iFOD2 already done.')
     else:
-        tckgen_cmd = "tckgen " + fodWM_filename + " " + streamlines_filename + \
+        tckgen_cmd = "tckgen " + fodWM_work + " " + streamlines_filename + \
             " -algorithm iFOD2 -seed_image " + wm_pve_filename + " -select " + \
             str(streamlines_count) + " -force -minlength 1.6 -nthreads 8"
         logging.info('tckgen command: "{0}".'.format(tckgen_cmd))
-        subprocess.call(tckgen_cmd, shell=True)
+        resources = run_cmd(tckgen_cmd, outputs=[streamlines_filename])
         with open(json_file, 'w') as outfile:
             j = {
                 'Origin function': tckgen_cmd,
                 'Description': 'Generate tck file',
                 'tck filename': streamlines_filename,
+                'Resources': resources,
                 'Time' : time.asctime()
                 }
             json.dump(j, outfile)   
@@ -159,25 +222,36 @@ def dwi_processing_func(data_path:str, subj:str, sess:str, isForce:bool):
 
     json_file = os.path.join(proc_folder,subj + "_" + sess + "_sift.json")
     tck_sift_file = os.path.join(proc_folder,subj + "_" + sess + "_sift.txt")
-    wm_mask_file = os.path.join(preproc_folder,subj + "_" + sess + "_acq-mprage_T1wPveWM_dwi.nii.gz")
 
-    if os.path.isfile(tck_sift_file) and not isForce:
+    if is_valid(tck_sift_file) and not isForce:
         logging.info('tcksift2 already done.')
     else: 
-        tcksift2_cmd = "tcksift2 -act " + tt5_file + " " + streamlines_filename + " " + fodWM_filename + " " + tck_sift_file + " -proc_mask " + wm_mask_file + " -force " 
+        tcksift2_cmd = "tcksift2 -act " + tt5_file + " " + streamlines_filename + " " + fodWM_work + " " + tck_sift_file + " -proc_mask " + wm_pve_filename + " -force " 
 
         logging.info('tcksift2 command: "{0}".'.format(tcksift2_cmd))
 
-        subprocess.call(tcksift2_cmd, shell=True)
+        resources = run_cmd(tcksift2_cmd, outputs=[tck_sift_file])
 
         with open(json_file, 'w') as outfile:
             j = {
                 'Origin function': tcksift2_cmd,
                 'Description': 'Generate tcksift2 file',
                 'tck filename': tck_sift_file,
+                'Resources': resources,
                 'Time' : time.asctime()
                 }
             json.dump(j, outfile)    
+
+    #------------------------------------------------------------#
+    #### 5 FOD BACK TO THE ORIGINAL GRID #### 
+    #------------------------------------------------------------#
+
+    if crop:
+        for work_file, out_file in zip(fod_filenames, [fodWM_filename, fodGM_filename, fodCSF_filename]):
+            if is_valid(out_file) and not isForce:
+                logging.info('fod already in the original grid: "{0}".'.format(out_file))
+            elif os.path.isfile(work_file):
+                uncrop_image(work_file, out_file, dwi_base_filename + ".nii.gz")
     return
 
 
@@ -195,24 +269,15 @@ if __name__ == "__main__":
 
     data_path = args.data_path
 
-    if "all" in subj_list:
-        subjects = [s for s in os.listdir(data_path) if os.path.isdir(os.path.join(data_path, s)) if "sub-51T" in s]
-    else:
-        subjects = ['sub-' + subj for subj in subj_list]
-
-    if "all" in sess_list:
-        sessions = ["ses-T1", "ses-T2", "ses-T3", "ses-T4"]
-    else:
-        sessions = ['ses-' + sess for sess in sess_list]
-
-    date = datetime.now()
-    formatted_datetime = date.strftime("%Y-%m-%d-%H-%M-%S")
-    fail_list_filename = f"fail_list_06_dwi_processing_{formatted_datetime}.txt"
-    for subj, sess in itertools.product(subjects, sessions):        
-            try:
-                dwi_processing_func(data_path, subj, sess, isForce)
-            except Exception as e:
-                with open(fail_list_filename, "+a") as f:
-                    f.write(f"{subj} {sess} \n")
-                    f.write(f"{str(e)} \n")    
+    script = '06_dwi_processing'
+    manifest = Manifest(data_path)
+    pairs = manifest.select(subj_list, sess_list, 'dwi')
+    if not args.isForce:
+        pairs = manifest.incomplete(script, pairs)
+    stager = Stager(data_path, args.scratch, script)
+    for subj, sess in stager.sessions(select_sessions(data_path, script, pairs, args.only_failed, args.only_pending)):
+        run_step(data_path, script, subj, sess, dwi_processing_func, stager.path(subj, sess), subj, sess, isForce,
+                 not args.noCrop, args.crop_padding)
+        stager.write_back(subj, sess)
+    stager.close()
     
@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Group maps in MNI space, once the lesions (05_lesion_registration.py) and the T1w (05_T1w2MNI_reg.py) of the
+# sessions are registered:
+# - lesion frequency: for each lesion type, per session and over all the sessions ("ses-all"), the number of
+#   sessions with a lesion in each voxel (overlap, _count) and its fraction of the sessions (_frequency),
+# - mean and standard deviation of the T1w in MNI space, per session and over all the sessions.
+# The registered images are read one at a time into running accumulators (counts, running mean and sum of
+# squared deviations): the memory is that of a few MNI volumes per group, whatever the size of the cohort.
+# The outputs are written in derivatives/07_lesions/group, with a json sidecar listing the images they
+# were computed from (size and mtime): a run with the same images is skipped.
+#
+#     python 07_group_maps.py --subj all --sess all --data_path /media/windel/Elements/TiMeS/WP11_MRI/data/times_wp11
+
+from __future__ import division
+
+import argparse
+import json
+import logging
+import os
+import time
+
+import nibabel as nib
+import numpy as np
+
+from tools.run_ledger import run_step, runs, is_selected
+from tools.manifest import Manifest
+from tools.outputs import is_valid, save_image
+
+# Lesion masks registered by 05_lesion_registration.py
+LESION_TYPES = ("acute", "combined", "old")
+
+GROUP_FOLDER = os.path.join("derivatives", "07_lesions", "group")
+
+# Group of all the sessions
+ALL_SESSIONS = "ses-all"
+
+
+def buildArgsParser():
+    p = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter,
+        epilog="")
+    p._optionals.title = "Generic options"
+
+    p.add_argument('--subj', nargs='+', dest='subj', help="Subject index.")
+    p.add_argument('--sess', nargs='+', dest='sess', help="Session folder name.")
+
+    p.add_argument('--data_path', default='/media/windel/Elements/TiMeS/WP11_MRI/data/times_wp11', dest='data_path',
+        help="Subjects folder path. ['%(default)s']")
+
+    p.add_argument('-f', action='store_true', dest='isForce',
+    help='If set, overwrites output file.')
+
+    sel_g = p.add_argument_group('Selection options')
+    sel_g.add_argument('--only-failed', action='store_true', dest='only_failed',
+        help='If set, only runs the group maps that failed or were skipped (see tools/run_ledger.py).')
+    sel_g.add_argument('--only-pending', action='store_true', dest='only_pending',
+        help='If set, only runs the group maps that were never run or were interrupted.')
+
+    log_g = p.add_argument_group('Logging options')
+    log_g.add_argument(
+        '-v', action='store_true', dest='isVerbose',
+        help='If set, produces verbose output.')
+    return p
+
+
+def lesion_mni_file(data_path:str, subj:str, sess:str, les:str):
+    return os.path.join(data_path, "derivatives", "07_lesions", subj, sess, "mni",
+                        subj + "_" + sess + "_T1w_label-" + les + "lesion_roi_mni.nii.gz")
+
+
+def t1_mni_file(data_path:str, subj:str, sess:str):
+    return os.path.join(data_path, "derivatives", "04_mni", subj, sess, subj + "_" + sess + "_acq-mprage_T1w_mni.nii.gz")
+
+
+def group_file(data_path:str, name:str):
+    return os.path.join(data_path, GROUP_FOLDER, "group_" + name + ".nii.gz")
+
+
+def stamp(files:list):
+    ''' [file, size, mtime] of the input images, to know if the group maps are up to date '''
+    return [[f, os.path.getsize(f), os.path.getmtime(f)] for f in files]
+
+
+def is_done(data_path:str, step:str, inputs:list):
+    ''' Whether the sidecar of step lists the same inputs and all its outputs are valid '''
+    try:
+        with open(os.path.join(data_path, GROUP_FOLDER, step + ".json")) as f:
+            j = json.load(f)
+    except (OSError, ValueError):
+        return False
+    return j.get('Inputs') == stamp(inputs) and all(is_valid(out) for out in j.get('Outputs', []))
+
+
+def write_sidecar(data_path:str, step:str, description:str, inputs:list, outputs:list):
+    with open(os.path.join(data_path, GROUP_FOLDER, step + ".json"), 'w') as outfile:
+        j = {
+            'Origin function': './07_group_maps.py ' + step,
+            'Description': description,
+            'Outputs': outputs,
+            'Inputs': stamp(inputs),
+            'Time': time.asctime()
+            }
+        json.dump(j, outfile)
+
+
+def read_mni(filename:str, ref):
+    ''' Image and data of a registered image, ValueError if it is not on the grid of ref (None for the first one) '''
+    img = nib.load(filename)
+    if ref is not None and (img.shape != ref.shape or not np.allclose(img.affine, ref.affine, atol=1e-4)):
+        raise ValueError('"{0}" is not on the MNI grid of the other images {1}.'.format(filename, ref.shape))
+    return img, np.asanyarray(img.dataobj)
+
+
+def save_map(data, ref, dtype, filename:str):
+    img = nib.Nifti1Image(data.astype(dtype), ref.affine, ref.header)
+    img.set_data_dtype(dtype)
+    save_image(img, filename)
+
+
+def lesion_maps(pairs:list, data_path:str, isForce:bool):
+    ''' Lesion count (overlap) and frequency maps, per lesion type and session and over all the sessions '''
+    inputs = [(sess, les, lesion_mni_file(data_path, subj, sess, les))
+              for subj, sess in pairs for les in LESION_TYPES
+              if os.path.isfile(lesion_mni_file(data_path, subj, sess, les))]
+    if not inputs:
+        logging.info('No lesion registered in MNI space.')
+        return
+    if is_done(data_path, 'group_lesion_maps', [f for _, _, f in inputs]) and not isForce:
+        print('Group lesion maps already done')
+        return
+
+    # (lesion type, session) -> [count of the sessions with a lesion in each voxel, number of sessions]
+    counts = {}
+    ref = None
+    for sess, les, filename in inputs:
+        img, data = read_mni(filename, ref)
+        if ref is None:
+            ref = img
+        mask = data > 0
+        for group in (sess, ALL_SESSIONS):
+            acc = counts.setdefault((les, group), [np.zeros(ref.shape, dtype=np.uint16), 0])
+            acc[0] += mask
+            acc[1] += 1
+        del data, mask
+
+    outputs = []
+    if not os.path.exists(os.path.join(data_path, GROUP_FOLDER)):
+        os.makedirs(os.path.join(data_path, GROUP_FOLDER))
+    for (les, group), (count, n) in counts.items():
+        name = group + "_label-" + les + "lesion"
+        save_map(count, ref, np.int16, group_file(data_path, name + "_count"))
+        save_map(count / n, ref, np.float32, group_file(data_path, name + "_frequency"))
+        outputs += [group_file(data_path, name + "_count"), group_file(data_path, name + "_frequency")]
+        logging.info('{0} {1}: {2} lesion masks, largest overlap {3}.'.format(les, group, n, int(count.max())))
+
+    write_sidecar(data_path, 'group_lesion_maps', 'Lesion count and frequency in MNI space, ' + str(len(inputs)) + ' masks',
+                  [f for _, _, f in inputs], outputs)
+
+
+def t1_maps(pairs:list, data_path:str, isForce:bool):
+    ''' Mean and standard deviation of the T1w in MNI space, per session and over all the sessions '''
+    inputs = [(sess, t1_mni_file(data_path, subj, sess)) for subj, sess in pairs
+              if os.path.isfile(t1_mni_file(data_path, subj, sess))]
+    if not inputs:
+        logging.info('No T1w registered in MNI space.')
+        return
+    if is_done(data_path, 'group_t1_maps', [f for _, f in inputs]) and not isForce:
+        print('Group T1w maps already done')
+        return
+
+    # session -> [number of images, running mean, sum of the squared deviations] (Welford)
+    stats = {}
+    ref = None
+    for sess, filename in inputs:
+        img, data = read_mni(filename, ref)
+        if ref is None:
+            ref = img
+        data = data.astype(np.float64)
+        for group in (sess, ALL_SESSIONS):
+            acc = stats.setdefault(group, [0, np.zeros(ref.shape), np.zeros(ref.shape)])
+            acc[0] += 1
+            delta = data - acc[1]
+            acc[1] += delta / acc[0]
+            acc[2] += delta * (data - acc[1])
+            del delta
+        del data
+
+    outputs = []
+    if not os.path.exists(os.path.join(data_path, GROUP_FOLDER)):
+        os.makedirs(os.path.join(data_path, GROUP_FOLDER))
+    for group, (n, mean, m2) in stats.items():
+        name = group + "_acq-mprage_T1w_mni"
+        save_map(mean, ref, np.float32, group_file(data_path, name + "_mean"))
+        save_map(np.sqrt(m2 / n), ref, np.float32, group_file(data_path, name + "_std"))
+        outputs += [group_file(data_path, name + "_mean"), group_file(data_path, name + "_std")]
+        logging.info('T1w {0}: {1} images.'.format(group, n))
+
+    write_sidecar(data_path, 'group_t1_maps', 'Mean and standard deviation of the T1w in MNI space, ' + str(len(inputs)) + ' images',
+                  [f for _, f in inputs], outputs)
+
+
+if __name__ == "__main__":
+    parser = buildArgsParser()
+    args = parser.parse_args()
+
+    isForce = args.isForce
+    if args.isVerbose:
+        logging.basicConfig(level=logging.DEBUG)
+
+    subj_list = [subj for subj in args.subj]
+    sess_list = [sess for sess in args.sess]
+
+    data_path = args.data_path
+
+    pairs = Manifest(data_path).select(subj_list, sess_list, 'anat')
+
+    # Cohort steps, recorded in the ledger once for the whole cohort
+    script = '07_group_maps'
+    status = {}
+    for row in runs(data_path, script):
+        status.setdefault(row['step'], []).append(row['status'])
+    for function in (lesion_maps, t1_maps):
+        if is_selected(status.get(function.__name__, []), args.only_failed, args.only_pending):
+            run_step(data_path, script, 'cohort', sess_list[0], function, pairs, data_path, isForce)
@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Quality check of the ANTs registrations of the cohort (T1w2meanB0_ants, MNI2Tw1_ants, T1wtranspl2MNI_ants...),
+# before tractography and the roi analysis are run on their outputs. For every warp of the warps folders
+# of every session (WARP_FOLDERS), the moving image registered by antsRegistrationSyN.sh (<warp>Warped.nii.gz)
+# is compared in-process to the fixed image (tools/registration_metrics.py): normalised mutual information,
+# Dice of the foreground masks and statistics of the Jacobian determinant of the warp (mean, std, min,
+# max and fraction of folded voxels). The fixed image is read from the json sidecar of the warp
+# (registerAnts), or from FIXED_FILES for the warps computed before.
+# The sessions are checked in parallel (--n_jobs worker processes), the warps of a subject that are not of
+# a session (SUBJECT_WARP_FOLDERS) in a job of their own, once per subject. The metrics of a warp are kept
+# in <warp>_qc.json next to it and computed again only when the warp or its images change.
+# The warps are ranked by an outlier score: the largest robust z-score (median and MAD over the sessions
+# of the same warp, with a floor on the MAD) of the metrics of OUTLIER_METRICS, counted in the direction
+# of a bad registration.
+# A warp is an outlier when its score is above OUTLIER_Z, its folded fraction above MAX_FOLDING or its
+# metrics could not be computed. The table is written in derivatives/01_analysis/registration_qc.csv,
+# the worst warps first.
+#
+#     python 08_registration_qc.py --subj all --sess all --data_path /mnt/Hummel-Data/TI/mri/51T
+
+from __future__ import division
+
+import argparse
+import json
+import logging
+import os
+import time
+
+import numpy as np
+import pandas as pd
+from joblib import Parallel, delayed
+
+from tools.run_ledger import run_step, runs, is_selected
+from tools.manifest import Manifest
+from tools.outputs import tmp_path, commit
+from tools.registration_metrics import warp_metrics
+from tools.roi_study import REFERENCES
+
+MNI_FILE = "/usr/local/fsl/data/standard/MNI152_T1_1mm.nii.gz"
+
+# Warps folders of a session, relative to data_path
+WARP_FOLDERS = [
+    os.path.join("derivatives", "01_dwi", "{subj}", "{sess}", "warps"),
+    os.path.join("derivatives", "03_dwi", "2_dwi_processing_FW", "{subj}", "{sess}", "warps"),
+]
+
+# Warps folders of a subject, relative to data_path: within-subject template to MNI (--longitudinal of
+# 05_T1w2MNI_reg.py and 05_lesion_registration.py). Their rows have TEMPLATE_SESSION as session
+SUBJECT_WARP_FOLDERS = [
+    os.path.join("derivatives", "04_mni", "{subj}", "template"),
+]
+TEMPLATE_SESSION = 'template'
+
+# Fixed image of the warps whose sidecar does not give it, relative to data_path (or absolute)
+FIXED_FILES = {
+    'T1w2meanB0_ants': 'derivatives/01_dwi/{subj}/{sess}/dwi/preproc/{subj}_{sess}_dwi_mean-b0_bet.nii.gz',
+    REFERENCES['t1'][0]: REFERENCES['t1'][1],
+    REFERENCES['t1_brain'][0]: REFERENCES['t1_brain'][1],
+    'T1wtranspl2MNI_ants': MNI_FILE,
+    'T1wtranspl_template2MNI_': MNI_FILE,
+}
+
+# Metrics of the outlier score: (-1 if a low value is a bad registration, 1 if a high value is, smallest
+# spread of the metric over the sessions, so that a few sessions with close values do not make outliers)
+OUTLIER_METRICS = {'NMI': (-1, 0.01), 'Dice': (-1, 0.01), 'Jacobian std': (1, 0.05), 'Folding fraction': (1, 1e-4)}
+OUTLIER_Z = 3.5
+MAX_FOLDING = 0.001
+
+QC_FILE = os.path.join("derivatives", "01_analysis", "registration_qc.csv")
+
+
+def buildArgsParser():
+    p = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter,
+        epilog="")
+    p._optionals.title = "Generic options"
+
+    p.add_argument('--subj', nargs='+', dest='subj', help="Subject index.")
+    p.add_argument('--sess', nargs='+', dest='sess', help="Session folder name.")
+
+    p.add_argument('--data_path', default='/mnt/Hummel-Data/TI/mri/51T', dest='data_path',
+        help="Subjects folder path. ['%(default)s']")
+    p.add_argument('--n_jobs', type=int, default=4, dest='n_jobs',
+        help="Number of sessions checked in parallel, -1 for all cores (a MNI warp takes ~1 GB). ['%(default)s']")
+
+    p.add_argument('-f', action='store_true', dest='isForce',
+    help='If set, computes the metrics of every warp again.')
+
+    sel_g = p.add_argument_group('Selection options')
+    sel_g.add_argument('--only-failed', action='store_true', dest='only_failed',
+        help='If set, only runs the quality check if it failed or was skipped (see tools/run_ledger.py).')
+    sel_g.add_argument('--only-pending', action='store_true', dest='only_pending',
+        help='If set, only runs the quality check if it was never run or was interrupted.')
+
+    log_g = p.add_argument_group('Logging options')
+    log_g.add_argument(
+        '-v', action='store_true', dest='isVerbose',
+        help='If set, produces verbose output.')
+    return p
+
+
+def warps(data_path:str, subj:str, sess:str, folders:list=WARP_FOLDERS):
+    ''' (warp folder, warp name) of the warps of a session, or of a subject with SUBJECT_WARP_FOLDERS '''
+    for folder in folders:
+        warp_folder = os.path.join(data_path, folder.format(subj=subj, sess=sess))
+        if not os.path.isdir(warp_folder):
+            continue
+        for name in sorted(os.listdir(warp_folder)):
+            # The rigid registrations of the sessions to their template are not warps
+            if name.endswith('1Warp.nii.gz') and not name.endswith('1InverseWarp.nii.gz') \
+                    and not name.endswith('_2template_1Warp.nii.gz'):
+                yield warp_folder, name[:-len('1Warp.nii.gz')]
+
+
+def fixed_file(data_path:str, subj:str, sess:str, warp_folder:str, warp_name:str):
+    ''' Fixed image of a warp, None if it is not known '''
+    try:
+        with open(os.path.join(warp_folder, warp_name + '.json')) as f:
+            fixed = json.load(f).get('Fixed_filename')
+        if fixed:
+            return fixed
+    except (OSError, ValueError):
+        pass
+    if warp_name not in FIXED_FILES:
+        return None
+    return os.path.join(data_path, FIXED_FILES[warp_name].format(subj=subj, sess=sess))
+
+
+def stamp(files:list):
+    ''' [file, size, mtime] of the images of a warp, to know if its metrics are up to date '''
+    return [[f, os.path.getsize(f), os.path.getmtime(f)] for f in files]
+
+
+def warp_qc(data_path:str, subj:str, sess:str, warp_folder:str, warp_name:str, isForce:bool):
+    ''' Metrics of a warp, from its <warp>_qc.json if its images did not change '''
+    warp_file = os.path.join(warp_folder, warp_name)
+    fixed = fixed_file(data_path, subj, sess, warp_folder, warp_name)
+    if fixed is None:
+        raise ValueError('fixed image of "{0}" unknown (no sidecar, not in FIXED_FILES)'.format(warp_name))
+    inputs = [fixed, warp_file + "Warped.nii.gz", warp_file + "1Warp.nii.gz"]
+    missing = [f for f in inputs if not os.path.isfile(f)]
+    if missing:
+        raise FileNotFoundError('missing ' + ', '.join(missing))
+
+    json_file = warp_file + "_qc.json"
+    if not isForce:
+        try:
+            with open(json_file) as f:
+                j = json.load(f)
+            if j.get('Inputs') == stamp(inputs):
+                return fixed, j['Metrics']
+        except (OSError, ValueError, KeyError):
+            pass
+
+    metrics = warp_metrics(fixed, warp_file + "Warped.nii.gz", warp_file + "1Warp.nii.gz")
+    tmp_file = tmp_path(json_file)
+    try:
+        with open(tmp_file, 'w') as outfile:
+            j = {
+                'Origin function': 'warp_metrics with registration_metrics.py',
+                'Description': 'Quality metrics of the registration ' + warp_name,
+                'Metrics': metrics,
+                'Inputs': stamp(inputs),
+                'Time': time.asctime()
+                }
+            json.dump(j, outfile)
+        commit(tmp_file, json_file)
+    finally:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+    return fixed, metrics
+
+
+def session_qc(data_path:str, subj:str, sess:str, isForce:bool, folders:list=WARP_FOLDERS):
+    ''' One row per warp of the session (of the subject with SUBJECT_WARP_FOLDERS), with its metrics or
+        the error that prevented them '''
+    rows = []
+    for warp_folder, warp_name in warps(data_path, subj, sess, folders):
+        row = {'subject': subj, 'session': sess, 'warp': warp_name, 'folder': warp_folder}
+        try:
+            row['fixed'], metrics = warp_qc(data_path, subj, sess, warp_folder, warp_name, isForce)
+            row.update(metrics)
+        except (OSError, ValueError) as e:
+            logging.warning('{0} {1} {2}: {3}'.format(subj, sess, warp_name, e))
+            row['error'] = str(e)
+        rows.append(row)
+    return rows
+
+
+def robust_z(values, min_spread:float):
+    ''' (x - median) / spread, the spread being 1.4826 MAD (the std of normal values) or min_spread '''
+    median = values.median()
+    spread = max(1.4826 * (values - median).abs().median(), min_spread)
+    return (values - median) / spread
+
+
+def rank_outliers(df:pd.DataFrame):
+    ''' Outlier score of each warp against the same warp of the other sessions, the worst warps first '''
+    scores = pd.DataFrame(index=df.index)
+    for metric, (direction, min_spread) in OUTLIER_METRICS.items():
+        scores[metric] = direction * df.groupby('warp')[metric].transform(robust_z, min_spread)
+    df['score'] = scores.max(axis=1, skipna=True)
+    df['outlier'] = (df['score'] > OUTLIER_Z) | (df['Folding fraction'] > MAX_FOLDING) | df['error'].notna()
+    df.loc[df['error'].notna(), 'score'] = np.inf
+    return df.sort_values(['outlier', 'score'], ascending=False)
+
+
+def registration_qc(pairs:list, data_path:str, n_jobs:int, isForce:bool):
+    ''' Metrics of the warps of the sessions and their ranking, written in QC_FILE '''
+    # The subject warps in one job per subject, not in the jobs of its sessions that would write the same
+    # <warp>_qc.json at once
+    subjects = list(dict.fromkeys(subj for subj, _ in pairs))
+    jobs = [delayed(session_qc)(data_path, subj, sess, isForce) for subj, sess in pairs] + \
+           [delayed(session_qc)(data_path, subj, TEMPLATE_SESSION, isForce, SUBJECT_WARP_FOLDERS) for subj in subjects]
+    sessions = Parallel(n_jobs=n_jobs)(jobs)
+    columns = ['subject', 'session', 'warp', 'NMI', 'Dice', 'Jacobian mean', 'Jacobian std', 'Jacobian min',
+               'Jacobian max', 'Folding fraction', 'fixed', 'folder', 'error']
+    df = pd.DataFrame([row for rows in sessions for row in rows], columns=columns)
+    if df.empty:
+        logging.info('No warp found.')
+        return
+    df = rank_outliers(df)
+
+    output = os.path.join(data_path, QC_FILE)
+    if not os.path.exists(os.path.dirname(output)):
+        os.makedirs(os.path.dirname(output))
+    tmp_file = tmp_path(output)
+    try:
+        df.to_csv(tmp_file, index=False)
+        commit(tmp_file, output)
+    finally:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+
+    outliers = df[df['outlier']]
+    print('{0} warps of {1} sessions checked, {2} outliers: "{3}".'.format(
+        len(df), len(pairs), len(outliers), output))
+    with pd.option_context('display.max_columns', None, 'display.width', 200, 'display.precision', 3):
+        if len(outliers):
+            print(outliers[['subject', 'session', 'warp', 'NMI', 'Dice', 'Jacobian std', 'Folding fraction', 'score']])
+
+
+if __name__ == "__main__":
+    parser = buildArgsParser()
+    args = parser.parse_args()
+
+    isForce = args.isForce
+    if args.isVerbose:
+        logging.basicConfig(level=logging.DEBUG)
+
+    subj_list = [subj for subj in args.subj]
+    sess_list = [sess for sess in args.sess]
+
+    data_path = args.data_path
+
+    pairs = Manifest(data_path).select(subj_list, sess_list)
+
+    # Cohort step, recorded in the ledger once for the whole cohort
+    script = '08_registration_qc'
+    status = [row['status'] for row in runs(data_path, script) if row['step'] == registration_qc.__name__]
+    if is_selected(status, args.only_failed, args.only_pending):
+        run_step(data_path, script, 'cohort', sess_list[0], registration_qc, pairs, data_path, args.n_jobs, isForce)
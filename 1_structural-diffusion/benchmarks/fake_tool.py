@@ -0,0 +1,361 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Stand-in for the FSL/ANTs/MRtrix/FreeSurfer executables used by the pipeline.
+# run_benchmarks.py writes one wrapper per tool name on a temporary PATH:
+#     exec python fake_tool.py <tool> "$@"
+# Each tool parses only the arguments the pipeline passes, writes outputs with the right names and
+# shapes (copies or resamplings of its inputs, no real processing), sleeps FAKE_TOOL_DELAY seconds
+# (or FAKE_TOOL_DELAY_<TOOL>, i.e. FAKE_TOOL_DELAY_EDDY_OPENMP) and appends its timing to FAKE_TOOL_LOG.
+
+import time
+START = time.time()
+
+import json
+import os
+import shutil
+import sys
+
+import numpy as np
+import nibabel as nib
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from phantom import make_tractogram
+
+N_STREAMLINES = int(os.environ.get('FAKE_TOOL_STREAMLINES', 2000))
+
+
+#------------------------------------------------------------#
+# Helpers
+#------------------------------------------------------------#
+
+def nii(path:str):
+    ''' FSL style image name: add .nii.gz if the file was given without extension '''
+    if os.path.isfile(path) or path.endswith('.nii.gz') or path.endswith('.nii') or path.endswith('.mgz'):
+        return path
+    return path + '.nii.gz'
+
+
+def load(path:str):
+    img = nib.load(nii(path))
+    return np.asanyarray(img.dataobj), img
+
+
+def save(data:np.ndarray, affine:np.ndarray, path:str):
+    path = nii(path)
+    if path.endswith('.mgz'):
+        nib.MGHImage(data.astype(np.float32), affine).to_filename(path)
+    else:
+        nib.Nifti1Image(data, affine).to_filename(path)
+
+
+def option(args:list, name:str, default=None):
+    ''' Value of "--name=value" or "name value" '''
+    for i, a in enumerate(args):
+        if a.startswith(name + '='):
+            return a.split('=', 1)[1]
+        if a == name and i + 1 < len(args):
+            return args[i + 1]
+    return default
+
+
+def positional(args:list, with_value:tuple=()):
+    ''' Arguments that are not options (options in with_value take one value) '''
+    out = []
+    skip = False
+    for a in args:
+        if skip:
+            skip = False
+        elif a in with_value:
+            skip = True
+        elif not a.startswith('-'):
+            out.append(a)
+    return out
+
+
+def resample(data:np.ndarray, shape:tuple):
+    ''' Nearest neighbour resampling of the first 3 axes by index scaling '''
+    idx = [np.minimum((np.arange(n) * data.shape[k] / n).astype(int), data.shape[k] - 1)
+           for k, n in enumerate(shape)]
+    return data[np.ix_(*idx)]
+
+
+def count_streamlines(tck_file:str):
+    return len(nib.streamlines.load(tck_file, lazy_load=False).streamlines)
+
+
+def write_weights(path:str, n:int, seed:int=0):
+    weights = np.random.default_rng(seed).uniform(0.5, 1.5, size=n)
+    with open(path, 'w') as f:
+        f.write(' '.join('{0:.6f}'.format(w) for w in weights) + ' \n')
+
+
+#------------------------------------------------------------#
+# Tools
+#------------------------------------------------------------#
+
+def copy_first_to_last(args):
+    ''' "tool in out": mrdegibbs, mrconvert, mri_binarize '''
+    files = positional(args, ('-strides', '--i', '--o', '--min'))
+    src = option(args, '--i', files[0] if files else None)
+    dst = option(args, '--o', files[-1] if files else None)
+    if src != dst:
+        data, img = load(src)
+        save(data, img.affine, dst)
+
+
+def bet(args):
+    src, dst = positional(args, ('-f', '-g'))[:2]
+    data, img = load(src)
+    save(data, img.affine, dst)
+    if '-m' in args:
+        mask = (data > 0).astype(np.uint8)
+        save(mask, img.affine, nii(dst)[:-7] + '_mask.nii.gz')
+
+
+def fslmaths(args):
+    src, dst = args[0], args[-1]
+    data, img = load(src)
+    data = data.astype(np.float32)
+    i = 1
+    while i < len(args) - 1:
+        if args[i] == '-thr':
+            data[data < float(args[i + 1])] = 0
+            i += 2
+        elif args[i] == '-uthr':
+            data[data > float(args[i + 1])] = 0
+            i += 2
+        elif args[i] == '-bin':
+            data = (data > 0).astype(np.float32)
+            i += 1
+        elif args[i] == '-div':
+            i += 2
+        else:
+            i += 1
+    save(data, img.affine, dst)
+
+
+def topup(args):
+    data, img = load(option(args, '--imain'))
+    out = option(args, '--out')
+    save(data[..., 0], img.affine, out + '_fieldcoef.nii.gz')
+    np.savetxt(out + '_movpar.txt', np.zeros((data.shape[3], 6)))
+
+
+def eddy(args):
+    data, img = load(option(args, '--imain'))
+    out = option(args, '--out')
+    save(data, img.affine, out + '.nii.gz')
+    shutil.copy(option(args, '--bvecs'), out + '.eddy_rotated_bvecs')
+    for ext in ['.eddy_parameters', '.eddy_movement_rms', '.eddy_outlier_report']:
+        open(out + ext, 'w').close()
+
+
+def fast(args):
+    out = option(args, '-o')
+    data, img = load(args[-1])
+    if '-b' in args:
+        save(np.ones(data.shape, dtype=np.float32), img.affine, out + '_bias.nii.gz')
+    else:
+        brain = data > 0
+        for k in range(3):
+            save((brain * (k + 1) / 6.).astype(np.float32), img.affine, out + '_pve_' + str(k) + '.nii.gz')
+        for ext in ['_seg.nii.gz', '_pveseg.nii.gz', '_mixeltype.nii.gz']:
+            save(brain.astype(np.uint8), img.affine, out + ext)
+
+
+def ants_registration(args):
+    fixed, moving, out = option(args, '-f'), option(args, '-m'), option(args, '-o')
+    fixed_data, fixed_img = load(fixed)
+    moving_data, moving_img = load(moving)
+    with open(out + '0GenericAffine.mat', 'w') as f:  # identity, ITK text format
+        f.write('#Insight Transform File V1.0\nTransform: AffineTransform_double_3_3\n'
+                'Parameters: 1 0 0 0 1 0 0 0 1 0 0 0\nFixedParameters: 0 0 0\n')
+    warp = np.zeros(fixed_data.shape[:3] + (1, 3), dtype=np.float32)
+    save(warp, fixed_img.affine, out + '1Warp.nii.gz')
+    save(np.zeros(moving_data.shape[:3] + (1, 3), dtype=np.float32), moving_img.affine, out + '1InverseWarp.nii.gz')
+    save(resample(moving_data, fixed_data.shape[:3]), fixed_img.affine, out + 'Warped.nii.gz')
+    save(resample(fixed_data, moving_data.shape[:3]), moving_img.affine, out + 'InverseWarped.nii.gz')
+
+
+def ants_apply_transforms(args):
+    data, img = load(option(args, '-i'))
+    ref = option(args, '-r')
+    if os.path.isfile(ref):
+        ref_data, ref_img = load(ref)
+        shape, affine = ref_data.shape[:3], ref_img.affine
+    else:
+        shape, affine = data.shape[:3], img.affine
+    save(resample(data, shape), affine, option(args, '-o'))
+
+
+def average_images(args):
+    # AverageImages <dimension> <output> <normalize> <images...>
+    images = [load(f)[0] for f in args[3:]]
+    save(np.mean(images, axis=0), load(args[3])[1].affine, args[1])
+
+
+def mri_vol2vol(args):
+    data, img = load(option(args, '--mov'))
+    ref_data, ref_img = load(option(args, '--targ'))
+    save(resample(data, ref_data.shape[:3]), ref_img.affine, option(args, '--o'))
+
+
+def recon_all(args):
+    subjid = option(args, '-subjid', option(args, '-s'))
+    mri_folder = os.path.join(os.environ.get('SUBJECTS_DIR', '.'), subjid, 'mri')
+    if not os.path.exists(mri_folder):
+        os.makedirs(mri_folder)
+    orig = os.path.join(mri_folder, 'orig', '001.mgz')
+    data, img = load(orig)
+    labels = (data > 0) * 2
+    for name in ['aparc.a2009s+aseg', 'wmparc', 'aseg', 'aparc+aseg']:
+        save(labels, img.affine, os.path.join(mri_folder, name + '.mgz'))
+    save((data > 0) * 174, img.affine, os.path.join(mri_folder, 'brainstemSsLabels.v10.FSvoxelSpace.mgz'))
+    for name in ['rawavg', 'brainmask', 'T1', 'brain']:
+        save(data, img.affine, os.path.join(mri_folder, name + '.mgz'))
+
+
+def dwi2response(args):
+    for resp in positional(args, ('-fslgrad', '-nthreads'))[2:5]:
+        np.savetxt(resp, np.ones((3, 4)))
+
+
+def dwi2fod(args):
+    files = positional(args, ('-fslgrad', '-nthreads', '-mask'))
+    data, img = load(files[0])
+    brain = data[..., 0] > 0
+    for k, fod in enumerate(files[2:7:2]):
+        n_vol = 45 if k == 0 else 1
+        save((brain[..., None] * np.ones(n_vol)).astype(np.float32), img.affine, fod)
+
+
+def tckgen(args):
+    fod, out = positional(args, ('-algorithm', '-seed_image', '-select', '-minlength', '-nthreads'))[:2]
+    n = min(int(option(args, '-select', N_STREAMLINES)), N_STREAMLINES)
+    make_tractogram(fod, out, n)
+
+
+def tcksift2(args):
+    tck, fod, out = positional(args, ('-act', '-proc_mask', '-nthreads'))[:3]
+    write_weights(out, count_streamlines(tck))
+
+
+def tckedit(args):
+    tck_in, tck_out = positional(args, ('-include', '-tck_weights_in', '-tck_weights_out', '-mask'))[:2]
+    streamlines = nib.streamlines.load(tck_in).streamlines
+    keep = list(range(0, len(streamlines), 7))
+    tractogram = nib.streamlines.Tractogram([streamlines[i] for i in keep], affine_to_rasmm=np.eye(4))
+    nib.streamlines.save(tractogram, tck_out)
+    if option(args, '-tck_weights_out'):
+        write_weights(option(args, '-tck_weights_out'), len(keep))
+
+
+def tck2connectome(args):
+    ''' "tck2connectome tck parc out -assignment_end_voxels": node of the voxel of each end point, the
+        connectome counts the streamlines of each pair of nodes '''
+    tck, parc, out = positional(args, ('-tck_weights_in', '-out_assignments'))[:3]
+    data, img = load(parc)
+    data = data.astype(int)
+    n = max(int(np.max(data)), 1)
+    streamlines = nib.streamlines.load(tck).streamlines
+    ends = np.array([[s[0], s[-1]] for s in streamlines]).reshape(-1, 3)
+    voxels = np.rint(nib.affines.apply_affine(np.linalg.inv(img.affine), ends)).astype(int)
+    inside = np.all((voxels >= 0) & (voxels < data.shape[:3]), axis=1)
+    nodes = np.zeros(len(ends), dtype=int)
+    nodes[inside] = data[tuple(voxels[inside].T)]
+    # Node pair of every streamline, 0 for the end points outside of the parcellation
+    pairs = np.sort(nodes.reshape(-1, 2), axis=1)
+    matrix = np.zeros((n + 1, n + 1))
+    np.add.at(matrix, (pairs[:, 0], pairs[:, 1]), 1)
+    np.savetxt(out, matrix[1:, 1:], fmt='%.6f', delimiter=' ')
+    if option(args, '-out_assignments'):
+        np.savetxt(option(args, '-out_assignments'), pairs, fmt='%d', delimiter=' ')
+
+
+def connectome2tck(args):
+    ''' "connectome2tck tck assignments prefix -nodes i,j,... -exclusive": one file per edge of the nodes '''
+    tck, assignments, prefix = positional(args, ('-nodes', '-files', '-tck_weights_in', '-prefix_tck_weights_out'))[:3]
+    streamlines = nib.streamlines.load(tck).streamlines
+    pairs = np.loadtxt(assignments, dtype=int, ndmin=2)
+    nodes = [int(node) for node in option(args, '-nodes').split(',')]
+    for i, a in enumerate(nodes):
+        for b in nodes[i + 1:]:
+            keep = np.flatnonzero((pairs[:, 0] == a) & (pairs[:, 1] == b))
+            tractogram = nib.streamlines.Tractogram([streamlines[k] for k in keep], affine_to_rasmm=np.eye(4))
+            nib.streamlines.save(tractogram, prefix + '{0}-{1}.tck'.format(a, b))
+            if option(args, '-prefix_tck_weights_out'):
+                write_weights(option(args, '-prefix_tck_weights_out') + '{0}-{1}.csv'.format(a, b), len(keep))
+
+
+def tcksample(args):
+    tck, img, out = positional(args, ('-stat_tck',))[:3]
+    n = count_streamlines(tck)
+    # Empty file for a tract without streamline
+    with open(out, 'w') as f:
+        f.write(' '.join(['0.5'] * n) + '\n' if n else '')
+
+
+def dtifit(args):
+    data, img = load(option(args, '--data'))
+    out = option(args, '--out')
+    brain = (data[..., 0] > 0).astype(np.float32)
+    for name in ['FA', 'MD', 'L1', 'L2', 'L3', 'S0']:
+        save(brain * 0.5, img.affine, out + '_' + name + '.nii.gz')
+    for name in ['V1', 'V2', 'V3']:
+        save(brain[..., None] * np.ones(3, dtype=np.float32), img.affine, out + '_' + name + '.nii.gz')
+
+
+TOOLS = {
+    'mrdegibbs': copy_first_to_last,
+    'mrconvert': copy_first_to_last,
+    'mri_binarize': copy_first_to_last,
+    'bet': bet,
+    'fslmaths': fslmaths,
+    'topup': topup,
+    'eddy_openmp': eddy,
+    'eddy_cuda': eddy,
+    'fast': fast,
+    'antsRegistrationSyN.sh': ants_registration,
+    'antsRegistrationSyNQuick.sh': ants_registration,
+    'antsApplyTransforms': ants_apply_transforms,
+    'AverageImages': average_images,
+    'mri_vol2vol': mri_vol2vol,
+    'recon-all': recon_all,
+    'dwi2response': dwi2response,
+    'dwi2fod': dwi2fod,
+    'tckgen': tckgen,
+    'tcksift2': tcksift2,
+    'tckedit': tckedit,
+    'tck2connectome': tck2connectome,
+    'connectome2tck': connectome2tck,
+    'tcksample': tcksample,
+    'dtifit': dtifit,
+}
+
+
+if __name__ == "__main__":
+    tool = sys.argv[1]
+    args = sys.argv[2:]
+
+    # dwi2response/dwi2fod take the algorithm as first argument
+    if tool in ('dwi2response', 'dwi2fod'):
+        args = args[1:]
+
+    status = 0
+    try:
+        TOOLS[tool](args)
+    except Exception as e:
+        sys.stderr.write(tool + ': ' + str(e) + '\n')
+        status = 1
+
+    delay = float(os.environ.get('FAKE_TOOL_DELAY_' + tool.upper().replace('-', '_').replace('.', '_'),
+                                 os.environ.get('FAKE_TOOL_DELAY', 0)))
+    time.sleep(delay)
+
+    log_file = os.environ.get('FAKE_TOOL_LOG')
+    if log_file:
+        with open(log_file, 'a') as f:
+            f.write(json.dumps({'tool': tool, 'start': START, 'end': time.time(), 'delay': delay,
+                                'status': status}) + '\n')
+    sys.exit(status)
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Synthetic BIDS sessions for the benchmarks: a small ellipsoid "brain" with T1, AP/PA dwi with
+# bvals/bvecs, lesion masks and the MNI rois of fMRI_study (roi_analysis/studies) registered by
+# 11_register_rois_MNI2B0.py. Everything is a few MB so that a whole cohort is built in seconds.
+
+from __future__ import division
+
+import os
+import numpy as np
+import nibabel as nib
+
+ROI_INDEX = [2, 4, 5, 6, 7]
+STRIAT = ['v_d_Ca_L', 'v_d_Ca_R', 'vm_dl_PU_L', 'vm_dl_PU_R']
+
+
+def phantom_affine(voxel_size:float, shape:tuple):
+    ''' RAS affine with the center of the grid at the origin '''
+    affine = np.diag([voxel_size, voxel_size, voxel_size, 1.0])
+    affine[:3, 3] = -voxel_size * (np.array(shape) - 1) / 2
+    return affine
+
+
+def brain_mask(shape:tuple):
+    ''' Ellipsoid filling ~60% of each axis '''
+    grid = np.meshgrid(*[np.linspace(-1, 1, n) for n in shape], indexing='ij')
+    return sum((g / 0.6) ** 2 for g in grid) <= 1
+
+
+def gradient_table(n_b0:int, shells:list, n_dir:int, rng):
+    ''' b0s followed by n_dir random directions per shell, FSL format '''
+    bvals = [0] * n_b0
+    bvecs = [np.zeros(3)] * n_b0
+    for b in shells:
+        dirs = rng.normal(size=(n_dir, 3))
+        dirs /= np.linalg.norm(dirs, axis=1, keepdims=True)
+        bvals += [b] * n_dir
+        bvecs += list(dirs)
+    return np.array(bvals, dtype=float), np.array(bvecs).T
+
+
+def make_dwi(mask:np.ndarray, bvals:np.ndarray, bvecs:np.ndarray, rng):
+    ''' Anisotropic tensor along x in the mask, noisy S0=1000 signal '''
+    evals = np.array([1.7e-3, 0.3e-3, 0.3e-3])
+    adc = (bvecs ** 2 * evals[:, None]).sum(axis=0)
+    signal = 1000 * np.exp(-bvals * adc)
+    data = mask[..., None] * signal[None, None, None, :]
+    data = data + rng.normal(scale=10, size=data.shape)
+    return np.abs(data).astype(np.float32)
+
+
+def save(data:np.ndarray, affine:np.ndarray, filename:str):
+    if not os.path.exists(os.path.dirname(filename)):
+        os.makedirs(os.path.dirname(filename))
+    nib.Nifti1Image(data, affine).to_filename(filename)
+
+
+def make_session(data_path:str, subj:str, sess:str, shape:tuple=(32, 32, 24), voxel_size:float=2.0,
+                 shells:list=(1000, 2000), n_dir:int=12, seed:int=0):
+    ''' Write the raw data of one session in the layout read by the numbered scripts
+
+        Parameters
+        ----------
+        data_path :
+            Root of the synthetic dataset
+        subj :
+            Subject folder name (i.e. sub-51T01)
+        sess :
+            Session folder name (i.e. ses-baseline)
+        shape :
+            Dwi grid, the T1 grid has twice the resolution
+        voxel_size :
+            Dwi voxel size in mm
+        shells :
+            Non-zero b-values
+        n_dir :
+            Directions per shell
+        seed :
+            Random seed
+    '''
+    rng = np.random.default_rng(seed)
+    prefix = subj + "_" + sess
+
+    # T1 at twice the dwi resolution
+    t1_shape = tuple(2 * n for n in shape)
+    t1_affine = phantom_affine(voxel_size / 2, t1_shape)
+    t1_mask = brain_mask(t1_shape)
+    t1 = (600 * t1_mask + rng.normal(scale=20, size=t1_shape)).astype(np.float32)
+    anat_folder = os.path.join(data_path, subj, sess, "anat")
+    save(t1, t1_affine, os.path.join(anat_folder, prefix + "_T1w.nii.gz"))
+    save(t1, t1_affine, os.path.join(anat_folder, prefix + "_acq-mprage_T1w.nii.gz"))
+
+    # Lesions: a small sphere per lesion type
+    center = np.array(t1_shape) // 2
+    grid = np.indices(t1_shape)
+    for i, les in enumerate(("acute", "combined", "old")):
+        offset = center + np.array([4 * (i - 1), 3, 0])
+        lesion = (((grid - offset[:, None, None, None]) ** 2).sum(axis=0) <= 9).astype(np.uint8)
+        save(lesion, t1_affine, os.path.join(anat_folder, prefix + "_T1w_label-" + les + "lesion_roi.nii.gz"))
+
+    # AP (full protocol) and PA dwi
+    affine = phantom_affine(voxel_size, shape)
+    mask = brain_mask(shape)
+    dwi_folder = os.path.join(data_path, subj, sess, "dwi")
+    bvals, bvecs = gradient_table(2, list(shells), n_dir, rng)
+    for direction, (bv, bc) in zip(["AP", "PA"], [(bvals, bvecs), (bvals[:2], bvecs[:, :2])]):
+        base = os.path.join(dwi_folder, prefix + "_dwi_" + direction + "_1")
+        save(make_dwi(mask, bv, bc, rng), affine, base + ".nii.gz")
+        np.savetxt(base + ".bval", bv[None], fmt='%g')
+        np.savetxt(base + ".bvec", bc, fmt='%.6f')
+
+    # Outputs of 11_register_rois_MNI2B0.py in dwi space: clusters and striatum rois
+    tract_folder = os.path.join(data_path, "derivatives", "01_tracts", subj, sess)
+    clusters = np.zeros(shape, dtype=np.float32)
+    cube = np.array(shape) // 8
+    for k, idx in enumerate(ROI_INDEX):
+        start = np.array(shape) // 2 + (np.array([k % 3, k // 3, 0]) - 1) * cube * 2
+        clusters[tuple(slice(s, s + c) for s, c in zip(start, cube))] = idx
+    save(clusters, affine, os.path.join(tract_folder, 'roi2roi', 'fMRI_study', prefix + '_roi_Clusters_dwi_ants.nii.gz'))
+    for k, roi in enumerate(STRIAT):
+        roi_mask = np.zeros(shape, dtype=np.float32)
+        start = np.array(shape) // 2 + np.array([k - 2, -2, -2]) * cube // 2
+        roi_mask[tuple(slice(s, s + c) for s, c in zip(start, cube))] = 1
+        save(roi_mask, affine, os.path.join(tract_folder, 'striat', prefix + "_roi_" + roi + "_dwi_ants.nii.gz"))
+
+    # Output folders created by 000_main_dwi_pipeline.sh before the python steps
+    for folder in ["preproc", "proc"]:
+        out_folder = os.path.join(data_path, "derivatives", "01_dwi", subj, sess, "dwi", folder)
+        if not os.path.exists(out_folder):
+            os.makedirs(out_folder)
+
+
+def make_tractogram(ref_file:str, tck_file:str, n_streamlines:int, seed:int=0):
+    ''' Straight streamlines (1 mm steps) through random points of the non-zero voxels of ref_file '''
+    rng = np.random.default_rng(seed)
+    ref = nib.load(ref_file)
+    data = np.asanyarray(ref.dataobj)
+    mask = data[..., 0] > 0 if data.ndim > 3 else data > 0
+    voxels = np.argwhere(mask)
+    if len(voxels) == 0:
+        voxels = np.argwhere(np.ones(mask.shape, dtype=bool))
+    seeds = nib.affines.apply_affine(ref.affine, voxels[rng.integers(len(voxels), size=n_streamlines)])
+    dirs = rng.normal(size=(n_streamlines, 3))
+    dirs /= np.linalg.norm(dirs, axis=1, keepdims=True)
+    lengths = rng.integers(10, 40, size=n_streamlines)
+    streamlines = [(s + np.arange(-n // 2, n // 2)[:, None] * d).astype(np.float32)
+                   for s, d, n in zip(seeds, dirs, lengths)]
+    tractogram = nib.streamlines.Tractogram(streamlines, affine_to_rasmm=np.eye(4))
+    nib.streamlines.save(tractogram, tck_file)
+    return len(streamlines)
+
+
+def make_cohort(data_path:str, n_subjects:int, sessions:list, **kwargs):
+    ''' Write n_subjects x sessions synthetic sessions, returns the subject folder names '''
+    subjects = ['sub-51T{0:02d}'.format(i + 1) for i in range(n_subjects)]
+    for i, subj in enumerate(subjects):
+        for j, sess in enumerate(sessions):
+            make_session(data_path, subj, sess, seed=100 * i + j, **kwargs)
+    if not os.path.exists(os.path.join(data_path, "derivatives", "01_analysis")):
+        os.makedirs(os.path.join(data_path, "derivatives", "01_analysis"))
+    return subjects
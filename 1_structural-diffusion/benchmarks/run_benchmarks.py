@@ -0,0 +1,332 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Cohort benchmark of the pipeline on synthetic data.
+#
+# A small cohort is written by phantom.py, the external executables are replaced by fake_tool.py
+# (fixed, configurable cost per call) and the processing functions of the numbered scripts are run
+# in-process, step by step, over every session. For each step the wall time is split into
+#   - tool      : time spent inside the (fake) executables, as reported by the tools themselves
+#   - spawn     : process start-up and shell overhead (parent side time minus tool time)
+#   - python    : everything else, i.e. the numpy/nibabel work done by the scripts
+# so that changes to the pipeline itself can be measured without FSL/ANTs/MRtrix/FreeSurfer.
+# One JSON line per run is appended to results.jsonl (commit, host, parameters, per-step timings)
+# and --compare prints the last run next to a previous one.
+#
+# Run from 1_structural-diffusion:
+#     python benchmarks/run_benchmarks.py --n_subjects 4 --delay 0.05 -v
+
+from __future__ import division
+
+import argparse
+import importlib.util
+import itertools
+import json
+import logging
+import os
+import platform
+import shutil
+import socket
+import stat
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+PIPELINE_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, PIPELINE_DIR)
+
+import phantom
+from fake_tool import TOOLS
+from tools import registration_ants
+from tools.roi_study import load_studies
+
+# (name, script, function, call) in pipeline order. call builds the arguments of the function,
+# "cohort" steps are called once with the list of subjects instead of once per session.
+STEPS = [
+    ('02_dwi_preprocessing', '02_dwi_preprocessing.py', 'pre_proc',
+        lambda d, s, t: (d, s, t, False)),
+    ('04_freesurfer', '04_freesurfer.py', 'freesurfer_func',
+        lambda d, s, t: (d, s, t, False, False)),
+    ('05_anat_registration_dwi', '05_anat_registration_dwi.py', 'anat_reg_dwi',
+        lambda d, s, t: (d, s, t, False)),
+    ('06_dwi_processing', '06_dwi_processing.py', 'dwi_processing_func',
+        lambda d, s, t: (d, s, t, False)),
+    ('06_compute_scalar_maps', '06_compute_scalar_maps.py', 'scalar_maps_fnct',
+        lambda d, s, t: (d, s, t, False, False, False)),
+    ('12_create_parc', 'roi_analysis/12_create_parc.py', 'create_parc',
+        lambda d, s, t: (s, t, d, load_studies(['all']), False)),
+    ('13_dwi_extract_tracts_tckedit', 'roi_analysis/13_dwi_extract_tracts_tckedit.py', 'track_extraction',
+        lambda d, s, t: (s, t, d, load_studies(['all']), False, False)),
+    ('13_seed_based', 'roi_analysis/13_seed_based.py', 'seed_based',
+        lambda d, s, t: (d, s, t, False, False)),
+    ('14_formate_data', 'roi_analysis/14_formate_data.py', 'cohort',
+        None),
+]
+
+
+def buildArgsParser():
+    p = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter,
+        epilog="")
+    p._optionals.title = "Generic options"
+
+    p.add_argument('--n_subjects', type=int, default=3, dest='n_subjects',
+        help="Number of synthetic subjects. ['%(default)s']")
+    p.add_argument('--sess', nargs='+', default=['baseline'], dest='sess',
+        help="Session names (14_formate_data reads ses-baseline only). ['%(default)s']")
+    p.add_argument('--shape', type=int, nargs=3, default=[32, 32, 24], dest='shape',
+        help="Dwi grid of the phantom. ['%(default)s']")
+    p.add_argument('--delay', type=float, default=0.0, dest='delay',
+        help="Seconds slept by every fake tool call. ['%(default)s']")
+    p.add_argument('--streamlines', type=int, default=2000, dest='streamlines',
+        help="Streamlines written by the fake tckgen. ['%(default)s']")
+    p.add_argument('--steps', nargs='+', default=None, dest='steps',
+        help="Subset of steps to run (default: all).")
+    p.add_argument('--work_dir', default=None, dest='work_dir',
+        help="Working folder, kept after the run (default: temporary folder removed at the end).")
+    p.add_argument('--results', default=os.path.join(BENCH_DIR, 'results.jsonl'), dest='results',
+        help="File the results are appended to. ['%(default)s']")
+    p.add_argument('--label', default='', dest='label',
+        help="Free text stored with the results.")
+    p.add_argument('--compare', nargs='?', const=-2, type=int, default=None, dest='compare',
+        help="Print the last result next to the result at this index of the results file (default: previous run) "
+             "and exit.")
+
+    log_g = p.add_argument_group('Logging options')
+    log_g.add_argument(
+        '-v', action='store_true', dest='isVerbose',
+        help='If set, produces verbose output.')
+
+    return p
+
+
+#------------------------------------------------------------#
+# Fake executables
+#------------------------------------------------------------#
+
+def install_fake_tools(work_dir:str):
+    ''' Wrapper scripts for every fake tool in work_dir/bin, and work_dir/tools/antsRegistrationSyN.sh
+        (called by path by registerAnts, see ANTS_SYN_SCRIPT) '''
+    bin_dir = os.path.join(work_dir, 'bin')
+    os.makedirs(bin_dir)
+    os.makedirs(os.path.join(work_dir, 'tools'))
+    wrapper = '#!/bin/sh\nexec "{0}" "{1}" {2} "$@"\n'
+    fake_tool = os.path.join(BENCH_DIR, 'fake_tool.py')
+    scripts = [os.path.join(bin_dir, tool) for tool in TOOLS] + \
+        [os.path.join(work_dir, 'tools', 'antsRegistrationSyN.sh')]
+    for script in scripts:
+        with open(script, 'w') as f:
+            f.write(wrapper.format(sys.executable, fake_tool, os.path.basename(script)))
+        os.chmod(script, os.stat(script).st_mode | stat.S_IEXEC)
+    return bin_dir
+
+
+class TimedPopen(subprocess.Popen):
+    ''' Popen recording the parent side duration of every child process, whether it is reaped by
+        Popen.wait or by os.wait4 (tools/command.py) '''
+    durations = []
+    started = {}
+
+    def __init__(self, *args, **kwargs):
+        start = time.perf_counter()
+        super().__init__(*args, **kwargs)
+        TimedPopen.started[self.pid] = start
+
+    def wait(self, *args, **kwargs):
+        status = super().wait(*args, **kwargs)
+        TimedPopen.reaped(self.pid)
+        return status
+
+    @staticmethod
+    def reaped(pid:int):
+        if pid in TimedPopen.started:
+            TimedPopen.durations.append(time.perf_counter() - TimedPopen.started.pop(pid))
+
+
+def timed_wait4(pid:int, options:int, _wait4=os.wait4):
+    result = _wait4(pid, options)
+    TimedPopen.reaped(pid)
+    return result
+
+
+def read_tool_log(log_file:str):
+    if not os.path.isfile(log_file):
+        return []
+    with open(log_file) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+#------------------------------------------------------------#
+# Steps
+#------------------------------------------------------------#
+
+def load_script(name:str, script:str, data_path:str):
+    ''' Import a numbered script as a module and set the globals its functions read from __main__ '''
+    spec = importlib.util.spec_from_file_location('bench_' + name, os.path.join(PIPELINE_DIR, script))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    module.args = argparse.Namespace(acqparams_file=os.path.join(PIPELINE_DIR, 'eddy', 'acqparams.txt'),
+                                      index_file=os.path.join(PIPELINE_DIR, 'eddy', 'eddy_index.txt'),
+                                      isForce=False, isVerbose=False)
+    module.data_path = data_path
+    return module
+
+
+def run_step(name:str, script:str, function:str, call, data_path:str, subjects:list, sessions:list,
+             work_dir:str, log_file:str):
+    ''' Run one step over the cohort, returns its timings '''
+    result = {'step': name, 'sessions': 0, 'failures': 0, 'errors': []}
+    TimedPopen.durations = []
+    n_log = len(read_tool_log(log_file))
+
+    start = time.perf_counter()
+    try:
+        module = load_script(name, script, data_path)
+    except Exception as e:
+        result['errors'].append('import: ' + repr(e))
+        result['failures'] = 1
+        logging.warning('{0}: import failed: {1!r}'.format(name, e))
+        return result
+
+    if function == 'cohort':
+        calls = [(step_function, (subjects, sessions, data_path) + step_args + (True,))
+                 for _, step_function, step_args in module.cohort_steps(load_studies(['all']))]
+    else:
+        calls = [(getattr(module, function), call(data_path, subj, sess))
+                 for subj, sess in itertools.product(subjects, sessions)]
+
+    for func, func_args in calls:
+        result['sessions'] += 1
+        try:
+            func(*func_args)
+        except Exception as e:
+            result['failures'] += 1
+            result['errors'].append(func.__name__ + str(func_args[:3]) + ': ' + repr(e))
+            logging.debug(traceback.format_exc())
+        finally:
+            os.chdir(work_dir)
+    wall = time.perf_counter() - start
+
+    tool_calls = read_tool_log(log_file)[n_log:]
+    subprocess_time = sum(TimedPopen.durations)
+    tool_time = sum(c['end'] - c['start'] for c in tool_calls)
+    result.update({
+        'wall': wall,
+        'python': wall - subprocess_time,
+        'subprocess': subprocess_time,
+        'tool': tool_time,
+        'spawn': subprocess_time - tool_time,
+        'n_calls': len(TimedPopen.durations),
+        'tool_calls': sorted(set(c['tool'] for c in tool_calls)),
+        })
+    return result
+
+
+#------------------------------------------------------------#
+# Results
+#------------------------------------------------------------#
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=PIPELINE_DIR,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return 'unknown'
+
+
+def print_results(run:dict, reference:dict=None):
+    ref_steps = {s['step']: s for s in reference['steps']} if reference else {}
+    header = '{0:<32}{1:>9}{2:>9}{3:>9}{4:>9}{5:>7}{6:>6}'.format('step', 'wall', 'python', 'spawn', 'tool',
+                                                                 'calls', 'fail')
+    if reference:
+        header += '{0:>12}'.format('ref wall')
+    print(header)
+    for s in run['steps']:
+        line = '{0:<32}{1:>9.2f}{2:>9.2f}{3:>9.2f}{4:>9.2f}{5:>7d}{6:>6d}'.format(
+            s['step'], s.get('wall', 0), s.get('python', 0), s.get('spawn', 0), s.get('tool', 0),
+            s.get('n_calls', 0), s['failures'])
+        if s['step'] in ref_steps:
+            line += '{0:>12.2f}'.format(ref_steps[s['step']].get('wall', 0))
+        print(line)
+    print('total wall {0:.2f} s ({1} @ {2}, {3})'.format(run['wall'], run['commit'], run['host'], run['date']))
+
+
+def compare(results_file:str, index:int):
+    with open(results_file) as f:
+        runs = [json.loads(line) for line in f if line.strip()]
+    if len(runs) < 2:
+        print('Nothing to compare in ' + results_file)
+        return
+    print_results(runs[-1], runs[index])
+    print('reference: {0} @ {1}, {2}'.format(runs[index]['commit'], runs[index]['host'], runs[index]['date']))
+
+
+if __name__ == "__main__":
+    parser = buildArgsParser()
+    args = parser.parse_args()
+
+    if args.isVerbose:
+        logging.basicConfig(level=logging.DEBUG)
+
+    if args.compare is not None:
+        compare(args.results, args.compare)
+        sys.exit(0)
+
+    keep_work_dir = args.work_dir is not None
+    WORK_DIR = os.path.abspath(args.work_dir) if keep_work_dir else tempfile.mkdtemp(prefix='dwi_bench_')
+    if not os.path.exists(WORK_DIR):
+        os.makedirs(WORK_DIR)
+    data_path = os.path.join(WORK_DIR, 'data')
+    log_file = os.path.join(WORK_DIR, 'fake_tools.jsonl')
+
+    sessions = ['ses-' + sess for sess in args.sess]
+    start = time.perf_counter()
+    subjects = phantom.make_cohort(data_path, args.n_subjects, sessions, shape=tuple(args.shape))
+    phantom_time = time.perf_counter() - start
+    logging.info('Synthetic cohort written in {0:.1f} s: "{1}".'.format(phantom_time, data_path))
+
+    bin_dir = install_fake_tools(WORK_DIR)
+    os.environ['PATH'] = bin_dir + os.pathsep + os.environ['PATH']
+    os.environ['FAKE_TOOL_LOG'] = log_file
+    os.environ['FAKE_TOOL_DELAY'] = str(args.delay)
+    os.environ['FAKE_TOOL_STREAMLINES'] = str(args.streamlines)
+    subprocess.Popen = TimedPopen
+    os.wait4 = timed_wait4
+    registration_ants.ANTS_SYN_SCRIPT = os.path.join(WORK_DIR, 'tools', 'antsRegistrationSyN.sh')
+    os.chdir(WORK_DIR)
+
+    steps = []
+    for name, script, function, call in STEPS:
+        if args.steps and name not in args.steps:
+            continue
+        logging.info('Running ' + name)
+        steps.append(run_step(name, script, function, call, data_path, subjects, sessions, WORK_DIR, log_file))
+
+    run = {
+        'commit': git_commit(),
+        'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'host': socket.gethostname(),
+        'python': platform.python_version(),
+        'cpus': os.cpu_count(),
+        'label': args.label,
+        'params': {'n_subjects': args.n_subjects, 'sessions': sessions, 'shape': args.shape,
+                   'delay': args.delay, 'streamlines': args.streamlines},
+        'phantom': phantom_time,
+        'wall': sum(s.get('wall', 0) for s in steps),
+        'steps': steps,
+        }
+    with open(args.results, 'a') as f:
+        f.write(json.dumps(run) + '\n')
+
+    print_results(run)
+    for s in steps:
+        for error in s['errors']:
+            print(s['step'] + ': ' + error)
+
+    os.chdir(PIPELINE_DIR)
+    if not keep_work_dir:
+        shutil.rmtree(WORK_DIR)
@@ -3,22 +3,24 @@
 
 # This file provide a way to extract specific tract from the all-brain tractography. 
 # Must be used after the dwi pipeline once the full tractograme is extracted,  as a second step of the roi-to-roi analysis.
+# The rois and their order in the parcellation are those of the ROI studies of roi_analysis/studies (see tools/roi_study.py).
 
 from __future__ import division
 
 import argparse
 import os
-import sys
 import time
-import itertools
 import json
-import subprocess
 import logging
-from datetime import datetime
 import nibabel as nib
 import numpy as np
 import pandas as pd
 
+from tools.run_ledger import run_step, select_sessions
+from tools.manifest import Manifest
+from tools.outputs import is_valid, save_image
+from tools.roi_study import load_studies, labels, paint_order, study_folder, atlas_file, roi_mask, parcellation_file
+
 def buildArgsParser():
     p = argparse.ArgumentParser(
         description=__doc__, formatter_class=argparse.RawTextHelpFormatter,
@@ -30,111 +32,119 @@ def buildArgsParser():
 
     p.add_argument('--data_path', default='/mnt/Hummel-Data/TI/mri/51T', dest='data_path',
         help="Subjects folder path. ['%(default)s']")
+    p.add_argument('--study', nargs='+', default=['all'], dest='study',
+        help="ROI studies of roi_analysis/studies (name or json file). ['%(default)s']")
 
     p.add_argument('-f', action='store_true', dest='isForce', 
     help='If set, overwrites output file.')
 
+    sel_g = p.add_argument_group('Selection options')
+    sel_g.add_argument('--only-failed', action='store_true', dest='only_failed',
+        help='If set, only runs the sessions that failed or were skipped (see tools/run_ledger.py).')
+    sel_g.add_argument('--only-pending', action='store_true', dest='only_pending',
+        help='If set, only runs the sessions that were never run or were interrupted.')
+
     log_g = p.add_argument_group('Logging options')
     log_g.add_argument(
         '-v', action='store_true', dest='isVerbose',
         help='If set, produces verbose output.')
     return p
 
-def create_parc(subj:str, sess:str,data_path:str, isForce:bool):  
-    ''' 
-        Create individual mask AND global mask for connectivity analysis.
+def roi_voxels(data, roi:dict):
+    ''' Voxels of a roi in its registered atlas: its label (+/- 0.1, the interpolated atlas is not integer) or, without label, the whole atlas '''
+    if 'label' not in roi:
+        return data == 1
+    return np.abs(data - roi['label']) <= 0.1
+
+
+def create_parc(subj:str, sess:str,data_path:str, studies:list, isForce:bool):  
     ''' 
+        Create individual mask AND global mask for connectivity analysis, for each study (tools/roi_study.py).
 
-    #------------------------------------------------------------#
-    # SETUP:  TO CHANGE IF WANT TO RUN THE ANALYSIS FOR OTHER ROIS
-    #------------------------------------------------------------#
-    study = 'fMRI_study'
-    rois = ['Loc_NA_Postcentral_L', 'Loc_NA_Cerebellum', 'Thal_IL_R', 'Precentral_L', 'Supp_Motor_Area_R']
-    index = [2, 4, 5, 6, 7] # from cluster files
-    
-    roiClusters_file = os.path.join(data_path, "derivatives", "01_tracts", subj, sess, 'roi2roi', study, subj + "_" + sess +'_roi_Clusters_dwi_ants.nii.gz')
-    striat = ['v_d_Ca_L', 'v_d_Ca_R', 'vm_dl_PU_L', 'vm_dl_PU_R']
-    #------------------------------------------------------------#
-    
-    tract_folder =  os.path.join(data_path, "derivatives", "01_tracts", subj, sess)
-    roi_folder = os.path.join(tract_folder, 'roi2roi')
-
-    #------------------------------------------------------------#
-    #### 1 CREATE INDIVIDUAL MASK FOR EACH ROI - FOR TRACT EXTRACTION #### 
-    #------------------------------------------------------------#
-
-    for idx_roi, roi in zip(index, rois) : 
-        # Apply fslmath with threashold [v1, v2] and save the result into masks
-        if not os.path.exists(os.path.join(roi_folder, study, 'masks')) : 
-            os.makedirs(os.path.join(roi_folder, study, 'masks'))
-
-        mask_file = os.path.join(roi_folder, study, 'masks', subj + '_' + sess + "_roi_" + str(roi) +'_mask.nii.gz')
-        json_out = os.path.join(roi_folder, study, 'masks', subj + '_' + sess + "_roi_" + str(roi) +'_mask.json')
-
-        # set the tresholds 
-        v1 = idx_roi - 0.1
-        v2 = idx_roi + 0.1
-
-        if os.path.isfile(mask_file) and not isForce: 
-            logging.info('Individual mask already done: "{0}".'.format(mask_file))
-            print('Individual mask already done: "{0}".'.format(mask_file))
-        else:
-            fslmath_cmd_thr = "fslmaths " + roiClusters_file + " -thr " + str(v1) + " -uthr " + str(v2) + " -bin " + mask_file 
-            logging.info('fslmaths threshold command: "{0}".'.format(fslmath_cmd_thr))
-            subprocess.call(fslmath_cmd_thr, shell=True)
-                
-            with open(json_out, 'w') as outfile:
+        Each registered atlas is read once for all the studies, the masks (uint8) and the parcellation (int16)
+        are written from it in memory, without one fslmaths per roi. A voxel of several rois is labelled
+        with the roi of highest priority (roi_study.paint_order).
+    ''' 
+    atlas_data = {}
+
+    def atlas(study, roi):
+        # Registered atlas of a roi, loaded on first use
+        atlas_name = roi['atlas']
+        if atlas_name not in atlas_data:
+            img = nib.load(atlas_file(data_path, subj, sess, study['atlases'][atlas_name]))
+            atlas_data[atlas_name] = (img, np.asanyarray(img.dataobj))
+        return atlas_data[atlas_name]
+
+    for study in studies:
+        mask_folder = os.path.join(study_folder(data_path, subj, sess, study), 'masks')
+        if not os.path.exists(mask_folder) : 
+            os.makedirs(mask_folder)
+
+        parc_file = parcellation_file(data_path, subj, sess, study)
+        json_file = parc_file[:-len('.nii.gz')] + '.json'
+        # A roi without label is its whole registered atlas (i.e. striatum), used as it is
+        mask_files = [roi_mask(data_path, subj, sess, study, roi) for roi in study['rois'] if 'label' in roi]
+
+        if all(is_valid(f) for f in mask_files + [parc_file]) and not isForce:
+            logging.info('Masks already done: "{0}".'.format(parc_file))
+            print('Masks and global mask already done: "{0}".'.format(parc_file))
+            continue
+
+        #------------------------------------------------------------#
+        #### 1 CREATE INDIVIDUAL MASK FOR EACH ROI - FOR TRACT EXTRACTION #### 
+        #------------------------------------------------------------#
+
+        voxels = []
+        for roi in study['rois'] : 
+            img, data = atlas(study, roi)
+            voxels.append(roi_voxels(data, roi))
+            if 'label' not in roi:
+                continue
+
+            mask_file = roi_mask(data_path, subj, sess, study, roi)
+            mask = nib.Nifti1Image(voxels[-1].astype(np.uint8), img.affine, img.header)
+            mask.set_data_dtype(np.uint8)
+            save_image(mask, mask_file)
+
+            with open(mask_file[:-len('.nii.gz')] + '.json', 'w') as outfile:
                 j = {
-                    'Origin function': fslmath_cmd_thr,
-                    'Description': 'Apply fslmath with threashold [' + str(v1) + ',' + str(v2) +']',
+                    'Origin function': './roi_analysis/12_create_parc.py',
+                    'Description': 'Voxels of label ' + str(roi['label']) + ' (+/- 0.1) of atlas ' + roi['atlas'],
                     'Anat_filename': mask_file,
                     'Time' : time.asctime()
                     }
                 json.dump(j, outfile)
-          
-
-    # add the striatum to the label list
-    tot_rois = striat + rois
-
-    #------------------------------------------------------------#
-    #### 2 CREATE GLOBAL MASK FOR WITH ALL THE ROI - FOR CONNECTOME #### 
-    #------------------------------------------------------------#
-
-    parcellation_file = os.path.join(roi_folder, study, 'masks', subj + "_" + sess + "_global_mask.nii.gz")
-    json_file = os.path.join(roi_folder, study, 'masks', subj + "_" + sess + "_global_mask.json")
 
-    if os.path.isfile(parcellation_file) and not isForce:
-        logging.info('global mask already done: "{0}".'.format(parcellation_file))
-        print('global mask already done: "{0}".'.format(parcellation_file))
-    else : 
-        parc = nib.load(roiClusters_file)
-        parc_data = parc.get_fdata()
-        reduced = np.zeros(parc_data.shape)
+        #------------------------------------------------------------#
+        #### 2 CREATE GLOBAL MASK FOR WITH ALL THE ROI - FOR CONNECTOME #### 
+        #------------------------------------------------------------#
 
-        for i, roi in enumerate(tot_rois): 
-            # Select the right individual mask
-            if  roi in striat : 
-                mask_file = os.path.join(tract_folder, 'striat',  subj + "_" + sess + "_roi_" + roi + "_dwi_ants.nii.gz")
-            else: 
-                mask_file = os.path.join(roi_folder, study, 'masks', subj + '_' + sess + "_roi_" + str(roi) +'_mask.nii.gz')
-            
-            mask = nib.load(mask_file)
-            reduced[mask.get_fdata() == 1] = i + 1
+        # Label i + 1 for the i-th roi of the study, painted by increasing priority
+        img = atlas(study, study['rois'][0])[0]
+        parc_data = np.zeros(img.shape[:3], dtype=np.int16)
+        for i in paint_order(study['rois']):
+            overlap = np.count_nonzero(parc_data[voxels[i]])
+            if overlap:
+                logging.warning('{0} voxels of roi {1} also belong to a roi of lower priority: assigned to {1}.'.format(
+                    overlap, study['rois'][i]['name']))
+            parc_data[voxels[i]] = i + 1
 
-
-        nib.Nifti1Image(reduced, parc.affine, parc.header).to_filename(parcellation_file)
+        parc = nib.Nifti1Image(parc_data, img.affine, img.header)
+        parc.set_data_dtype(np.int16)
+        save_image(parc, parc_file)
 
         with open(json_file, 'w') as outfile:
             j = {
-                'Origin function': './processing_scripts/diffusion/ROIs_functions/2_create_parc.py',
-                'Description': 'Parcellation with ROIs and Striat',
-                'DWI_filename': parcellation_file,
+                'Origin function': './roi_analysis/12_create_parc.py',
+                'Description': 'Parcellation with the rois of study ' + study['name'],
+                'DWI_filename': parc_file,
                 'Time': time.asctime()
                 }
             json.dump(j, outfile)
                     
         # Save the labels into a csv file
-        label_file = os.path.join(roi_folder, study, 'masks', subj + "_" + sess + "_global_mask.csv")
+        label_file = parc_file[:-len('.nii.gz')] + '.csv'
+        tot_rois = labels(study)
         lab = {'roi' : tot_rois}
         df = pd.DataFrame(lab, index=(np.arange(1,len(tot_rois)+1)))
         df.to_csv(label_file)
@@ -155,25 +165,14 @@ if __name__ == "__main__":
 
     data_path = args.data_path
 
-    if "all" in subj_list:
-        subjects = [s for s in os.listdir(data_path) if os.path.isdir(os.path.join(data_path, s)) if "sub-51T" in s]
-    else:
-        subjects = ['sub-' + subj for subj in subj_list]
-    
-    
     sess_list = [sess for sess in args.sess]
-    if "all" in sess_list:
-       sessions = ["ses-T1", "ses-T2", "ses-T3", "ses-T4"]
-    else:
-        sessions = ['ses-' + sess for sess in sess_list]
     
-    date = datetime.now()
-    formatted_datetime = date.strftime("%Y-%m-%d-%H-%M-%S")
-    fail_list_filename = f"fail_list_12_create_parc{formatted_datetime}.txt"
-    for subj, sess in itertools.product(subjects, sessions):        
-            try:
-                create_parc(subj, sess,data_path, isForce)
-            except Exception as e:
-                with open(fail_list_filename, "+a") as f:
-                    f.write(f"{subj} {sess} \n")
-                    f.write(f"{str(e)} \n")
+    studies = load_studies(args.study)
+
+    script = '12_create_parc'
+    manifest = Manifest(data_path)
+    pairs = manifest.select(subj_list, sess_list, 'dwi')
+    if not args.isForce:
+        pairs = manifest.incomplete(script, pairs)
+    for subj, sess in select_sessions(data_path, script, pairs, args.only_failed, args.only_pending):
+        run_step(data_path, script, subj, sess, create_parc, subj, sess,data_path, studies, isForce)
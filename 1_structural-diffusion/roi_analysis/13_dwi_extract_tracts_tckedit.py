@@ -3,25 +3,26 @@
 
 # This file provide a way to extract specific track from the all tractograme. 
 # Must be used after the dwi pipeline once the full tractograme is extracted,  as a second step of the roi-to-roi analysis.
+# The rois and the pairs of rois are those of the ROI studies of roi_analysis/studies (see tools/roi_study.py),
+# all the studies of a session are extracted from one pass over the tractogram.
 
 from __future__ import division
 
 import argparse
 import os
-import sys
 import time
-import itertools
 import json
-import subprocess
 import logging
-from datetime import datetime
+import shutil
 import nibabel as nib
 import numpy as np
-import pandas as pd
 
-sys.path.insert(1,'/home/bgrosjea/mnt/Hummel-Data/TI/mri/51T/barbara/uphummel_imaging_template/1_structural-diffusion')
 from tools.tck2conn4stream_measures import * 
-from tools.formate_data import formate_roi2roi
+from tools.command import run_cmd
+from tools.run_ledger import run_step, select_sessions
+from tools.manifest import Manifest
+from tools.outputs import is_valid, tmp_path, commit, save_image, save_txt
+from tools.roi_study import load_studies, labels, rois, paint_order, study_folder, roi_mask, parcellation_file, connectome_file, tract_file
 
 def buildArgsParser():
     p = argparse.ArgumentParser(
@@ -34,28 +35,191 @@ def buildArgsParser():
 
     p.add_argument('--data_path', default='/mnt/Hummel-Data/TI/mri/51T', dest='data_path',
         help="Subjects folder path. ['%(default)s']")
+    p.add_argument('--study', nargs='+', default=['all'], dest='study',
+        help="ROI studies of roi_analysis/studies (name or json file). ['%(default)s']")
 
     p.add_argument('-f', action='store_true', dest='isForce', 
     help='If set, overwrites output file.')
 
+    sel_g = p.add_argument_group('Selection options')
+    sel_g.add_argument('--only-failed', action='store_true', dest='only_failed',
+        help='If set, only runs the sessions that failed or were skipped (see tools/run_ledger.py).')
+    sel_g.add_argument('--only-pending', action='store_true', dest='only_pending',
+        help='If set, only runs the sessions that were never run or were interrupted.')
+
     log_g = p.add_argument_group('Logging options')
     log_g.add_argument(
         '-v', action='store_true', dest='isVerbose',
         help='If set, produces verbose output.')
     return p
 
-def track_extraction(subj:str, sess:str, data_path:str, isVerbose:bool, isForce:bool): 
-    ''' 
-    Track extraction using tckedit 
+def study_done(data_path:str, subj:str, sess:str, study:dict):
+    ''' Whether the tracts and the connectome of a study are there and valid for the session '''
+    files = [connectome_file(data_path, subj, sess, study)]
+    for pair in study['pairs']:
+        files += [tract_file(data_path, subj, sess, study, pair), tract_file(data_path, subj, sess, study, pair, '_sift2.txt')]
+    return all(is_valid(f) for f in files)
+
+
+def write_weights(weights_file:str, filename:str):
+    ''' Copy a weights file of connectome2tck as a tckedit -tck_weights_out file (space separated) '''
+    with open(weights_file) as f:
+        weights = f.read().split()
+    tmp_file = tmp_path(filename)
+    with open(tmp_file, 'w') as f:
+        f.write(''.join(w + ' ' for w in weights) + '\n')
+    commit(tmp_file, filename)
+
+
+def copy_tract(tck_edge:str, filename:str):
+    tmp_file = tmp_path(filename)
+    try:
+        shutil.copyfile(tck_edge, tmp_file)
+        commit(tmp_file, filename)
+    finally:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+
+
+def merged_parcellation(data_path:str, subj:str, sess:str, studies:list):
+    ''' Parcellation of the rois of all the studies: node i + 1 for the i-th roi, a roi shared by several
+        studies being one node, painted by increasing priority
+
+        Returns
+        ----------
+        Labels (int16), affine and roi names of the nodes
     '''
+    masks = {}
+    for study in studies:
+        for roi in study['rois']:
+            masks.setdefault(roi['name'], roi_mask(data_path, subj, sess, study, roi))
+    nodes = list(masks)
+    node_rois = rois(studies)
+
+    ref = nib.load(masks[nodes[0]])
+    parc_data = np.zeros(ref.shape[:3], dtype=np.int16)
+    for i in paint_order(node_rois):
+        roi = nodes[i]
+        mask = np.asanyarray(nib.load(masks[roi]).dataobj) == 1
+        overlap = np.count_nonzero(parc_data[mask])
+        if overlap:
+            logging.warning('{0} voxels of roi {1} also belong to a roi of lower priority: assigned to {1}.'.format(overlap, roi))
+        parc_data[mask] = i + 1
+    return parc_data, ref.affine, nodes
+
+
+def is_merged_parcellation(parc_data, nodes:list, study_parc:str, study:dict):
+    ''' Whether the merged parcellation, restricted to the rois of a study, is the parcellation of the study
+        (12_create_parc.py): then its end point assignments are those of the study alone '''
+    lookup = np.zeros(len(nodes) + 1, dtype=np.int16)
+    for k, roi in enumerate(labels(study), 1):
+        lookup[nodes.index(roi) + 1] = k
+    return np.array_equal(lookup[parc_data], np.asanyarray(nib.load(study_parc).dataobj).reshape(parc_data.shape))
+
+
+def extract_studies(tck_file:str, sift_file:str, parc_file:str, nodes:list, studies:list, data_path:str,
+                    subj:str, sess:str, roi_folder:str, run_name:str):
+    ''' Connectome and tracts of the studies from one pass over the tractogram, with the parcellation
+        parc_file whose node i + 1 is nodes[i]. The intermediates are written in roi_folder, named after run_name '''
+
     #------------------------------------------------------------#
-    # SETUP:  TO CHANGE IF WANT TO RUN THE ANALYSIS FOR OTHER ROIS
+    #### 1 ONE PASS OVER THE TRACTOGRAM: CONNECTOME AND ASSIGNMENTS #### 
     #------------------------------------------------------------#
-    study = 'fMRI_study'
-    rois = ['Loc_NA_Postcentral_L', 'Loc_NA_Cerebellum', 'Thal_IL_R', 'Precentral_L', 'Supp_Motor_Area_R']
-    striat = ['v_d_Ca_L', 'v_d_Ca_R', 'vm_dl_PU_L', 'vm_dl_PU_R']
+    print('## EXTRACT MATRIX OF CONNECTIVITY ##')
+    run_connectome = os.path.join(roi_folder, subj + "_" + sess + "_" + run_name + "_connect_matrix.csv")
+    assignments = os.path.join(roi_folder, subj + "_" + sess + "_" + run_name + "_assignments.txt")
+
+    # The end points are assigned to the node of their voxel, as the -ends_only of tckedit, instead of the
+    # node found by the 4 mm radial search
+    tck2connectome_cmd = 'tck2connectome ' + tck_file + ' ' + parc_file + ' ' + run_connectome + ' -tck_weights_in ' +  sift_file + \
+        ' -assignment_end_voxels -out_assignments ' + assignments + ' -force' 
+    logging.info('tck2connectome command: "{0}".'.format(tck2connectome_cmd))
+    resources = run_cmd(tck2connectome_cmd, outputs=[run_connectome, assignments])
+
+    # Upper triangular matrix of tck2connectome, made symmetric to take the sub-matrix of any order of rois.
+    # Its size is the highest label of the parcellation: the empty last nodes are added back
+    matrix = np.loadtxt(run_connectome, ndmin=2)
+    matrix = np.pad(matrix, (0, len(nodes) - matrix.shape[0]))
+    matrix = matrix + np.triu(matrix, 1).T
+
+    for study in studies:
+        connectome = connectome_file(data_path, subj, sess, study)
+        json_out = connectome[:-len('.csv')] + '.json'
+        idx = [nodes.index(roi) for roi in labels(study)]
+        save_txt(connectome, np.triu(matrix[np.ix_(idx, idx)]), fmt='%.10g', delimiter=' ')
+
+        with open(json_out, 'w') as outfile:
+            j = {
+                'Origin function': tck2connectome_cmd,
+                'Description': 'extract csv connectome, rois ' + ', '.join(labels(study)) + ' of ' + parc_file,
+                'Anat_filename': connectome,
+                'Resources': resources,
+                'Time' : time.asctime()
+                }
+            json.dump(j, outfile)
+
     #------------------------------------------------------------#
+    #### 2 EXTRACT TRACTS OF ALL THE PAIRS FROM THE ASSIGNMENTS #### 
+    #------------------------------------------------------------#
+    print('## EXTRACT THE TRACTS OF THE PAIRS ##')
+    edges = {}
+    for study in studies:
+        for pair in study['pairs']:
+            edges[pair] = tuple(sorted(nodes.index(roi) + 1 for roi in pair))
+    edge_nodes = sorted(set(node for edge in edges.values() for node in edge))
+
+    edge_folder = os.path.join(roi_folder, 'connectome2tck')
+    if not os.path.exists(edge_folder):
+        os.makedirs(edge_folder)
+    tck_prefix = os.path.join(edge_folder, subj + "_" + sess + "_")
+    weights_prefix = os.path.join(edge_folder, subj + "_" + sess + "_weights_")
+    edge_outputs = [prefix + '{0}-{1}'.format(*edge) + ext for edge in set(edges.values())
+                    for prefix, ext in [(tck_prefix, '.tck'), (weights_prefix, '.csv')]]
+
+    connectome2tck_cmd = 'connectome2tck ' + tck_file + ' ' + assignments + ' ' + tck_prefix + ' -nodes ' + ','.join(str(node) for node in edge_nodes) + \
+        ' -exclusive -files per_edge -tck_weights_in ' + sift_file + ' -prefix_tck_weights_out ' + weights_prefix + ' -force'
+    logging.info('connectome2tck command: "{0}".'.format(connectome2tck_cmd))
+    resources = run_cmd(connectome2tck_cmd, outputs=edge_outputs)
+
+    for study in studies:
+        tck_out_path = os.path.join(study_folder(data_path, subj, sess, study), 'tracts_tckedit')
+        if not os.path.exists(tck_out_path):
+            os.makedirs(tck_out_path)
+
+        for pair in study['pairs']:
+            edge = '{0}-{1}'.format(*edges[pair])
+            tck_out_file = tract_file(data_path, subj, sess, study, pair)
+            json_out = tck_out_file[:-len('.tck')] + '.json'
+            copy_tract(tck_prefix + edge + '.tck', tck_out_file)
+            write_weights(weights_prefix + edge + '.csv', tract_file(data_path, subj, sess, study, pair, '_sift2.txt'))
+
+            with open(json_out, 'w') as outfile:
+                j = {
+                    'Origin function': connectome2tck_cmd,
+                    'Description': 'Streamlines of the tractogram assigned to the pair ' + '-'.join(pair) + ' (node ' + edge + ' of ' + parc_file + ')',
+                    'Anat_filename': tck_out_file,
+                    'Resources': resources,
+                    'Time' : time.asctime()
+                    }
+                json.dump(j, outfile)
+
+    # The edges and the assignments are only read here
+    shutil.rmtree(edge_folder)
+    os.remove(assignments)
+
 
+def track_extraction(subj:str, sess:str, data_path:str, studies:list, isVerbose:bool, isForce:bool): 
+    ''' 
+    Track extraction and connectome of the studies (tools/roi_study.py), from one pass over the tractogram
+    
+    The rois of all the studies to run are merged in one parcellation: tck2connectome assigns each
+    streamline to its pair of rois once, the connectome of a study is the sub-matrix of its rois and
+    the tracts of all the pairs are written from the assignments by a single connectome2tck (instead of
+    one tckedit per pair and per study, each reading the whole tractogram).
+    A study whose parcellation (12_create_parc.py) is not the merged one restricted to its rois, i.e. one of
+    its rois overlaps a roi of another study, is run on its own parcellation: the results of a study do
+    not depend on the other studies of the run.
+    '''
     session_folder = os.path.join(data_path, "derivatives", "01_dwi", subj, sess) 
     tract_folder =  os.path.join(data_path, "derivatives", "01_tracts", subj, sess)
     
@@ -69,91 +233,45 @@ def track_extraction(subj:str, sess:str, data_path:str, isVerbose:bool, isForce:
         dwi_out = os.path.join(session_folder, 'dwi', "proc", subj + "_" + sess)
         tck_file = dwi_out + "_iFOD2.tck"
         sift_file = dwi_out + "_sift.txt"
-               
-        #------------------------------------------------------------#
-        #### 1 EXTRACT TRACTS 2 BY 2 #### 
-        #------------------------------------------------------------#
-
-        # Building up the tracts
-        tot_rois = striat + rois
-        tracts = list(itertools.combinations(tot_rois, 2))
-
-        for trct in tracts: 
-            # Select the right area files 
-            roi_file =['0', '0']
-            for i in range(len(trct)): 
-                if  trct[i] in striat : 
-                    roi_file[i] = os.path.join(tract_folder, 'striat',  subj + "_" + sess + "_roi_" + str(trct[i]) + "_dwi_ants.nii.gz")
-                else: 
-                    roi_file[i] =  os.path.join(roi_folder,study, 'masks', subj + '_' + sess + "_roi_" + str(trct[i]) +'_mask.nii.gz')
-            
-            print('## RUNNING TCKEDIT FOR TRACT ', trct, ' ##')
-            tck_out_path = os.path.join(roi_folder, study, 'tracts_tckedit')
-
-            if not os.path.exists(tck_out_path):
-                os.makedirs(tck_out_path)
-            
-            tck_out_file = os.path.join(tck_out_path, subj + "_" + sess + "_" + str(trct[0]) + "-" + str(trct[1]) + ".tck")
-            json_out = os.path.join(tck_out_path, subj + "_" + sess + "_" + str(trct[0]) + "-" + str(trct[1]) + ".json")
-            include_options =  "-include " + roi_file[0] +" -include " + roi_file[1]
-
-            if os.path.isfile(tck_out_file) and not isForce:
-                print(f'%s file already existing' %tck_out_file)
-            else:  
-                sift_outpath = os.path.join(tck_out_path, subj + "_" + sess + "_" + str(trct[0]) + "-" + str(trct[1]) + "_sift2.txt")
-                tckedit_cmd = "tckedit " + tck_file + " " + tck_out_file + " " + include_options + " -ends_only "  + " -tck_weights_in " + sift_file + " -tck_weights_out " + sift_outpath
-                
-                logging.info('tckedit command: "{0}".'.format(tckedit_cmd))
-                subprocess.call(tckedit_cmd, shell=True)
-
-                with open(json_out, 'w') as outfile:
-                    j = {
-                        'Origin function': tckedit_cmd,
-                        'Description': 'Applied rois selection to the tractogram with tckedit command',
-                        'Anat_filename': tck_out_file,
-                        'Time' : time.asctime()
-                        }
-                    json.dump(j, outfile)
-
-        #------------------------------------------------------------#
-        #### 2 EXTRACT CONNECTIVITY MATRIX #### 
-        #------------------------------------------------------------#
-        print('## EXTRACT MATRIX OF CONNECTIVITY ##')
-        
-        # tck2connectome command 
-        # Input 
-        parcellation_file = os.path.join(roi_folder, study, 'masks', subj + "_" + sess + '_global_mask.nii.gz')
-        
-        # Ouputs 
-        connectome = os.path.join(roi_folder, study, subj + "_" + sess + "_connect_matrix.csv")
-        json_out = os.path.join(roi_folder, study, subj + "_" + sess + "_connect_matrix.json")
-            
-        if os.path.isfile(connectome) and not isForce: 
-            logging.info('connectom already done: "{0}".'.format(connectome))
-        else:
-            tck2connectome_cmd = 'tck2connectome ' + tck_file + ' ' + parcellation_file + ' ' + connectome + ' -tck_weights_in ' +  sift_file + ' -force' 
-
-            logging.info('tck2connectome command: "{0}".'.format(tck2connectome_cmd))
-            subprocess.call(tck2connectome_cmd, shell=True)
-            
-            with open(json_out, 'w') as outfile:
-                j = {
-                    'Origin function': tck2connectome_cmd,
-                    'Description': 'extract csv connectome',
-                    'Anat_filename': connectome,
-                    'Time' : time.asctime()
-                    }
-                json.dump(j, outfile)
 
-        current_folder = os.path.join(roi_folder,study)
+        todo = [study for study in studies if isForce or not study_done(data_path, subj, sess, study)]
+        for study in studies:
+            if study not in todo:
+                print('Tracts and connectome of study {0} already done'.format(study['name']))
+
+        if todo:
+            #------------------------------------------------------------#
+            #### PARCELLATION WITH THE ROIS OF ALL THE STUDIES #### 
+            #------------------------------------------------------------#
+            print('## MERGE THE ROIS OF STUDIES', ', '.join(study['name'] for study in todo), '##')
+            parc_data, affine, nodes = merged_parcellation(data_path, subj, sess, todo)
+
+            merged, alone = [], []
+            for study in todo:
+                if is_merged_parcellation(parc_data, nodes, parcellation_file(data_path, subj, sess, study), study):
+                    merged.append(study)
+                else:
+                    logging.warning('Rois of study {0} overlap the rois of another study: run on its own parcellation.'.format(study['name']))
+                    alone.append(study)
+
+            if merged:
+                studies_parc = os.path.join(roi_folder, subj + "_" + sess + "_studies_parc.nii.gz")
+                save_image(nib.Nifti1Image(parc_data, affine), studies_parc)
+                extract_studies(tck_file, sift_file, studies_parc, nodes, merged, data_path, subj, sess, roi_folder, 'studies')
+            for study in alone:
+                extract_studies(tck_file, sift_file, parcellation_file(data_path, subj, sess, study), labels(study), [study],
+                                data_path, subj, sess, roi_folder, study['name'])
 
-        # Other metrics 
-        # Munual sum of the wieght
-        #get_sum_of_weights(subj, sess, data_path, tracts, current_folder, isVerbose, isForce)
+        for study in studies:
+            current_folder = study_folder(data_path, subj, sess, study)
 
-        # Summary of sum of the weights
-        tracts_str =[str(tract[0])+ '-'+ str(tract[1]) for tract in tracts]
-        extract_stream_metrics([subj], [sess], data_path, tracts_str, current_folder, isVerbose, isForce)
+            # Other metrics 
+            # Munual sum of the wieght
+            #get_sum_of_weights(subj, sess, data_path, study['pairs'], current_folder, isVerbose, isForce)
+
+            # Summary of sum of the weights
+            tracts_str =[str(tract[0])+ '-'+ str(tract[1]) for tract in study['pairs']]
+            extract_stream_metrics([subj], [sess], data_path, tracts_str, current_folder, isVerbose, isForce)
    
     else:
         raise FileNotFoundError("subj " + subj + ", sess " + sess + " not existing")
@@ -175,26 +293,15 @@ if __name__ == "__main__":
 
     isForce = args.isForce
 
-    if "all" in subj_list:
-        subjects = [s for s in os.listdir(data_path) if os.path.isdir(os.path.join(data_path,'derivatives', '01_dwi', s)) if "sub-51T" in s]
-    else:
-        subjects = ['sub-' + subj for subj in subj_list]
-    
-    
     sess_list = [sess for sess in args.sess]
-    if "all" in sess_list:
-       sessions = ["ses-T1", "ses-T2", "ses-T3", "ses-T4"]
-    else:
-        sessions = ['ses-' + sess for sess in sess_list]
     
-    date = datetime.now()
-    formatted_datetime = date.strftime("%Y-%m-%d-%H-%M-%S")
-    fail_list_filename = f"fail_list_13_dwi_extract_tracts_tckedit{formatted_datetime}.txt"
-    for subj, sess in itertools.product(subjects, sessions):        
-            try:
-                track_extraction(subj, sess, data_path, args.isVerbose, isForce)
-            except Exception as e:
-                with open(fail_list_filename, "+a") as f:
-                    f.write(f"{subj} {sess} \n")
-                    f.write(f"{str(e)} \n")
+    studies = load_studies(args.study)
+
+    script = '13_dwi_extract_tracts_tckedit'
+    manifest = Manifest(data_path)
+    pairs = manifest.select(subj_list, sess_list, 'dwi')
+    if not args.isForce:
+        pairs = manifest.incomplete(script, pairs)
+    for subj, sess in select_sessions(data_path, script, pairs, args.only_failed, args.only_pending):
+        run_step(data_path, script, subj, sess, track_extraction, subj, sess, data_path, studies, args.isVerbose, isForce)
 
@@ -8,19 +8,14 @@ from __future__ import division
 
 import argparse
 import os
-import sys
 import time
-import itertools
 import json
-import subprocess
 import logging
-from datetime import datetime
-import nibabel as nib
-import numpy as np
 
-sys.path.insert(1,'/home/bgrosjea/mnt/Hummel-Data/TI/mri/51T/barbara/uphummel_imaging_template/1_structural-diffusion')
-from tools.tck2conn4stream_measures import * 
-from tools.formate_data import formate_seed_based
+from tools.run_ledger import run_step, select_sessions
+from tools.manifest import Manifest
+from tools.outputs import is_valid, save_txt
+from tools.tck_filter import seed_filter
 
 def buildArgsParser():
     p = argparse.ArgumentParser(
@@ -37,6 +32,12 @@ def buildArgsParser():
     p.add_argument('-f', action='store_true', dest='isForce', 
     help='If set, overwrites output file.')
 
+    sel_g = p.add_argument_group('Selection options')
+    sel_g.add_argument('--only-failed', action='store_true', dest='only_failed',
+        help='If set, only runs the sessions that failed or were skipped (see tools/run_ledger.py).')
+    sel_g.add_argument('--only-pending', action='store_true', dest='only_pending',
+        help='If set, only runs the sessions that were never run or were interrupted.')
+
     log_g = p.add_argument_group('Logging options')
     log_g.add_argument(
         '-v', action='store_true', dest='isVerbose',
@@ -46,7 +47,7 @@ def buildArgsParser():
 
 def seed_based(data_path:str, subj:str, sess:str, isVerbose:bool, isForce:bool): 
     ''' 
-    Track extraction using tckedit 
+    Track extraction of the seeds, all of them from one pass over the tractogram
     '''
     
     tract_folder =  os.path.join(data_path, "derivatives", "01_tracts", subj, sess)
@@ -71,7 +72,14 @@ def seed_based(data_path:str, subj:str, sess:str, isVerbose:bool, isForce:bool):
         dwi_out = os.path.join(session_folder, 'dwi', "proc", subj + "_" + sess)
         tck_file = dwi_out + "_iFOD2.tck"
         sift_file = dwi_out + "_sift.txt"
-        
+
+        # Apply to the tractogram in one pass for all the seeds (tools/tck_filter.py), instead of tckedit -include
+        # and tck2connectome for each seed
+        tck_out_path = os.path.join(seed_folder, 'tracts_tckedit')
+        if not os.path.exists(tck_out_path):
+            os.makedirs(tck_out_path)
+
+        todo = []
         for roi in rois: 
             print('Processing roi :', roi)
 
@@ -82,58 +90,44 @@ def seed_based(data_path:str, subj:str, sess:str, isVerbose:bool, isForce:bool):
                 logging.info('must perform the registration step (11_)')
                 return 
 
-            # Apply to the tractogram with tckedit command
-            tck_out_path = os.path.join(seed_folder, 'tracts_tckedit')
-
-            if not os.path.exists(tck_out_path):
-                os.makedirs(tck_out_path)
-            
             tck_out_file = os.path.join(tck_out_path, subj + "_" + sess + "_" + str(roi) + ".tck")
-            json_out = os.path.join(tck_out_path, subj + "_" + sess + "_" + str(roi) + ".json")
-            include_options =  "-include " + roi_file #"-mask " 
+            sift_outpath = os.path.join(tck_out_path, subj + "_" + sess + "_" + str(roi) + "_sift2.txt")
+            connectome = os.path.join(seed_folder, subj + "_" + sess +"_"+ roi +"_metric.csv")
 
-            if os.path.isfile(tck_out_file) and not isForce:
+            if all(is_valid(f) for f in (tck_out_file, sift_outpath, connectome)) and not isForce:
                 print(f'%s file already existing' %tck_out_file)
-            else:  
-                sift_outpath = os.path.join(tck_out_path, subj + "_" + sess + "_" + str(roi) + "_sift2.txt")
-                tckedit_cmd = "tckedit " + tck_file + " " + tck_out_file + " " + include_options + " -tck_weights_in " + sift_file + " -tck_weights_out " + sift_outpath + ' -force'
-                
-                logging.info('tckedit command: "{0}".'.format(tckedit_cmd))
-                subprocess.call(tckedit_cmd, shell=True)
+            else:
+                todo.append((roi, roi_file, tck_out_file, sift_outpath, connectome))
+
+        if todo:
+            start = time.time()
+            metrics = seed_filter(tck_file, sift_file, [t[1] for t in todo], [t[2] for t in todo], [t[3] for t in todo])
+            resources = {'Command': 'seed_filter', 'Wall time (s)': round(time.time() - start, 3)}
 
-                with open(json_out, 'w') as outfile:
+            for (roi, roi_file, tck_out_file, sift_outpath, connectome), metric in zip(todo, metrics):
+                # Single-node connectome of the seed, as written by tck2connectome
+                save_txt(connectome, [[metric]], fmt='%.10g')
+
+                with open(os.path.join(tck_out_path, subj + "_" + sess + "_" + str(roi) + ".json"), 'w') as outfile:
                     j = {
-                        'Origin function': tckedit_cmd,
-                        'Description': 'Applied rois selection to the tractogram with tckedit command',
+                        'Origin function': 'tools.tck_filter.seed_filter',
+                        'Description': 'Applied rois selection to the tractogram, streamlines with a point in ' + roi_file,
                         'Anat_filename': tck_out_file,
+                        'Resources': resources,
                         'Time' : time.asctime()
                         }
                     json.dump(j, outfile)
 
-            # tck2connectome command         
-            # Ouputs 
-            connectome = os.path.join(seed_folder, subj + "_" + sess +"_"+ roi +"_metric.csv")
-            json_out = os.path.join(seed_folder,  subj + "_" + sess + "_"+ roi +"_metric.json")
-            
-            if os.path.isfile(connectome) and not isForce: 
-                logging.info('connectom already done: "{0}".'.format(connectome))
-            else:
-                tck2connectome_cmd = 'tck2connectome ' + tck_file + ' ' + roi_file + ' ' + connectome + ' -tck_weights_in ' +  sift_file + ' -force' 
-
-                logging.info('tck2connectome command: "{0}".'.format(tck2connectome_cmd))
-                subprocess.call(tck2connectome_cmd, shell=True)
-                
-                with open(json_out, 'w') as outfile:
+                with open(os.path.join(seed_folder,  subj + "_" + sess + "_"+ roi +"_metric.json"), 'w') as outfile:
                     j = {
-                        'Origin function': tck2connectome_cmd,
-                        'Description': 'extract csv connectome',
+                        'Origin function': 'tools.tck_filter.seed_filter',
+                        'Description': 'extract csv connectome, sum of the weights of the streamlines ending in ' + roi_file + ' at both ends',
                         'Anat_filename': connectome,
+                        'Resources': resources,
                         'Time' : time.asctime()
                         }
                     json.dump(j, outfile)
 
-            
-
     else:
         raise FileNotFoundError("subj " + subj + ", sess " + sess + " not existing")
         return
@@ -154,27 +148,13 @@ if __name__ == "__main__":
 
     data_path = args.data_path
 
-    if "all" in subj_list:
-        subjects = [s for s in os.listdir(data_path) if os.path.isdir(os.path.join(data_path,'derivatives', '01_dwi', s)) if "sub-51T" in s]
-    else:
-        subjects = ['sub-' + subj for subj in subj_list]
-    
-    
     sess_list = [sess for sess in args.sess]
-    if "all" in sess_list:
-       sessions = ["ses-T1", "ses-T2", "ses-T3", "ses-T4"]
-    else:
-        sessions = ['ses-' + sess for sess in sess_list]
     
-    date = datetime.now()
-    formatted_datetime = date.strftime("%Y-%m-%d-%H-%M-%S")
-    fail_list_filename = f"fail_list_13_seed_based{formatted_datetime}.txt"
-    for subj, sess in itertools.product(subjects, sessions):        
-            try:
-                seed_based(data_path, subj, sess, args.isVerbose, isForce)
-                
-            except Exception as e:
-                with open(fail_list_filename, "+a") as f:
-                    f.write(f"{subj} {sess} \n")
-                    f.write(f"{str(e)} \n")
+    script = '13_seed_based'
+    manifest = Manifest(data_path)
+    pairs = manifest.select(subj_list, sess_list, 'dwi')
+    if not args.isForce:
+        pairs = manifest.incomplete(script, pairs)
+    for subj, sess in select_sessions(data_path, script, pairs, args.only_failed, args.only_pending):
+        run_step(data_path, script, subj, sess, seed_based, data_path, subj, sess, args.isVerbose, isForce)
     
\ No newline at end of file
@@ -1,16 +1,32 @@
 # The file is used to formate the data used for the statistical analysis analysis. it manipulate csv file. You will find :
 # - formate_seed_based to formate the csv from the seed based that contains one unique value into a matrix.
+# The values of every session are kept in the append-only cohort stores of tools/cohort.py: a run only reads the
+# sessions that are new or were processed again, and writes the tables again when their store changed.
 # - formate_behav to formate the behaviral gain into one vector column.
-# - formate_roi2roi_Pu and formate_roi2roi_Ca to have the connectivity metric of the tract that link the putamen right and the caudate respectively to the rest of the network.
-# - formate_roi2roi_Pu_network to have the connectivity metric for the network selected included the putamen.
+# - formate_connectivity to read the connectomes of a ROI study (roi_analysis/studies, see tools/roi_study.py) of
+#   every subject and session once, into the cohort store of tools/cohort.py.
+# - formate_roi2roi to have the connectivity metric of the pairs of a view of the study from that store, i.e. the
+#   tracts that link the putamen right (Pu) or the caudate right (Ca) to the rest of the network, or the network
+#   selected included the putamen (Pu_net) for fMRI_study.
 
 # Depending call the one needed in the main.
 
+import argparse
+import logging
 import numpy as np
-import tools
 import os
 import pandas as pd
 
+from tools.run_ledger import run_step, runs, is_selected
+from tools.manifest import Manifest
+from tools.outputs import is_valid
+from tools import cohort, roi_study
+
+# Session of the one-row-per-subject tables
+VIEW_SESSION = 'ses-baseline'
+
+SEEDS = ['v_d_Ca_L', 'v_d_Ca_R', 'vm_dl_PU_L', 'vm_dl_PU_R']
+
 def buildArgsParser():
     p = argparse.ArgumentParser(
         description=__doc__, formatter_class=argparse.RawTextHelpFormatter,
@@ -22,10 +38,18 @@ def buildArgsParser():
 
     p.add_argument('--data_path', default='/mnt/Hummel-Data/TI/mri/51T', dest='data_path',
         help="Subjects folder path. ['%(default)s']")
+    p.add_argument('--study', nargs='+', default=['all'], dest='study',
+        help="ROI studies of roi_analysis/studies (name or json file). ['%(default)s']")
 
     p.add_argument('-f', action='store_true', dest='isForce', 
     help='If set, overwrites output file.')
 
+    sel_g = p.add_argument_group('Selection options')
+    sel_g.add_argument('--only-failed', action='store_true', dest='only_failed',
+        help='If set, only runs the formating steps that failed or were skipped (see tools/run_ledger.py).')
+    sel_g.add_argument('--only-pending', action='store_true', dest='only_pending',
+        help='If set, only runs the formating steps that were never run or were interrupted.')
+
     log_g = p.add_argument_group('Logging options')
     log_g.add_argument(
         '-v', action='store_true', dest='isVerbose',
@@ -33,31 +57,24 @@ def buildArgsParser():
     return p
 
     
-def formate_seed_based(subjects:list, sess:str, data_path:str, isForce:bool): 
+def formate_seed_based(subjects:list, sessions:list, data_path:str, isForce:bool): 
 
     print('Formating the seed based data for analysis ...')
     output = os.path.join(data_path, 'derivatives', '01_analysis', 'seed_metric_df.csv')
 
-    if os.path.isfile(output) and not isForce :
+    # Load the seed-based metrics of the sessions that changed into the cohort store
+    store = cohort.seed_metrics(data_path, subjects, sessions, SEEDS, isForce)
+    if cohort.is_view_current(output, cohort.store_file(data_path, 'seed_metrics')) and not isForce :
         print('Formating seed based data already done')
         return 
-    else :
-        # Load the seed-based metrics
-        seeds = ['v_d_Ca_L', 'v_d_Ca_R', 'vm_dl_PU_L', 'vm_dl_PU_R']
-        seed_metric = np.zeros([int(len(subjects)), len(seeds)])
-        for i, sub in enumerate(subjects):
-            folder_path = os.path.join(data_path, 'derivatives', '01_tracts', sub, 'ses-baseline', 'striat') 
-            for j,s in enumerate(seeds):
-                file_name=os.path.join(folder_path, sub + "_ses-baseline_"+ s +"_metric.csv")
-                df = pd.read_csv(file_name)  
-                seed_metric[i, j]=float(df.columns[0])
-
-        dict_= {}
-        for i,s in enumerate(seeds) : 
-            dict_[s] = seed_metric[:,i]
-
-        df = pd.DataFrame(dict_)
-        df.to_csv(output, index=False)
+
+    seed_metric = rows(store, subjects, sessions, 'seed based metric')
+    dict_= {}
+    for i,s in enumerate(SEEDS) : 
+        dict_[s] = seed_metric[:,i]
+
+    df = pd.DataFrame(dict_)
+    df.to_csv(output, index=False)
 
 def formate_behav(subjects:list, data_path:str, isForce:bool):
     # Load behavioral data
@@ -67,7 +84,7 @@ def formate_behav(subjects:list, data_path:str, isForce:bool):
         df_behav = pd.read_csv(file_name) 
 
         output = os.path.join(data_path, 'derivatives', '01_analysis','behav.csv')
-        if os.path.isfile(output) and not isForce :
+        if is_valid(output) and not isForce :
             print('Formating behavioral data already done')
             return 
         else :
@@ -98,147 +115,54 @@ def formate_behav(subjects:list, data_path:str, isForce:bool):
         return 
     
     
-def formate_roi2roi_Pu(subjects:list, sess:str, datapath:str, isForce:bool):
-    print('Formating data for Putamen tract analysis ...')
-    output = os.path.join(data_path, 'derivatives', '01_analysis','Pu.csv')
-
-    label_file = os.path.join(data_path,'sub-51T01', 'ses-baseline','roi2roi', 'fMRI_study','masks', 'sub-51T01_ses-baseline_global_mask.csv')
-    
-    if not os.path.isfile(label_file) : 
-        print('Should provide a label file: ', label_file)
-        return 
-
-    labels_df = pd.read_csv(label_file)
-    labels = np.array(labels_df['roi'])
-
-    to_remove = ['v_d_Ca_L', 'v_d_Ca_R', 'vm_dl_PU_L']
-
-    df_con = pd.DataFrame()
-    for k, sub in enumerate(subjects): 
-        folder_path = os.path.join(data_path,'derivatives', '01_tracts', sub, "ses-baseline",'roi2roi', 'fMRI_study')
-        file_name=os.path.join(folder_path, sub + "_ses-baseline_connect_matrix.csv")
-        if os.path.isfile(file_name) :
-            if os.path.isfile(output) and not isForce :
-                print('Formating data for putamen tracts analysis already done')
-            else : 
-                df = pd.read_csv(file_name)
-                suj = {}
-                for i, row in enumerate(df.to_numpy()):
-                    row = row[0].split(' ')
-                    for j, el in enumerate(row): 
-                        if labels[i] == 'vm_dl_PU_R' or labels[j]== 'vm_dl_PU_R': 
-                            # Remove inter striatum connection
-                            if not (labels[i] in to_remove or labels[j] in to_remove) : 
-                                suj[f'{labels[i]}-{labels[j]}'] = el
-                            
-                if k == 0: df_con = pd.DataFrame(columns = suj.keys())
-                df_con.loc[k] = suj
-        else : 
-            raise FileNotFoundError(file_name + 'not existing')
-            return 
+def rows(store:dict, subjects:list, sessions:list, what:str):
+    ''' Rows of the subjects for VIEW_SESSION in a cohort store, FileNotFoundError if one is missing '''
+    if VIEW_SESSION not in sessions:
+        raise ValueError('No {0} session in the selected sessions {1}.'.format(VIEW_SESSION, ', '.join(sessions)))
+    values = cohort.rows(store, subjects, VIEW_SESSION)
+    missing = [sub for sub, row in zip(subjects, values) if np.isnan(row).any()]
+    if missing:
+        raise FileNotFoundError('No {0} for {1}, session {2}'.format(what, ', '.join(missing), VIEW_SESSION))
+    return values
+
+
+def formate_connectivity(subjects:list, sessions:list, data_path:str, study:dict, isForce:bool):
+    ''' Cohort store of the connectomes of the study (tools/cohort.py), only the new or changed sessions are read '''
+    print('Loading the connectomes of study {0} ...'.format(study['name']))
+    cohort.connectivity(data_path, subjects, sessions, study, isForce)
+
+
+def formate_roi2roi(subjects:list, sessions:list, data_path:str, study:dict, view:str, isForce:bool):
+    ''' Connectivity of the pairs of a view of the study (tools/roi_study.py): the pairs with one of its
+        nodes (i.e. the tracts that link the right putamen to the rest of the network) and none of the
+        excluded rois, one row per subject '''
+    print('Formating data for {0} analysis of study {1} ...'.format(view, study['name']))
+    output = os.path.join(data_path, 'derivatives', '01_analysis', study['views'][view]['output'])
+
+    # Up to date after formate_connectivity: only stats the connectomes
+    store = cohort.connectivity(data_path, subjects, sessions, study)
+    if cohort.is_view_current(output, cohort.store_file(data_path, study['name'] + '_connectivity')) and not isForce :
+        print('Formating data for {0} analysis already done'.format(view))
+        return
+
+    mask = cohort.view_mask(study, view)
+    rows(store, subjects, sessions, 'connectome of study ' + study['name'])
+    values, pairs = cohort.view_table(store, mask, subjects, VIEW_SESSION)
 
     #remove 0 column : 
-    for col in df_con.columns :
-        if not np.any(df_con[col]) : 
-            df_con = df_con.drop(columns=col)
-        
+    nonzero = np.any(values != 0, axis=0)
+    df_con = pd.DataFrame(values[:, nonzero], columns=[pair for pair, keep in zip(pairs, nonzero) if keep])
     df_con.to_csv(output, index=False)
 
-def formate_roi2roi_Ca(subjects:list, sess:str, datapath:str, isForce:bool):
-    print('Formating data for Putamen tract analysis ...')
-    output = os.path.join(data_path, 'derivatives', '01_analysis','Ca.csv')
-
-    # Load the roi2roi metrics
-    label_file = os.path.join(data_path,'sub-51T01', 'ses-baseline','roi2roi', 'fMRI_study','masks', 'sub-51T01_ses-baseline_global_mask.csv')
-    
-    if not os.path.isfile(label_file) : 
-        print('Should provide a label file: ', label_file)
-        return 
-
-    labels_df = pd.read_csv(label_file)
-    labels = np.array(labels_df['roi'])
-    to_remove = ['v_d_Ca_L','vm_dl_PU_L','vm_dl_PU_R']
-
-    df_con = pd.DataFrame()
-    for k, sub in enumerate(subjects): 
-        folder_path = os.path.join(data_path,'derivatives', '01_tracts', sub, "ses-baseline",'roi2roi', 'fMRI_study')
-        file_name=os.path.join(folder_path, sub + "_ses-baseline_connect_matrix.csv")
-        if os.path.isfile(file_name) :
-            if os.path.isfile(output) and not isForce :
-                print('Formating data for caudate tracts analysis already done')
-            else : 
-                df = pd.read_csv(file_name)
-                suj = {}
-                for i, row in enumerate(df.to_numpy()):
-                    row = row[0].split(' ')
-                    for j, el in enumerate(row): 
-                        if labels[i] == 'v_d_Ca_R' or labels[j]== 'v_d_Ca_R': 
-                            # Remove inter striatum connection
-                            if not (labels[i] in to_remove or labels[j] in to_remove) : 
-                                suj[f'{labels[i]}-{labels[j]}'] = el
-                            
-                if k == 0: df_con = pd.DataFrame(columns = suj.keys())
-                df_con.loc[k] = suj
-        else : 
-            raise FileNotFoundError(file_name + 'not existing')
-            return 
 
-    #remove 0 column : 
-    for col in df_con.columns :
-        if not np.any(df_con[col]) : 
-            df_con = df_con.drop(columns=col)
-        
-
-    df_con.to_csv(output, index=False)
-
-def formate_roi2roi_Pu_net(subjects:list, sess:str, datapath:str, isForce:bool):
-    print('Formating data for Putamen tract analysis ...')
-    output = os.path.join(data_path, 'derivatives', '01_analysis','Pu_network.csv')
-    
-    # Load the roi2roi metrics
-    label_file = os.path.join(data_path,'sub-51T01', 'ses-baseline','roi2roi', 'fMRI_study','masks', 'sub-51T01_ses-baseline_global_mask.csv')
-    
-    if not os.path.isfile(label_file) : 
-        print('Should provide a label file: ', label_file)
-        return 
-
-    labels_df = pd.read_csv(label_file)
-    labels = np.array(labels_df['roi'])
-    to_remove = ['v_d_Ca_L', 'v_d_Ca_R', 'vm_dl_PU_L']
-
-    df_con = pd.DataFrame()
-    for k, sub in enumerate(subjects): 
-        folder_path = os.path.join(data_path,'derivatives', '01_tracts', sub, "ses-baseline",'roi2roi', 'fMRI_study')
-        file_name=os.path.join(folder_path, sub + "_ses-baseline_connect_matrix.csv")
-
-        if os.path.isfile(file_name) :
-            if os.path.isfile(output) and not isForce :
-                print('Formating data for putamen network analysis already done')
-                 
-            else : 
-                df = pd.read_csv(file_name)
-                suj = {}
-                for i, row in enumerate(df.to_numpy()):
-                    row = row[0].split(' ')
-                    for j, el in enumerate(row): 
-                        # Remove inter striatum connection
-                        if not (labels[i] in to_remove or labels[j] in to_remove) : 
-                            suj[f'{labels[i]}-{labels[j]}'] = el
-        
-                if k == 0: df_con = pd.DataFrame(columns = suj.keys())
-                df_con.loc[k] = suj
-                
-        else : 
-            raise FileNotFoundError(file_name + 'not existing')
-            return 
-
-    #remove 0 column : 
-    for col in df_con.columns :
-        if not np.any(df_con[col]) : 
-            df_con = df_con.drop(columns=col)
-                
-    df_con.to_csv(output, index=False)
-            
+def cohort_steps(studies:list):
+    ''' (ledger step, function, arguments after subjects, sessions and data_path) of the formating steps '''
+    steps = [('formate_seed_based', formate_seed_based, ())]
+    for study in studies:
+        steps.append(('formate_connectivity_' + study['name'], formate_connectivity, (study,)))
+        for view in study['views']:
+            steps.append(('formate_roi2roi_' + view, formate_roi2roi, (study, view)))
+    return steps
             
 
 if __name__ == "__main__":
@@ -256,30 +180,19 @@ if __name__ == "__main__":
 
     data_path = args.data_path
 
-    if "all" in subj_list:
-        subjects = [s for s in os.listdir(data_path) if os.path.isdir(os.path.join(data_path,'derivatives', '01_dwi', s)) if "sub-51T" in s]
-    else:
-        subjects = ['sub-' + subj for subj in subj_list]
-    
-    
     sess_list = [sess for sess in args.sess]
-    if "all" in sess_list:
-       sessions = ["ses-T1", "ses-T2", "ses-T3", "ses-T4"]
-    else:
-        sessions = ['ses-' + sess for sess in sess_list]
-    
-    date = datetime.now()
-    formatted_datetime = date.strftime("%Y-%m-%d-%H-%M-%S")
-    fail_list_filename = f"fail_list_13_seed_based{formatted_datetime}.txt"
-    for subj, sess in itertools.product(subjects, sessions):        
-            try:
-                formate_seed_based(subj_list, sess_list[0], data_path, isForce)
-                formate_roi2roi_Pu(subj_list,sess_list[0], data_path, isForce)
-                formate_roi2roi_Ca(subj_list,sess_list[0], data_path, isForce)
-                formate_roi2roi_Pu_net(subj_list,sess_list[0], data_path, isForce)
-                
-            except Exception as e:
-                with open(fail_list_filename, "+a") as f:
-                    f.write(f"{subj} {sess} \n")
-                    f.write(f"{str(e)} \n")
-    
\ No newline at end of file
+
+    # The formating functions read every subject and session of the cohort with dwi data
+    pairs = Manifest(data_path).select(subj_list, sess_list, 'dwi')
+    subjects = sorted(set(subj for subj, _ in pairs))
+    sessions = sorted(set(sess for _, sess in pairs))
+
+    # Cohort steps: each one reads every subject, they are recorded in the ledger once for the whole cohort
+    script = '14_formate_data'
+    status = {}
+    for row in runs(data_path, script):
+        status.setdefault(row['step'], []).append(row['status'])
+    for step, function, step_args in cohort_steps(roi_study.load_studies(args.study)):
+        if is_selected(status.get(step, []), args.only_failed, args.only_pending):
+            run_step(data_path, script, 'cohort', sess_list[0], function, subjects, sessions, data_path, *step_args, isForce,
+                     step=step)
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Single entry point of the pipeline, the "dwi" command of the package (pip install -e 1_structural-diffusion):
+#
+#     dwi preprocessing --subj 51T01 --sess baseline
+#     dwi 06_dwi_processing --subj all --sess all --only-failed
+#     dwi ledger --status failed
+#
+# A step is the numbered script of its name or alias (STEPS), run in this process as __main__ with the
+# remaining arguments, i.e. its own options (dwi <step> -h). The dispatcher only imports the standard
+# library and a step only imports the modules it uses (nibabel, pandas... are not loaded by the steps that
+# only run external tools): a worker process started per session by a scheduler starts in milliseconds.
+# The tools with a command line (TOOLS) are run the same way.
+#
+#     python -m tools.cli -h
+
+import os
+import runpy
+import sys
+
+PIPELINE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Alias -> numbered script, relative to PIPELINE_DIR. The script name (without .py) is accepted as well.
+STEPS = {
+    'copy': '01_copy_data_locally.py',
+    'preprocessing': '02_dwi_preprocessing.py',
+    'lesion-transplantation': '03_lesionTransplantation_anat.py',
+    'freesurfer': '04_freesurfer.py',
+    'anat-registration': '05_anat_registration_dwi.py',
+    'lesion-registration': '05_lesion_registration.py',
+    'mni-registration': '05_T1w2MNI_reg.py',
+    'dwi-processing': '06_dwi_processing.py',
+    'scalar-maps': '06_compute_scalar_maps.py',
+    'group-maps': '07_group_maps.py',
+    'registration-qc': '08_registration_qc.py',
+    'register-rois': 'roi_analysis/11_register_rois_MNI2B0.py',
+    'create-parc': 'roi_analysis/12_create_parc.py',
+    'extract-tracts': 'roi_analysis/13_dwi_extract_tracts_tckedit.py',
+    'seed-based': 'roi_analysis/13_seed_based.py',
+    'formate-data': 'roi_analysis/14_formate_data.py',
+}
+
+# Alias -> module of the tools with a command line
+TOOLS = {
+    'manifest': 'tools.manifest',
+    'ledger': 'tools.run_ledger',
+    'resources': 'tools.resource_report',
+    'retention': 'tools.retention',
+}
+
+
+def usage():
+    lines = ['usage: dwi <step> [options of the step]', '', 'steps:']
+    lines += ['  {0:24} {1}'.format(alias, script) for alias, script in STEPS.items()]
+    lines += ['', 'tools:']
+    lines += ['  {0:24} {1}'.format(alias, module) for alias, module in TOOLS.items()]
+    lines += ['', 'dwi <step> -h prints the options of a step.']
+    return '\n'.join(lines)
+
+
+def resolve(name:str):
+    ''' ('script', path) or ('module', name) of a step or tool, None if it is unknown '''
+    if name in TOOLS:
+        return 'module', TOOLS[name]
+    scripts = {os.path.splitext(os.path.basename(script))[0]: script for script in STEPS.values()}
+    script = STEPS.get(name) or scripts.get(os.path.splitext(name)[0])
+    if script is None:
+        return None
+    return 'script', os.path.join(PIPELINE_DIR, script)
+
+
+def main(argv:list=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if not argv or argv[0] in ('-h', '--help'):
+        print(usage())
+        return 0 if argv else 2
+
+    target = resolve(argv[0])
+    if target is None:
+        print('dwi: unknown step "{0}"\n\n{1}'.format(argv[0], usage()), file=sys.stderr)
+        return 2
+
+    kind, name = target
+    if kind == 'module':
+        sys.argv = [argv[0]] + argv[1:]
+        runpy.run_module(name, run_name='__main__', alter_sys=True)
+    else:
+        sys.argv = [name] + argv[1:]
+        runpy.run_path(name, run_name='__main__')
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Cohort stores of the formating steps of roi_analysis/14_formate_data.py: the values of every subject and
+# session (the connectome of a ROI study, the metrics of the seeds...) in one (subjects x sessions x ...)
+# array, saved in derivatives/01_analysis/<name>.npz with the subjects, sessions and labels of its axes.
+# A missing session is NaN.
+# The store is append-only: a new subject or session adds its row, and each row records the hash of the
+# files it was read from (and their size and mtime, so that an unchanged session costs a stat). A formating
+# run only reads the sessions that landed or were processed again since the last one; the tables of
+# 14_formate_data are views of the store, written again when it changed.
+# A view of a ROI study (tools/roi_study.py) is a boolean N x N mask over the connectivity array, its table
+# one column per pair of the mask: the Pu, Ca and Pu_net outputs of fMRI_study come from the same store.
+
+import hashlib
+import logging
+import os
+
+import numpy as np
+
+from tools import roi_study
+from tools.outputs import is_valid, tmp_path, commit
+
+ANALYSIS_FOLDER = os.path.join('derivatives', '01_analysis')
+
+# Stores loaded in this process, by file: (mtime, store)
+_LOADED = {}
+
+
+def store_file(data_path:str, name:str):
+    return os.path.join(data_path, ANALYSIS_FOLDER, name + '.npz')
+
+
+def save_store(filename:str, store:dict):
+    ''' np.savez through a temporary file '''
+    if not os.path.exists(os.path.dirname(filename)):
+        os.makedirs(os.path.dirname(filename))
+    tmp_file = tmp_path(filename)
+    try:
+        np.savez(tmp_file, **store)
+        commit(tmp_file, filename)
+    finally:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+    _LOADED[filename] = (os.path.getmtime(filename), store)
+
+
+def load_store(filename:str):
+    ''' Arrays of a store, read once per process unless the file changed '''
+    mtime = os.path.getmtime(filename)
+    if filename not in _LOADED or _LOADED[filename][0] != mtime:
+        with np.load(filename) as f:
+            _LOADED[filename] = (mtime, {key: f[key] for key in f.files})
+    return _LOADED[filename][1]
+
+
+def empty_store(labels:list, shape:tuple):
+    return {'subjects': np.array([], dtype=str), 'sessions': np.array([], dtype=str),
+            'labels': np.array(labels, dtype=str), 'values': np.full((0, 0) + shape, np.nan),
+            'sources': np.full((0, 0), '', dtype='U40'), 'stats': np.zeros((0, 0, 2))}
+
+
+def append_axes(store:dict, subjects:list, sessions:list):
+    ''' Add the rows of the subjects and sessions not in the store yet, returns whether any was added '''
+    new_subjects = [s for s in subjects if s not in store['subjects']]
+    new_sessions = [s for s in sessions if s not in store['sessions']]
+    if not new_subjects and not new_sessions:
+        return False
+    pad = [(0, len(new_subjects)), (0, len(new_sessions))]
+    store['subjects'] = np.append(store['subjects'], new_subjects).astype(str)
+    store['sessions'] = np.append(store['sessions'], new_sessions).astype(str)
+    store['values'] = np.pad(store['values'], pad + [(0, 0)] * (store['values'].ndim - 2), constant_values=np.nan)
+    store['sources'] = np.pad(store['sources'], pad, constant_values='')
+    store['stats'] = np.pad(store['stats'], pad + [(0, 0)])
+    return True
+
+
+def file_stats(files:list):
+    ''' (total size, latest mtime) of the files, None if one is missing '''
+    try:
+        stats = [os.stat(f) for f in files]
+    except FileNotFoundError:
+        return None
+    return [sum(s.st_size for s in stats), max(s.st_mtime for s in stats)]
+
+
+def file_hash(files:list):
+    digest = hashlib.sha1()
+    for f in files:
+        with open(f, 'rb') as src:
+            digest.update(src.read())
+    return digest.hexdigest()
+
+
+def update_store(filename:str, subjects:list, sessions:list, labels:list, shape:tuple, sources, read,
+                 isForce:bool=False):
+    ''' Store with the rows of the subjects and sessions up to date, only the changed ones read again
+
+        Parameters
+        ----------
+        filename :
+            Store file (store_file)
+        subjects, sessions :
+            Rows to bring up to date, the other rows of the store are kept as they are
+        labels, shape :
+            Labels of the values and shape of the values of a session, the store is built again if they change
+        sources :
+            sources(subj, sess): files the values of a session are read from
+        read :
+            read(subj, sess): values of a session, an array of shape
+        isForce :
+            If set, the sessions of subjects and sessions are read again, changed or not
+    '''
+    store = None
+    if is_valid(filename):
+        store = {key: value.copy() for key, value in load_store(filename).items()}
+        if 'sources' not in store or list(store['labels']) != list(labels) or store['values'].shape[2:] != tuple(shape):
+            logging.info('{0}: labels changed, built again.'.format(filename))
+            store = None
+    if store is None:
+        store = empty_store(labels, tuple(shape))
+    changed = append_axes(store, subjects, sessions)
+
+    subject_index = {s: i for i, s in enumerate(store['subjects'])}
+    session_index = {s: j for j, s in enumerate(store['sessions'])}
+    read_count = 0
+    for subj in subjects:
+        for sess in sessions:
+            i, j = subject_index[subj], session_index[sess]
+            files = sources(subj, sess)
+            stats = file_stats(files)
+            if stats is None:
+                if store['sources'][i, j]:
+                    store['values'][i, j], store['sources'][i, j], store['stats'][i, j] = np.nan, '', 0
+                    changed = True
+                continue
+            if store['sources'][i, j] and list(store['stats'][i, j]) == stats and not isForce:
+                continue
+            digest = file_hash(files)
+            if digest != store['sources'][i, j] or isForce:
+                store['values'][i, j] = read(subj, sess)
+                store['sources'][i, j] = digest
+                read_count += 1
+            store['stats'][i, j] = stats
+            changed = True
+
+    logging.info('{0}: {1} of {2} sessions read.'.format(filename, read_count, len(subjects) * len(sessions)))
+    if changed:
+        save_store(filename, store)
+    return store
+
+
+def rows(store:dict, subjects:list, sess:str):
+    ''' Values of the subjects for a session, in the order of subjects '''
+    subject_index = {s: i for i, s in enumerate(store['subjects'])}
+    j = list(store['sessions']).index(sess)
+    return store['values'][[subject_index[s] for s in subjects], j]
+
+
+def is_view_current(output:str, filename:str):
+    ''' Whether a table written from a store is valid and not older than the store '''
+    return is_valid(output) and os.path.getmtime(output) >= os.path.getmtime(filename)
+
+
+def connectivity(data_path:str, subjects:list, sessions:list, study:dict, isForce:bool=False):
+    ''' Store of the connectomes of the study (13_dwi_extract_tracts_tckedit.py) '''
+    labels = roi_study.labels(study)
+
+    def read(subj, sess):
+        file_name = roi_study.connectome_file(data_path, subj, sess, study)
+        matrix = np.loadtxt(file_name, ndmin=2)
+        if matrix.shape != (len(labels), len(labels)):
+            raise ValueError('"{0}" is a {1} matrix, study {2} has {3} rois.'.format(
+                file_name, matrix.shape, study['name'], len(labels)))
+        return matrix
+
+    return update_store(store_file(data_path, study['name'] + '_connectivity'), subjects, sessions, labels,
+                        (len(labels), len(labels)),
+                        lambda subj, sess: [roi_study.connectome_file(data_path, subj, sess, study)], read, isForce)
+
+
+def seed_metric_file(data_path:str, subj:str, sess:str, seed:str):
+    return os.path.join(roi_study.tract_folder(data_path, subj, sess), 'striat', subj + "_" + sess + "_" + seed + "_metric.csv")
+
+
+def seed_metrics(data_path:str, subjects:list, sessions:list, seeds:list, isForce:bool=False):
+    ''' Store of the metric of the seeds (13_seed_based.py), the single value of each metric csv '''
+
+    def read(subj, sess):
+        values = []
+        for seed in seeds:
+            with open(seed_metric_file(data_path, subj, sess, seed)) as f:
+                values.append(float(f.readline().split(',')[0]))
+        return values
+
+    return update_store(store_file(data_path, 'seed_metrics'), subjects, sessions, seeds, (len(seeds),),
+                        lambda subj, sess: [seed_metric_file(data_path, subj, sess, seed) for seed in seeds], read, isForce)
+
+
+def view_mask(study:dict, view:str):
+    ''' Pairs (i, j) of the connectivity matrix in a view: one of its nodes (any roi if none) and no excluded roi '''
+    labels = np.array(roi_study.labels(study))
+    nodes, exclude = study['views'][view]['nodes'], study['views'][view]['exclude']
+    selected = np.isin(labels, nodes) if nodes else np.ones(len(labels), dtype=bool)
+    kept = ~np.isin(labels, exclude)
+    return (selected[:, None] | selected[None, :]) & kept[:, None] & kept[None, :]
+
+
+def view_table(store:dict, mask, subjects:list, sess:str):
+    ''' Values of the pairs of mask for the session, one row per subject, and the "roi-roi" names of the columns '''
+    labels = store['labels']
+    pair_rows, pair_cols = np.nonzero(mask)
+    return (rows(store, subjects, sess)[:, pair_rows, pair_cols],
+            ['{0}-{1}'.format(labels[r], labels[c]) for r, c in zip(pair_rows, pair_cols)])
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Run the external commands of the pipeline (FSL, ANTs, MRtrix, FreeSurfer) and measure what they cost.
+# The child is reaped with os.wait4, whose rusage covers the child and every descendant it waited for
+# (the shell, the tool and its own sub-processes): CPU times are summed over the tree, the max RSS is
+# the largest single process of the tree and the I/O is the block I/O of the tree (reads served by
+# the page cache are not counted). The returned dict is stored under 'Resources' in the sidecar json
+# and aggregated over the cohort by tools/resource_report.py.
+#
+# A command that exits with a non-zero status or does not write its expected outputs raises a
+# CommandError carrying the end of its stderr, so that the rest of the session is not run on missing
+# inputs (see tools/run_ledger.py for the skipping of the dependent steps). The outputs are written to
+# temporary names and only renamed once the command succeeded and they are valid (see tools/outputs.py).
+
+import collections
+import logging
+import os
+import subprocess
+import sys
+import time
+
+from tools.outputs import redirect_outputs, commit_outputs, discard_outputs
+
+RESOURCE_KEYS = ['Wall time (s)', 'User time (s)', 'System time (s)', 'Max RSS (MB)', 'Read (MB)', 'Written (MB)']
+STDERR_LINES = 50
+
+# Outputs checked by run_cmd, emptied by tools/run_ledger.py before each step to record what the step wrote
+OUTPUTS = []
+
+
+class CommandError(RuntimeError):
+    ''' External command that failed or did not write its outputs '''
+
+    def __init__(self, cmd:str, returncode:int, stderr:str='', missing:list=()):
+        self.cmd = cmd
+        self.returncode = returncode
+        self.stderr = stderr
+        self.missing = list(missing)
+        if returncode:
+            message = '{0} exited with status {1}'.format(command_name(cmd), returncode)
+        else:
+            message = '{0} did not write a valid {1}'.format(command_name(cmd), ', '.join(self.missing))
+        if stderr:
+            message += '\n' + stderr
+        super().__init__(message)
+
+
+def command_name(cmd:str):
+    ''' Executable of a shell command (i.e. "eddy_openmp", "antsRegistrationSyN.sh") '''
+    words = cmd.split()
+    if words and words[0] in ('bash', 'sh', 'python', 'python3') and len(words) > 1:
+        words = words[1:]
+    return os.path.basename(words[0]) if words else ''
+
+
+def run_cmd(cmd:str, outputs:list=(), check:bool=True):
+    ''' Run a shell command, measure its resource usage and check that it succeeded
+
+        Parameters
+        ----------
+        cmd :
+            Command line, run with shell=True like the subprocess.call it replaces
+        outputs :
+            Files the command must have written, written to temporary names and renamed on success
+        check :
+            If set, raises a CommandError when the command fails or an output is missing or not valid
+
+        Returns
+        ----------
+        dict with the executable name, wall/user/system time, max RSS, block I/O and return code
+    '''
+    folders, redirected = set(), []
+    if check and outputs:
+        cmd, folders, redirected = redirect_outputs(cmd, outputs)
+
+    start = time.time()
+    process = subprocess.Popen(cmd, shell=True, stderr=subprocess.PIPE)
+
+    # stderr is still shown as the command runs, only its end is kept for the error
+    stderr_tail = collections.deque(maxlen=STDERR_LINES)
+    for line in process.stderr:
+        line = line.decode(errors='replace')
+        sys.stderr.write(line)
+        stderr_tail.append(line)
+    process.stderr.close()
+
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    wall = time.time() - start
+
+    resources = {
+        'Command': command_name(cmd),
+        'Wall time (s)': round(wall, 3),
+        'User time (s)': round(usage.ru_utime, 3),
+        'System time (s)': round(usage.ru_stime, 3),
+        'Max RSS (MB)': round(usage.ru_maxrss / 1024, 1),  # kB on Linux
+        'Read (MB)': round(usage.ru_inblock * 512 / 1024 ** 2, 1),  # 512 bytes blocks
+        'Written (MB)': round(usage.ru_oublock * 512 / 1024 ** 2, 1),
+        'Return code': process.returncode,
+        }
+    logging.info('{0}: {1:.1f} s wall, {2:.1f} s cpu, {3:.0f} MB max RSS.'.format(
+        resources['Command'], wall, usage.ru_utime + usage.ru_stime, resources['Max RSS (MB)']))
+
+    if check:
+        if process.returncode:
+            discard_outputs(folders)
+            missing = []
+        else:
+            missing = commit_outputs(folders, redirected, outputs)
+        if process.returncode or missing:
+            raise CommandError(cmd, process.returncode, ''.join(stderr_tail).strip(), missing)
+        OUTPUTS.extend(outputs)
+    return resources
+
+
+def merge_resources(*resources):
+    ''' Resources of several commands written to the same sidecar: summed times and I/O, largest RSS '''
+    resources = [r for r in resources if r]
+    if not resources:
+        return {}
+    merged = {'Command': ' + '.join(r['Command'] for r in resources)}
+    for key in RESOURCE_KEYS:
+        values = [r[key] for r in resources]
+        merged[key] = round(max(values) if key == 'Max RSS (MB)' else sum(values), 3)
+    merged['Return code'] = next((r['Return code'] for r in resources if r['Return code']), 0)
+    return merged
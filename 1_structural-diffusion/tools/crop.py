@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Crop images to a padded bounding box of the brain mask and pad them back to the original grid.
+# The affine of the cropped image is shifted by the first voxel of the box so that the
+# world coordinates of every voxel are unchanged (tractograms stay valid in both grids).
+
+from __future__ import division
+
+import logging
+import numpy as np
+import nibabel as nib
+from tools.outputs import save_image
+
+
+def bounding_box(mask_file:str, padding:int=5):
+    ''' Padded bounding box of the non-zero voxels of a mask
+
+        Parameters
+        ----------
+        mask_file :
+            Brain mask (or brain extracted image)
+        padding :
+            Number of voxels added on each side of the box
+
+        Returns
+        ----------
+        List of [start, stop] for the three spatial axes
+    '''
+    mask = np.asanyarray(nib.load(mask_file).dataobj)
+    if mask.ndim > 3:
+        mask = mask[..., 0]
+    if not np.any(mask):
+        raise ValueError('Empty mask: ' + mask_file)
+
+    bbox = []
+    for axis in range(3):
+        other_axes = tuple(a for a in range(3) if a != axis)
+        nonzero = np.flatnonzero(np.any(mask, axis=other_axes))
+        bbox.append([int(max(nonzero[0] - padding, 0)), int(min(nonzero[-1] + 1 + padding, mask.shape[axis]))])
+    return bbox
+
+
+def cropped_affine(affine:np.ndarray, bbox:list):
+    ''' Affine of the cropped grid: same rotation/zooms, origin moved to the first voxel of the box '''
+    shift = np.eye(4)
+    shift[:3, 3] = [start for start, _ in bbox]
+    return affine @ shift
+
+
+def crop_image(in_file:str, out_file:str, bbox:list):
+    ''' Crop the spatial axes of an image (3D or 4D) to the bounding box '''
+    img = nib.load(in_file)
+    slicer = tuple(slice(start, stop) for start, stop in bbox)
+    data = np.asanyarray(img.dataobj)[slicer]
+
+    out = nib.Nifti1Image(data, cropped_affine(img.affine, bbox), img.header)
+    out.set_sform(out.affine, code=int(img.header['sform_code']) or 1)
+    out.set_qform(out.affine, code=int(img.header['qform_code']) or 1)
+    save_image(out, out_file)
+    logging.info('Cropped "{0}" from {1} to {2}.'.format(in_file, img.shape[:3], data.shape[:3]))
+
+
+def uncrop_image(in_file:str, out_file:str, ref_file:str):
+    ''' Pad a cropped image back to the grid of the reference image (zeros outside the box) '''
+    img = nib.load(in_file)
+    ref = nib.load(ref_file)
+
+    # Position of the first cropped voxel in the reference grid, must be an exact voxel shift
+    offset = (np.linalg.inv(ref.affine) @ img.affine)[:3, 3]
+    start = np.round(offset).astype(int)
+    if not np.allclose(offset, start, atol=1e-3) or not np.allclose(img.affine[:3, :3], ref.affine[:3, :3]):
+        raise ValueError('"{0}" is not a crop of the grid of "{1}".'.format(in_file, ref_file))
+
+    data = np.asanyarray(img.dataobj)
+    padded = np.zeros(ref.shape[:3] + data.shape[3:], dtype=data.dtype)
+    slicer = tuple(slice(s, s + n) for s, n in zip(start, data.shape[:3]))
+    padded[slicer] = data
+
+    out = nib.Nifti1Image(padded, ref.affine, img.header)
+    out.set_sform(ref.affine, code=int(img.header['sform_code']) or 1)
+    out.set_qform(ref.affine, code=int(img.header['qform_code']) or 1)
+    save_image(out, out_file)
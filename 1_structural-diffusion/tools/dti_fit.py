@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# In-process diffusion tensor fitting, used by 06_compute_scalar_maps.py in place of FSL dtifit.
+# The design matrix is built once from the .bval/.bvec files, the masked voxels are split into
+# chunks and every chunk is fitted (vectorised) by a worker of a joblib pool.
+# Outputs follow the dtifit naming: <out_base>_FA.nii.gz, _MD, _AD, _RD, _L1-3, _V1-3, _S0.
+
+from __future__ import division
+
+import logging
+import numpy as np
+import nibabel as nib
+from joblib import Parallel, delayed
+from tools.outputs import save_image
+
+# Lower bound on the signal before taking the log and on the eigenvalues (mm^2/s)
+MIN_SIGNAL = 1e-6
+MIN_DIFFUSIVITY = 1e-10
+
+
+def design_matrix(bvals:np.ndarray, bvecs:np.ndarray):
+    ''' Build the log-linear design matrix of the tensor model
+        log(S) = log(S0) - b * g^T D g
+
+        Parameters
+        ----------
+        bvals :
+            b-values, shape (n_vol,)
+        bvecs :
+            gradient directions (FSL convention), shape (3, n_vol)
+
+        Returns
+        ----------
+        Design matrix of shape (n_vol, 7), columns Dxx, Dyy, Dzz, Dxy, Dxz, Dyz, log(S0)
+    '''
+    gx, gy, gz = bvecs
+    return np.stack([-bvals * gx * gx, -bvals * gy * gy, -bvals * gz * gz,
+                     -2 * bvals * gx * gy, -2 * bvals * gx * gz, -2 * bvals * gy * gz,
+                     np.ones(len(bvals))], axis=1)
+
+
+def _fit_chunk(signal:np.ndarray, design:np.ndarray, method:str):
+    ''' Fit the tensor on a chunk of voxels, signal shape (n_vox, n_vol) '''
+    log_signal = np.log(np.maximum(signal, MIN_SIGNAL))
+
+    # Ordinary least squares for every voxel at once
+    coef = log_signal @ np.linalg.pinv(design).T
+
+    if method == 'wls':
+        # Weighted least squares with weights = predicted signal squared (Salvador et al. 2005)
+        w = np.exp(2 * (coef @ design.T))
+        btwb = np.einsum('ni,vn,nj->vij', design, w, design)
+        btwy = np.einsum('ni,vn,vn->vi', design, w, log_signal)
+        try:
+            coef = np.linalg.solve(btwb, btwy[..., None])[..., 0]
+        except np.linalg.LinAlgError:
+            logging.info('Singular WLS system in chunk, keeping the OLS estimate.')
+
+    tensor = np.empty((len(coef), 3, 3))
+    tensor[:, 0, 0] = coef[:, 0]
+    tensor[:, 1, 1] = coef[:, 1]
+    tensor[:, 2, 2] = coef[:, 2]
+    tensor[:, 0, 1] = tensor[:, 1, 0] = coef[:, 3]
+    tensor[:, 0, 2] = tensor[:, 2, 0] = coef[:, 4]
+    tensor[:, 1, 2] = tensor[:, 2, 1] = coef[:, 5]
+
+    # eigh returns ascending eigenvalues, dtifit convention is L1 >= L2 >= L3
+    evals, evecs = np.linalg.eigh(tensor)
+    evals = np.maximum(evals[:, ::-1], MIN_DIFFUSIVITY)
+    evecs = evecs[:, :, ::-1]
+
+    return evals, evecs, np.exp(coef[:, 6])
+
+
+def scalar_maps(evals:np.ndarray):
+    ''' Compute FA, MD, AD and RD from sorted eigenvalues of shape (n_vox, 3) '''
+    md = evals.mean(axis=1)
+    norm = np.sqrt((evals ** 2).sum(axis=1))
+    fa = np.sqrt(1.5 * ((evals - md[:, None]) ** 2).sum(axis=1)) / np.maximum(norm, MIN_DIFFUSIVITY)
+    return {'FA': fa, 'MD': md, 'AD': evals[:, 0], 'RD': evals[:, 1:].mean(axis=1)}
+
+
+def fit_tensor(dwi_file:str, bval_file:str, bvec_file:str, mask_file:str, out_base:str,
+               method:str='wls', n_jobs:int=-1, chunk_size:int=20000):
+    ''' Fit the diffusion tensor on all masked voxels and write the scalar maps
+
+        Parameters
+        ----------
+        dwi_file :
+            4D preprocessed dwi
+        bval_file :
+            b-values file (FSL format)
+        bvec_file :
+            b-vectors file (FSL format)
+        mask_file :
+            Brain mask, every non-zero voxel is fitted (i.e. the mean-b0 bet file)
+        out_base :
+            Output prefix, "_FA.nii.gz", "_MD.nii.gz", ... are appended
+        method :
+            "ols" for ordinary or "wls" for weighted least squares
+        n_jobs :
+            Number of worker processes (-1: all cores)
+        chunk_size :
+            Number of voxels fitted per task
+
+        Returns
+        ----------
+        List of the written files
+    '''
+    dwi = nib.load(dwi_file)
+    bvals = np.loadtxt(bval_file).ravel()
+    bvecs = np.loadtxt(bvec_file).reshape(3, -1)
+    mask = np.asanyarray(nib.load(mask_file).dataobj) > 0
+
+    if len(bvals) != dwi.shape[3] or bvecs.shape[1] != dwi.shape[3]:
+        raise ValueError('bvals/bvecs do not match the number of volumes of ' + dwi_file)
+
+    design = design_matrix(bvals, bvecs)
+    signal = np.asarray(dwi.dataobj, dtype=np.float32)[mask]
+    logging.info('Tensor fit ({0}) on {1} voxels.'.format(method, len(signal)))
+
+    chunks = [signal[i:i + chunk_size] for i in range(0, len(signal), chunk_size)]
+    results = Parallel(n_jobs=n_jobs)(delayed(_fit_chunk)(chunk, design, method) for chunk in chunks)
+
+    evals = np.concatenate([r[0] for r in results])
+    evecs = np.concatenate([r[1] for r in results])
+    s0 = np.concatenate([r[2] for r in results])
+
+    maps = scalar_maps(evals)
+    for i in range(3):
+        maps['L' + str(i + 1)] = evals[:, i]
+        maps['V' + str(i + 1)] = evecs[:, :, i]
+    maps['S0'] = s0
+
+    out_files = []
+    for name, values in maps.items():
+        vol = np.zeros(mask.shape + values.shape[1:], dtype=np.float32)
+        vol[mask] = values
+        img = nib.Nifti1Image(vol, dwi.affine, dwi.header)
+        img.set_data_dtype(np.float32)
+        img.header.set_slope_inter(1, 0)
+        out_file = out_base + "_" + name + ".nii.gz"
+        save_image(img, out_file)
+        out_files.append(out_file)
+
+    return out_files
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Shell selection for multi-shell dwi: the tensor model is only valid at low b, so the scalar maps
+# are fitted on a cached subset of the preprocessed dwi (b0 + shells up to bmax) instead of the
+# whole multi-shell file used by msmt_csd.
+
+from __future__ import division
+
+import json
+import logging
+import os
+import time
+import numpy as np
+import nibabel as nib
+from tools.outputs import is_valid, save_image, save_txt
+
+
+def select_volumes(bvals:np.ndarray, bmax:float, shell_tolerance:float=50):
+    ''' Indices of the volumes with b <= bmax (+ tolerance for the jitter of the shells) '''
+    return np.flatnonzero(bvals <= bmax + shell_tolerance)
+
+
+def low_b_subset(dwi_file:str, bval_file:str, bvec_file:str, out_base:str, bmax:float,
+                 shell_tolerance:float=50, isForce:bool=False):
+    ''' Write (once) the low-b subset of a dwi with its matching bvals/bvecs
+
+        Parameters
+        ----------
+        dwi_file :
+            4D preprocessed dwi
+        bval_file :
+            b-values file (FSL format)
+        bvec_file :
+            b-vectors file (FSL format)
+        out_base :
+            Prefix of the cached subset, ".nii.gz", ".bval", ".bvec" and ".json" are appended
+        bmax :
+            Highest b-value kept
+        shell_tolerance :
+            Tolerance added to bmax to keep the whole shell
+        isForce :
+            Boolean indicating if the cache has to be rebuilt
+
+        Returns
+        ----------
+        (dwi, bval, bvec) files to use: the cached subset, or the input files if every
+        volume is already below bmax
+    '''
+    bvals = np.loadtxt(bval_file).ravel()
+    keep = select_volumes(bvals, bmax, shell_tolerance)
+
+    if len(keep) == len(bvals):
+        logging.info('All volumes have b <= {0}, no subset needed.'.format(bmax))
+        return dwi_file, bval_file, bvec_file
+
+    out_files = (out_base + ".nii.gz", out_base + ".bval", out_base + ".bvec")
+    cache_valid = all(is_valid(f) for f in out_files) and \
+        os.path.getmtime(out_files[0]) >= os.path.getmtime(dwi_file)
+
+    if cache_valid and not isForce:
+        logging.info('Low-b subset already cached: "{0}".'.format(out_files[0]))
+        return out_files
+
+    dwi = nib.load(dwi_file)
+    data = np.asanyarray(dwi.dataobj)[..., keep]
+    save_image(nib.Nifti1Image(data, dwi.affine, dwi.header), out_files[0])
+
+    bvecs = np.loadtxt(bvec_file).reshape(3, -1)
+    save_txt(out_files[1], bvals[keep][None], fmt='%g')
+    save_txt(out_files[2], bvecs[:, keep], fmt='%.6f')
+
+    with open(out_base + ".json", 'w') as outfile:
+        j = {
+            'Origin function': 'low_b_subset(' + dwi_file + ', ' + bval_file + ', ' + bvec_file + ', ' +
+                               out_base + ', ' + str(bmax) + ')',
+            'Description': 'b0 and shells with b <= ' + str(bmax) + ' for the tensor fit',
+            'Volumes': [int(i) for i in keep],
+            'dwi_filename': out_files[0],
+            'Time' : time.asctime()
+            }
+        json.dump(j, outfile)
+
+    logging.info('Low-b subset: {0} of {1} volumes kept.'.format(len(keep), len(bvals)))
+    return out_files
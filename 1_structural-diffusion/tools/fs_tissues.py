@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Tissue partial volume maps of a T1 from its FreeSurfer segmentation, in place of "bet" and "fast -n 3"
+# (05_anat_registration_dwi.py --tissues freesurfer): recon-all (04_freesurfer.py) has already skull-stripped
+# the T1 (mri/brainmask.mgz) and segmented it (mri/aseg.mgz), in the conformed space.
+# The aseg labels are grouped into the tissues of the 5TT image of MRtrix (after the FreeSurfer2ACT lookup
+# table of "5ttgen freesurfer"): cortical GM (cerebral and cerebellar cortex), sub-cortical GM (thalamus,
+# basal ganglia, hippocampus, amygdala, ventral DC, non-WM hypointensities), WM (with the brain stem) and
+# CSF (ventricles, choroid plexus, vessels, and the voxels of the brain mask outside of the aseg, i.e. the
+# sulcal CSF). Any other label goes to OTHER_TISSUE: as the PVEs of fast, the fractions of a brain voxel
+# sum to 1, which 5ttcheck requires of the 5TT image.
+# The fraction of each tissue in a voxel of the T1 is the fraction of SUBSAMPLES^3 points, regularly spaced
+# in the voxel, that fall in a voxel of the tissue: the tissue volumes are resampled with the index maps of
+# tools/header_resample.py (one per point, nearest neighbour through the headers, no FreeSurfer process).
+#
+#     fractions, brain = tissue_fractions(aseg_mgz, brainmask_mgz, t1_file)
+#     fractions['GM'], fractions['SGM'], fractions['WM'], fractions['CSF']
+
+import itertools
+import logging
+
+import nibabel as nib
+import numpy as np
+
+from tools.header_resample import index_map, gather
+
+# Tissues in the order of the 5TT image (the 5th, pathological tissue, is not segmented by FreeSurfer)
+TISSUES = ('GM', 'SGM', 'WM', 'CSF')
+
+# aseg labels of each tissue (FreeSurferColorLUT)
+TISSUE_LABELS = {
+    'GM': [3, 8, 42, 47],
+    'SGM': [9, 10, 11, 12, 13, 17, 18, 26, 27, 28, 48, 49, 50, 51, 52, 53, 54, 58, 59, 60, 80, 81, 82],
+    'WM': [2, 7, 16, 41, 46, 77, 78, 79, 85, 192, 251, 252, 253, 254, 255],
+    'CSF': [4, 5, 14, 15, 24, 30, 31, 43, 44, 62, 63, 72],
+}
+
+# Tissue of the labels of none of TISSUE_LABELS
+OTHER_TISSUE = 'WM'
+
+# Points per axis in a voxel of the target grid
+SUBSAMPLES = 2
+
+
+def tissue_classes(labels, brain):
+    ''' Tissue of each voxel of a segmentation (1 + index in TISSUES), 0 outside of the brain '''
+    classes = np.zeros(labels.shape, dtype=np.uint8)
+    classes[labels > 0] = TISSUES.index(OTHER_TISSUE) + 1
+    for k, tissue in enumerate(TISSUES, 1):
+        classes[np.isin(labels, TISSUE_LABELS[tissue])] = k
+    # Cortical parcels of aparc+aseg (ctx-lh-*, ctx-rh-*, a2009s)
+    cortex = ((labels >= 1000) & (labels < 3000)) | ((labels >= 11100) & (labels < 13000))
+    classes[cortex] = TISSUES.index('GM') + 1
+    classes[(labels == 0) & brain] = TISSUES.index('CSF') + 1
+    return classes
+
+
+def subvoxel_affines(affine, subsamples:int):
+    ''' Affines of the grid shifted to each of the subsamples^3 points of its voxels '''
+    offsets = (np.arange(subsamples) + 0.5) / subsamples - 0.5
+    for shift in itertools.product(offsets, repeat=3):
+        shifted = affine.copy()
+        shifted[:3, 3] += affine[:3, :3] @ np.array(shift)
+        yield shifted
+
+
+def tissue_fractions(aseg_file:str, brainmask_file:str, target_file:str, subsamples:int=SUBSAMPLES):
+    ''' Partial volume maps of the tissues of a FreeSurfer segmentation on the grid of target_file
+
+        Parameters
+        ----------
+        aseg_file :
+            FreeSurfer segmentation (mri/aseg.mgz or aparc+aseg.mgz)
+        brainmask_file :
+            FreeSurfer skull-stripped T1 (mri/brainmask.mgz), on the grid of aseg_file
+        target_file :
+            Image whose grid (shape and affine) the maps are computed on
+        subsamples :
+            Points per axis in a voxel of the target grid
+
+        Returns
+        ----------
+        Dict of the fraction (float32, 0 to 1) of each tissue of TISSUES, and the brain mask (voxel centre in
+        the non-zero voxels of brainmask_file) on the target grid
+    '''
+    aseg = nib.load(aseg_file)
+    brainmask = nib.load(brainmask_file)
+    if aseg.shape[:3] != brainmask.shape[:3] or not np.allclose(aseg.affine, brainmask.affine, atol=1e-4):
+        raise ValueError('"{0}" is not on the grid of "{1}".'.format(brainmask_file, aseg_file))
+    brain = np.asanyarray(brainmask.dataobj).reshape(brainmask.shape[:3]) > 0
+    classes = tissue_classes(np.asanyarray(aseg.dataobj).reshape(aseg.shape[:3]), brain)
+
+    target = nib.load(target_file)
+    shape = target.shape[:3]
+    counts = np.zeros((len(TISSUES),) + shape, dtype=np.uint16)
+    for affine in subvoxel_affines(target.affine, subsamples):
+        sampled = gather(classes, index_map(aseg.shape[:3], aseg.affine, shape, affine))
+        for k in range(len(TISSUES)):
+            counts[k] += sampled == k + 1
+    fractions = {tissue: (counts[k] / subsamples ** 3).astype(np.float32) for k, tissue in enumerate(TISSUES)}
+    brain = gather(brain, index_map(aseg.shape[:3], aseg.affine, shape, target.affine))
+    logging.info('Tissue fractions of "{0}" on "{1}": {2}.'.format(aseg_file, target_file, ', '.join(
+        '{0} {1:.0f} ml'.format(tissue, fractions[tissue].sum() * abs(np.linalg.det(target.affine[:3, :3])) / 1000)
+        for tissue in TISSUES)))
+    return fractions, brain
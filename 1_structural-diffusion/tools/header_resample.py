@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Nearest neighbour resampling of label volumes to the grid of another image through their headers only,
+# in place of "mri_vol2vol --regheader --interp nearest" (05_anat_registration_dwi.py: the FreeSurfer
+# labels from the conformed space to the T1). The voxel of the target grid goes to the scanner coordinates
+# of its affine and back to the voxels of the source with the inverse of the source affine (vox2vox), and
+# takes the label of the nearest source voxel (floor(x + 0.5) as FreeSurfer), 0 outside of the source.
+# The volumes of the same grid (aparc+aseg, wmparc, brainstem labels of one FreeSurfer subject) share one
+# index map: the mapping is computed once and each volume is a single gather. No FreeSurfer process
+# is started, the .mgz files are read with nibabel.
+#
+#     aparcaseg, wmparc = resample_labels([aparcaseg_mgz, wmparc_mgz], t1_file)
+
+import logging
+
+import nibabel as nib
+import numpy as np
+
+
+def vox2vox(source_affine, target_affine):
+    ''' Target voxel -> source voxel matrix of two scanner space affines '''
+    return np.linalg.inv(source_affine) @ target_affine
+
+
+def index_map(source_shape:tuple, source_affine, target_shape:tuple, target_affine):
+    ''' Flat index in the source volume of the nearest voxel of each target voxel, -1 outside of the source '''
+    m = vox2vox(source_affine, target_affine)
+    j, k = np.meshgrid(np.arange(target_shape[1]), np.arange(target_shape[2]), indexing='ij')
+    # Source coordinates of the target plane i = 0, the planes i > 0 being shifted by the first column
+    plane = m[:3, 1:3] @ np.stack([j.ravel(), k.ravel()]) + m[:3, 3:4]
+    bounds = np.array(source_shape[:3])[:, None]
+    index = np.empty(target_shape[:3], dtype=np.int64)
+    for i in range(target_shape[0]):
+        voxels = np.floor(plane + m[:3, 0:1] * i + 0.5).astype(np.int64)
+        inside = np.all((voxels >= 0) & (voxels < bounds), axis=0)
+        flat = np.ravel_multi_index(np.where(inside, voxels, 0), source_shape[:3])
+        index[i] = np.where(inside, flat, -1).reshape(target_shape[1:3])
+    return index
+
+
+def gather(data, index):
+    ''' Values of data at the flat indices of index, 0 where it is -1 '''
+    out = data.ravel()[np.maximum(index, 0)]
+    out[index < 0] = 0
+    return out
+
+
+def resample_labels(source_files:list, target_file:str):
+    ''' Label volumes resampled (nearest neighbour) to the grid of target_file, through the headers
+
+        Parameters
+        ----------
+        source_files :
+            Label volumes (.mgz, .nii.gz), one index map computed per distinct grid
+        target_file :
+            Image whose grid (shape and affine) the volumes are resampled to
+
+        Returns
+        ----------
+        List of the resampled arrays (dtype of each source), in the order of source_files
+    '''
+    target = nib.load(target_file)
+    maps = []
+    resampled = []
+    for source_file in source_files:
+        img = nib.load(source_file)
+        if len(img.shape) > 3 and any(n > 1 for n in img.shape[3:]):
+            raise ValueError('"{0}" {1} is not a 3D volume.'.format(source_file, img.shape))
+        grid = (img.shape[:3], img.affine)
+        index = next((index for shape, affine, index in maps if shape == grid[0] and np.allclose(affine, grid[1])), None)
+        if index is None:
+            index = index_map(grid[0], grid[1], target.shape[:3], target.affine)
+            maps.append(grid + (index,))
+        data = np.asanyarray(img.dataobj).reshape(img.shape[:3])
+        # .mgz are big-endian
+        data = data.astype(data.dtype.newbyteorder('='), copy=False)
+        resampled.append(gather(data, index))
+    logging.info('{0} volumes resampled to "{1}" with {2} index map(s).'.format(len(source_files), target_file, len(maps)))
+    return resampled
@@ -0,0 +1,275 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Cached manifest of the dataset, replacing the os.listdir discovery of the scripts (filtered on
+# "sub-51T" or "sub-TIMESwp11s") and the stat calls on the network mount for finished sessions.
+# The BIDS tree (subjects, sessions, modalities) and the derivatives of the pipeline are listed once
+# and cached in derivatives/dataset_manifest.json with the mtime of every listed folder. On the next
+# load only the folders whose mtime changed are listed again, i.e. one stat per folder instead of a
+# walk of the tree and of one stat per file checked.
+#
+# The scripts select their sessions with Manifest.select and skip at once, without entering the
+# processing function, the sessions whose final outputs (STEP_OUTPUTS) are all there and valid:
+#
+#     python -m tools.manifest --data_path /mnt/Hummel-Data/TI/mri/51T
+
+import argparse
+import json
+import logging
+import os
+import time
+
+from tools.outputs import is_valid
+
+MANIFEST_NAME = 'dataset_manifest.json'
+MANIFEST_VERSION = 2
+
+# Folders listed by the manifest (relative to data_path) and how many levels are listed below them,
+# None for the whole tree. The root is only followed into the subject folders.
+SCAN_ROOTS = [
+    ('', 3),  # data_path, sub-*, sub-*/ses-* (modalities)
+    (os.path.join('derivatives', '01_dwi'), None),
+    (os.path.join('derivatives', '01_freesurfer'), 3),  # <subj>-<sess>/mri
+]
+
+# A folder modified less than this many seconds before it was listed may change again within the
+# mtime resolution of the share: it is listed again on the next load
+MTIME_MARGIN = 2
+
+# Final outputs of a step for a session, relative to data_path. A session whose final outputs all exist
+# is complete and not run again unless -f is given. Steps that are not listed are always run.
+STEP_OUTPUTS = {
+    '02_dwi_preprocessing': [
+        'derivatives/01_dwi/{subj}/{sess}/dwi/preproc/{subj}_{sess}_dwi.nii.gz',
+        'derivatives/01_dwi/{subj}/{sess}/dwi/preproc/{subj}_{sess}_dwi.bval',
+        'derivatives/01_dwi/{subj}/{sess}/dwi/preproc/{subj}_{sess}_dwi.bvec',
+        'derivatives/01_dwi/{subj}/{sess}/dwi/preproc/{subj}_{sess}_dwi_mean-b0_bet.nii.gz'],
+    '04_freesurfer': [
+        'derivatives/01_freesurfer/{subj}-{sess}/mri/aparc.a2009s+aseg.mgz',
+        'derivatives/01_freesurfer/{subj}-{sess}/mri/wmparc.mgz',
+        'derivatives/01_freesurfer/{subj}-{sess}/mri/brainstemSsLabels.v10.FSvoxelSpace.mgz'],
+    '05_anat_registration_dwi': [
+        'derivatives/01_dwi/{subj}/{sess}/dwi/preproc/{subj}_{sess}_acq-mprage_T1w_dwi.nii.gz',
+        'derivatives/01_dwi/{subj}/{sess}/dwi/preproc/{subj}_{sess}_acq-mprage_T1wPveWM_dwi.nii.gz',
+        'derivatives/01_dwi/{subj}/{sess}/dwi/preproc/{subj}_{sess}_acq-mprage_T1wPve5tt_dwi.nii.gz'],
+    '06_dwi_processing': [
+        'derivatives/01_dwi/{subj}/{sess}/dwi/proc/{subj}_{sess}_iFOD2.tck',
+        'derivatives/01_dwi/{subj}/{sess}/dwi/proc/{subj}_{sess}_sift.txt'],
+    '06_compute_scalar_maps': [
+        'derivatives/01_dwi/{subj}/{sess}/dwi/proc/{subj}_{sess}_dwi_FA.nii.gz'],
+    # 06_compute_scalar_maps --l, which also registers the lesion mask into the dwi space
+    '06_compute_scalar_maps --l': [
+        'derivatives/01_dwi/{subj}/{sess}/dwi/proc/{subj}_{sess}_dwi_FA.nii.gz',
+        'derivatives/01_dwi/{subj}/{sess}/lesion/{subj}_{sess}_acq-mprage_T1w_label-lesion_roi_dwi.nii.gz'],
+}
+
+
+def buildArgsParser():
+    p = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter,
+        epilog="")
+    p._optionals.title = "Generic options"
+
+    p.add_argument('--data_path', default='/mnt/Hummel-Data/TI/mri/51T', dest='data_path',
+        help="Subjects folder path, the manifest is cached in its derivatives folder. ['%(default)s']")
+    p.add_argument('-f', action='store_true', dest='isForce',
+        help='If set, lists the whole tree again instead of refreshing the cached manifest.')
+
+    log_g = p.add_argument_group('Logging options')
+    log_g.add_argument(
+        '-v', action='store_true', dest='isVerbose',
+        help='If set, produces verbose output.')
+
+    return p
+
+
+def manifest_file(data_path:str):
+    return os.path.join(data_path, 'derivatives', MANIFEST_NAME)
+
+
+class Manifest:
+    ''' Listing of the dataset folders, cached on disk and refreshed from the folder mtimes '''
+
+    def __init__(self, data_path:str, isForce:bool=False):
+        self.data_path = data_path
+        self.folders = {}  # relative path -> {'mtime', 'depth', 'dirs', 'files'}
+        self.changed = False
+        if not isForce:
+            try:
+                with open(manifest_file(data_path)) as f:
+                    cached = json.load(f)
+                if cached.get('Version') == MANIFEST_VERSION:
+                    self.folders = cached['Folders']
+            except (OSError, ValueError):
+                pass
+        self.refresh()
+
+    def _list(self, rel:str, depth):
+        ''' List a folder and the folders below it, up to depth levels '''
+        path = os.path.join(self.data_path, rel)
+        try:
+            mtime = os.stat(path).st_mtime
+            entries = list(os.scandir(path))
+        except OSError:
+            self._forget(rel)
+            return
+        dirs = sorted(e.name for e in entries if e.is_dir())
+        files = sorted(e.name for e in entries if not e.is_dir())
+        recent = time.time() - mtime < MTIME_MARGIN
+        self.folders[rel] = {'mtime': None if recent else mtime, 'depth': depth, 'dirs': dirs, 'files': files}
+        self.changed = True
+
+        if depth is not None and depth <= 1:
+            return
+        for name in dirs:
+            if rel == '' and not name.startswith('sub-'):
+                continue
+            child = os.path.join(rel, name)
+            if child not in self.folders:
+                self._list(child, None if depth is None else depth - 1)
+
+    def _forget(self, rel:str):
+        ''' Remove a folder and everything below it '''
+        for key in [k for k in self.folders if k == rel or k.startswith(rel + os.sep)]:
+            del self.folders[key]
+            self.changed = True
+
+    def refresh(self):
+        ''' List again the folders whose mtime changed (entries added, removed or renamed) '''
+        start = time.time()
+        for rel, depth in SCAN_ROOTS:
+            if rel not in self.folders:
+                self._list(rel, depth)
+        listed = 0
+        for rel in sorted(self.folders):
+            entry = self.folders.get(rel)
+            if entry is None:
+                continue  # forgotten with its parent
+            try:
+                mtime = os.stat(os.path.join(self.data_path, rel)).st_mtime
+            except OSError:
+                self._forget(rel)
+                continue
+            if entry['mtime'] is None or mtime != entry['mtime']:
+                old_dirs = set(entry['dirs'])
+                self._list(rel, entry['depth'])
+                for name in old_dirs - set(self.folders.get(rel, {}).get('dirs', [])):
+                    self._forget(os.path.join(rel, name))
+                listed += 1
+        logging.info('Manifest of {0}: {1} folders, {2} listed again in {3:.1f} s.'.format(
+            self.data_path, len(self.folders), listed, time.time() - start))
+        if self.changed:
+            self.save()
+
+    def save(self):
+        ''' Write the cache atomically, several scripts may load it at once '''
+        filename = manifest_file(self.data_path)
+        tmp_file = filename + '.' + str(os.getpid()) + '.tmp'
+        try:
+            if not os.path.exists(os.path.dirname(filename)):
+                os.makedirs(os.path.dirname(filename))
+            with open(tmp_file, 'w') as outfile:
+                json.dump({'Version': MANIFEST_VERSION, 'Data path': self.data_path, 'Time': time.asctime(),
+                           'Folders': self.folders}, outfile)
+            os.replace(tmp_file, filename)
+        except OSError as e:
+            # i.e. read-only source of 01_copy_data_locally: the manifest is only kept in memory
+            logging.warning('Manifest not cached in "{0}": {1}'.format(filename, e))
+        self.changed = False
+
+    def isfile(self, path:str):
+        ''' os.path.isfile answered from the manifest when the folder of path is listed in it '''
+        rel = os.path.relpath(path, self.data_path)
+        entry = self.folders.get(os.path.dirname(rel))
+        if entry is None or rel.startswith('..'):
+            return os.path.isfile(path)
+        return os.path.basename(rel) in entry['files']
+
+    def subjects(self):
+        return [d for d in self.folders.get('', {}).get('dirs', []) if d.startswith('sub-')]
+
+    def sessions(self, subj:str):
+        return [d for d in self.folders.get(subj, {}).get('dirs', []) if d.startswith('ses-')]
+
+    def modalities(self, subj:str, sess:str):
+        return self.folders.get(os.path.join(subj, sess), {}).get('dirs', [])
+
+    def select(self, subj_list:list, sess_list:list, modality:str=None):
+        ''' (subject, session) pairs of the --subj/--sess arguments, "all" being taken from the manifest
+
+            Parameters
+            ----------
+            subj_list, sess_list :
+                Subject and session ids without the "sub-"/"ses-" prefix, or "all"
+            modality :
+                Raw data folder the discovered sessions must have (i.e. "dwi", "anat")
+        '''
+        subjects = self.subjects() if 'all' in subj_list else ['sub-' + subj for subj in subj_list]
+        pairs = []
+        for subj in subjects:
+            if 'all' in sess_list:
+                sessions = self.sessions(subj)
+            else:
+                sessions = ['ses-' + sess for sess in sess_list]
+            for sess in sessions:
+                discovered = 'all' in subj_list or 'all' in sess_list
+                if discovered and modality is not None and modality not in self.modalities(subj, sess):
+                    continue
+                pairs.append((subj, sess))
+        return pairs
+
+    def is_output(self, path:str):
+        ''' Whether path exists and is a valid output (tools/outputs.py)
+
+            The check reads the header and the end of the file: its result is cached with the listing
+            of the folder under the size and mtime of the file, a single stat on the next load.
+        '''
+        if not self.isfile(path):
+            return False
+        rel = os.path.relpath(path, self.data_path)
+        entry = self.folders.get(os.path.dirname(rel))
+        if entry is None or rel.startswith('..'):
+            return is_valid(path)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return False
+        valid = entry.setdefault('valid', {})
+        if valid.get(os.path.basename(rel)) != [stat.st_size, stat.st_mtime]:
+            if not is_valid(path):
+                return False
+            valid[os.path.basename(rel)] = [stat.st_size, stat.st_mtime]
+            self.changed = True
+        return True
+
+    def is_complete(self, script:str, subj:str, sess:str):
+        ''' Whether every final output of the step exists and is valid for the session '''
+        outputs = STEP_OUTPUTS.get(script)
+        if not outputs:
+            return False
+        return all(self.is_output(os.path.join(self.data_path, out.format(subj=subj, sess=sess))) for out in outputs)
+
+    def incomplete(self, script:str, pairs:list):
+        ''' Sessions of pairs still to be run for the step '''
+        todo = [(subj, sess) for subj, sess in pairs if not self.is_complete(script, subj, sess)]
+        if len(todo) < len(pairs):
+            logging.info('{0}: {1} of {2} sessions already complete.'.format(script, len(pairs) - len(todo), len(pairs)))
+        if self.changed:
+            self.save()
+        return todo
+
+
+if __name__ == "__main__":
+    parser = buildArgsParser()
+    args = parser.parse_args()
+
+    if args.isVerbose:
+        logging.basicConfig(level=logging.DEBUG)
+
+    manifest = Manifest(args.data_path, args.isForce)
+    pairs = manifest.select(['all'], ['all'])
+    print('{0} subjects, {1} sessions, {2} folders listed in {3}'.format(
+        len(manifest.subjects()), len(pairs), len(manifest.folders), manifest_file(args.data_path)))
+    for script in STEP_OUTPUTS:
+        done = len(pairs) - len(manifest.incomplete(script, pairs))
+        print('{0:28} {1:4} / {2} complete'.format(script, done, len(pairs)))
@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Atomic outputs: a step is judged finished from its output files, so a file must only appear under its
+# final name once it is complete. A tckgen, eddy or antsApplyTransforms killed mid-write would otherwise
+# leave a truncated file that every later run skips as done.
+# The producers write to a hidden temporary name in the same folder (".tmp<pid>_<name>", same extension
+# so the tools keep the same format) which is checked and renamed (atomic within a file system):
+#   - run_cmd (tools/command.py) rewrites the outputs (or their prefix, i.e. "--out=<prefix>") in the
+#     command line with redirect_outputs and renames them with commit_outputs when the command succeeded,
+#   - the images and text files written by the scripts go through save_image / save_txt.
+# A leftover temporary file of a killed run is never taken for an output.
+#
+# is_valid checks a file on read, cheaply (header and end of file, not the data): the skip tests of the
+# steps and the manifest use it, so that a truncated file of an older run is computed again.
+# numpy and nibabel are only imported to check or write a file, not by the tools importing this module
+# (i.e. the manifest and the ledger commands of tools/cli.py).
+
+import logging
+import os
+import re
+import shutil
+import struct
+
+TMP_PREFIX = '.tmp'
+IMAGE_EXTENSIONS = ('.nii.gz', '.nii', '.mgz', '.mgh')
+
+
+def tmp_marker():
+    ''' Prefix of the temporary names of this process '''
+    return '{0}{1}_'.format(TMP_PREFIX, os.getpid())
+
+
+def tmp_path(path:str):
+    ''' Temporary name of an output, hidden and in the same folder so that the rename is atomic '''
+    return os.path.join(os.path.dirname(path), tmp_marker() + os.path.basename(path))
+
+
+def _gzip_size(path:str):
+    ''' Uncompressed size modulo 2**32, from the trailer of a gzip file '''
+    with open(path, 'rb') as f:
+        f.seek(-4, os.SEEK_END)
+        return struct.unpack('<I', f.read(4))[0]
+
+
+def _image_valid(path:str, shape:tuple=None):
+    import numpy as np
+    import nibabel as nib
+    img = nib.load(path)
+    if shape is not None and tuple(img.shape[:len(shape)]) != tuple(shape):
+        logging.warning('"{0}" has shape {1}, expected {2}.'.format(path, img.shape, tuple(shape)))
+        return False
+    end = img.dataobj.offset + int(np.prod(img.shape)) * img.get_data_dtype().itemsize
+    if path.endswith(('.gz', '.mgz')):
+        if end >= 2 ** 32:
+            return True  # the trailer only holds the size modulo 2**32
+        size = _gzip_size(path)
+        # NIfTI data ends the file, the MGH data may be followed by its (small) tags
+        return size == end if path.endswith('.nii.gz') else end <= size < end + 2 ** 20
+    return os.path.getsize(path) >= end
+
+
+def _tck_valid(path:str):
+    import numpy as np
+    with open(path, 'rb') as f:
+        header = f.read(4096).decode('latin-1')
+        if not header.startswith('mrtrix tracks') or '\nEND\n' not in header:
+            return False
+        fields = dict(line.split(': ', 1) for line in header.split('\nEND\n')[0].split('\n')[1:] if ': ' in line)
+        datatype = fields.get('datatype', 'Float32LE')
+        dtype = np.dtype(('<' if datatype.endswith('LE') else '>') + ('f8' if datatype.startswith('Float64') else 'f4'))
+        # The last point is the (inf, inf, inf) end of file marker written when the file is closed
+        f.seek(-3 * dtype.itemsize, os.SEEK_END)
+        return bool(np.all(np.isinf(np.frombuffer(f.read(3 * dtype.itemsize), dtype=dtype))))
+
+
+def is_valid(path:str, shape:tuple=None):
+    ''' Whether path is a complete output
+
+        Parameters
+        ----------
+        path :
+            Output file
+        shape :
+            Expected first dimensions of an image (i.e. the spatial shape), not checked if None
+
+        Returns
+        ----------
+        False if the file is missing or empty, if an image header does not parse or the data is shorter
+        than the header says, or if a tractogram has no end of file marker
+    '''
+    try:
+        if os.path.getsize(path) == 0:
+            return False
+        if path.endswith(IMAGE_EXTENSIONS):
+            return _image_valid(path, shape)
+        if path.endswith('.tck'):
+            return _tck_valid(path)
+    except FileNotFoundError:
+        return False
+    except Exception as e:
+        logging.warning('Invalid output "{0}": {1}'.format(path, e))
+        return False
+    return True
+
+
+def commit(tmp_file:str, filename:str, shape:tuple=None):
+    ''' Rename a checked temporary file to its final name, removed and IOError if it is not valid '''
+    if not is_valid(tmp_file, shape):
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        raise IOError('Incomplete output "{0}".'.format(filename))
+    os.replace(tmp_file, filename)
+
+
+def save_image(img, filename:str):
+    ''' img.to_filename(filename) through a checked temporary file '''
+    tmp_file = tmp_path(filename)
+    try:
+        img.to_filename(tmp_file)
+        commit(tmp_file, filename, img.shape)
+    finally:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+
+
+def save_txt(filename:str, array, **kwargs):
+    ''' np.savetxt(filename, array, **kwargs) through a temporary file '''
+    import numpy as np
+    tmp_file = tmp_path(filename)
+    try:
+        np.savetxt(tmp_file, array, **kwargs)
+        commit(tmp_file, filename)
+    finally:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+
+
+def _is_input(token:str, outputs:list):
+    ''' Whether a path (or FSL prefix) of the command line is an existing file that is not an output '''
+    return any(os.path.isfile(f) and f not in outputs for f in [token] + [token + ext for ext in IMAGE_EXTENSIONS])
+
+
+def redirect_outputs(cmd:str, outputs:list):
+    ''' Command line writing the outputs to their temporary names
+
+        The output, or the longest prefix of it written in the command (i.e. "-o <prefix>",
+        "--out=<prefix>", an image without extension), is replaced by its temporary name. The
+        outputs that are not in the command (i.e. recon-all) are written in place.
+
+        Returns
+        ----------
+        (command, folders holding the temporary files, outputs redirected)
+    '''
+    tokens = set(re.findall(r'[^\s=]+', cmd))
+    targets, redirected = set(), []
+    for output in outputs:
+        candidates = [t for t in tokens if output.startswith(t) and os.path.basename(t) and
+                      os.path.dirname(t) == os.path.dirname(output) and not _is_input(t, outputs)]
+        if candidates:
+            targets.add(max(candidates, key=len))
+            redirected.append(output)
+    for target in targets:
+        # Whole token, last occurrence: an in-place command (i.e. mri_binarize --i x --o x) keeps its input
+        start, end = list(re.finditer(r'(?<![^\s=])' + re.escape(target) + r'(?![^\s=])', cmd))[-1].span()
+        cmd = cmd[:start] + tmp_path(target) + cmd[end:]
+    return cmd, set(os.path.dirname(target) for target in targets), redirected
+
+
+def _tmp_files(folders:set):
+    marker = tmp_marker()
+    for folder in folders:
+        for name in os.listdir(folder or '.'):
+            if name.startswith(marker):
+                yield os.path.join(folder, name), os.path.join(folder, name[len(marker):])
+
+
+def commit_outputs(folders:set, redirected:list, outputs:list):
+    ''' Check the outputs of a successful command and rename its temporary files
+
+        Every temporary file of the process in folders is renamed (the tools write side files with
+        the same prefix, i.e. the _mask of bet or the .eddy_* files), once all the outputs are valid.
+
+        Returns
+        ----------
+        Outputs that are missing or not valid, nothing being renamed if there is any
+    '''
+    invalid = [f for f in outputs if not is_valid(tmp_path(f) if f in redirected else f)]
+    if invalid:
+        discard_outputs(folders)
+        return invalid
+    for tmp_file, filename in list(_tmp_files(folders)):
+        if os.path.isdir(tmp_file) and os.path.isdir(filename):
+            shutil.rmtree(filename)
+        os.replace(tmp_file, filename)
+    return []
+
+
+def discard_outputs(folders:set):
+    ''' Remove the temporary files of a failed command '''
+    for tmp_file, _ in list(_tmp_files(folders)):
+        if os.path.isdir(tmp_file):
+            shutil.rmtree(tmp_file, ignore_errors=True)
+        else:
+            os.remove(tmp_file)
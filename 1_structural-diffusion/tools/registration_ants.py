@@ -1,16 +1,62 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import json
 import logging
-import subprocess
 import os
-import sys
+import time
+from tools.command import run_cmd, merge_resources
+from tools.outputs import is_valid
 
-sys.path
-sys.path.append('/opt/ants-2.4.3')
+# Shipped with the pipeline, found from this module rather than from the working directory
+ANTS_SYN_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'antsRegistrationSyN.sh')
 
+# Longitudinal registration to MNI (registerAntsLongitudinal): instead of one SyN registration to MNI
+# per session, the sessions of a subject are averaged in a within-subject template, registered once
+# to MNI. The template is built in TEMPLATE_ITERATIONS rounds: the sessions are registered rigidly to
+# the first session and averaged, then registered rigidly again to that average and averaged again,
+# so that no session is the reference of the final transforms. A session goes to MNI (or MNI to the
+# session) through its rigid transform to the template composed with the warp of the template, in one
+# antsApplyTransforms (one interpolation). A subject with S sessions costs one SyN and 2 x S rigid
+# registrations instead of S SyN. The template is kept once built: a session processed later is only
+# registered rigidly to it (the json sidecar of the template lists the sessions it was built from,
+# delete the template folder to build it again from all the sessions).
+TEMPLATE_ITERATIONS = 2
 
-def registerAnts(input_file:str, output_file:str, warp_folder:str, warp_name:str, original_file:str, ref_file:str, inv:bool=False, interp:str="Linear", dim_add:str=""):
+# Tiered registration (registerAnts with tiered set): the quick SyN of ANTs (antsRegistrationSyNQuick.sh,
+# mutual information and fewer iterations) is run first and the moving image it registered is compared
+# to the fixed image in-process (normalised mutual information, tools/registration_metrics.py). The full
+# SyN (ANTS_SYN_SCRIPT) is only run when the NMI is below the threshold, its outputs replacing those of
+# the quick one. The tier kept and the NMI of each tier are written in the json sidecar of the warp
+# (<warp_name>.json in the warp folder, see registration_tier).
+# A tier before the last one writes its outputs under its own prefix (<warp_name>_quick), renamed to the
+# names of the warp only once its NMI passed and the sidecar is written (1Warp last, it marks the warp as
+# done): a run killed during the escalation never leaves a rejected quick warp taken for the warp.
+TIERS = ('quick', 'full')
+NMI_THRESHOLD = 1.1
+
+# Outputs of antsRegistrationSyN.sh for an output prefix, the done marker (1Warp) last
+SYN_OUTPUTS = ("0GenericAffine.mat", "1InverseWarp.nii.gz", "Warped.nii.gz", "InverseWarped.nii.gz", "1Warp.nii.gz")
+
+
+def synCommand(tier:str, original_file:str, ref_file:str, warp_file:str):
+    ''' antsRegistrationSyN command of a tier of TIERS '''
+    if tier == 'quick':
+        return "antsRegistrationSyNQuick.sh -d 3 -f " + ref_file + " -m " + original_file + " -o " + warp_file
+    return "bash " + ANTS_SYN_SCRIPT + " -d 3 -r 2 -f " + ref_file + " -m " + original_file + " -o " + warp_file
+
+
+def registration_tier(warp_folder:str, warp_name:str):
+    ''' Tier the warp was computed with, None if it has no sidecar (i.e. computed before the tiers) '''
+    try:
+        with open(os.path.join(warp_folder, warp_name + ".json")) as f:
+            return json.load(f).get('Tier')
+    except (OSError, ValueError):
+        return None
+
+
+def registerAnts(input_file:str, output_file:str, warp_folder:str, warp_name:str, original_file:str, ref_file:str, inv:bool=False, interp:str="Linear", dim_add:str="",
+                 tiered:bool=False, threshold:float=NMI_THRESHOLD):
     '''Registration from one space to another
         
         Parameters
@@ -35,16 +81,21 @@ def registerAnts(input_file:str, output_file:str, warp_folder:str, warp_name:str
         dim_add :
             Specify if the dimension of the input file is different than the 
             dimension usd to create the warp (i.e. " -e 3" fro 4 dim images)
+        tiered :
+            Specify if the quick SyN is tried first, the full SyN being run only if the
+            registered original_file has a NMI with ref_file below threshold
+        threshold :
+            NMI under which the quick SyN is not kept
+
+        Returns
+        ----------
+        Resources used by the commands that were run (see tools/command.py), empty if none was run
     '''
     if not os.path.exists(warp_folder):
         os.makedirs(warp_folder)
 
     warp_file = os.path.join(warp_folder, warp_name)
 
-    # Set the right path for the sh file --> to add to the readme
-    antsRegistrationSyN_cmd = "bash ./tools/antsRegistrationSyN.sh -d 3 -r 2 -f " + \
-        ref_file + " -m " + original_file + " -o " + warp_file
-    
     if inv:
         complete_warp_file = warp_file + "1InverseWarp.nii.gz"
         affine_mat = "[" + warp_file + "0GenericAffine.mat, 1 ]"
@@ -57,20 +108,202 @@ def registerAnts(input_file:str, output_file:str, warp_folder:str, warp_name:str
     
     mri_binarize_cmd = "mri_binarize --i " + output_file + " --o " + output_file + " --min 0.00001"
 
-    if os.path.exists(warp_file + "1Warp.nii.gz"):
+    resources = []
+    if is_valid(warp_file + "1Warp.nii.gz"):
         print("antsRegistrationSyN already run")
     else:
-        print(antsRegistrationSyN_cmd)
-        logging.info('antsRegistrationSyN command: "{0}".'.format(antsRegistrationSyN_cmd))
-        subprocess.call(antsRegistrationSyN_cmd, shell=True)
+        quality = {}
+        for tier in (TIERS if tiered else TIERS[-1:]):
+            # The last tier is kept whatever its NMI, it is written under the names of the warp
+            prefix = warp_file if tier == TIERS[-1] else warp_file + "_" + tier
+            antsRegistrationSyN_cmd = synCommand(tier, original_file, ref_file, prefix)
+            print(antsRegistrationSyN_cmd)
+            logging.info('antsRegistrationSyN command: "{0}".'.format(antsRegistrationSyN_cmd))
+            resources.append(run_cmd(antsRegistrationSyN_cmd, outputs=[prefix + "1Warp.nii.gz", prefix + "0GenericAffine.mat",
+                                                                       prefix + "Warped.nii.gz"]))
+            if not tiered:
+                break
+            from tools.registration_metrics import image_nmi # numpy and nibabel, only for the tiered registrations
+            quality[tier] = image_nmi(ref_file, prefix + "Warped.nii.gz")
+            # NaN (empty or constant image) escalates too
+            if quality[tier] >= threshold:
+                break
+            logging.warning('{0} registration "{1}": NMI {2:.3f} below {3}.'.format(tier, warp_file, quality[tier], threshold))
+
+        with open(warp_file + ".json", 'w') as outfile:
+            j = {
+                'Origin function': antsRegistrationSyN_cmd,
+                'Description': 'Warp from ' + original_file + ' to ' + ref_file,
+                'Fixed_filename': ref_file,
+                'Moving_filename': original_file,
+                'Tier': tier,
+                'NMI': quality,
+                'NMI threshold': threshold if tiered else None,
+                'Time': time.asctime()
+                }
+            json.dump(j, outfile)
+
+        # Quick tier kept: renamed to the warp, rejected tiers removed
+        for rejected in TIERS[:-1]:
+            rejected_prefix = warp_file + "_" + rejected
+            for suffix in SYN_OUTPUTS:
+                if os.path.exists(rejected_prefix + suffix):
+                    if rejected_prefix == prefix:
+                        os.replace(rejected_prefix + suffix, warp_file + suffix)
+                    else:
+                        os.remove(rejected_prefix + suffix)
 
     
-    if os.path.isfile(output_file):
+    if is_valid(output_file):
         print("File already registered")
     else:
         print(antsApplyTransforms_cmd)
         logging.info('c command: "{0}".'.format(antsApplyTransforms_cmd))
-        subprocess.call(antsApplyTransforms_cmd, shell=True)
+        resources.append(run_cmd(antsApplyTransforms_cmd, outputs=[output_file]))
+
+
+    return merge_resources(*resources)
+
+
+def template_file(template_folder:str, template_name:str):
+    return os.path.join(template_folder, template_name + "_template.nii.gz")
+
+
+def rigid_prefix(template_folder:str, template_name:str, sess:str):
+    ''' Prefix of the rigid transform of a session to the template '''
+    return os.path.join(template_folder, template_name + "_" + sess + "_2template_")
+
+
+def mni_prefix(template_folder:str, template_name:str):
+    ''' Prefix of the warp of the template to MNI '''
+    return os.path.join(template_folder, template_name + "_template2MNI_")
+
+
+def registerRigid(moving_file:str, fixed_file:str, prefix:str):
+    ''' Rigid registration (antsRegistrationSyN.sh -t r), writes <prefix>0GenericAffine.mat and <prefix>Warped.nii.gz '''
+    cmd = "bash " + ANTS_SYN_SCRIPT + " -d 3 -t r -f " + fixed_file + " -m " + moving_file + " -o " + prefix
+    logging.info('antsRegistrationSyN command: "{0}".'.format(cmd))
+    return run_cmd(cmd, outputs=[prefix + "0GenericAffine.mat", prefix + "Warped.nii.gz"])
+
+
+def buildTemplate(session_files:dict, template_folder:str, template_name:str):
+    '''Within-subject template of the sessions, unless it was already built
+
+        Parameters
+        ----------
+        session_files :
+            Image of each session of the subject (session -> file)
+        template_folder :
+            Folder path where to save the template and the transforms
+        template_name :
+            Name of the template
+
+        Returns
+        ----------
+        Resources used by the commands that were run (see tools/command.py)
+    '''
+    template = template_file(template_folder, template_name)
+    if is_valid(template):
+        print("Template already built")
+        return []
+
+    sessions = sorted(session_files)
+    logging.info('Building template "{0}" from {1}.'.format(template, ', '.join(sessions)))
+    resources = []
+    target = session_files[sessions[0]]
+    for _ in range(TEMPLATE_ITERATIONS):
+        warped = []
+        for sess in sessions:
+            prefix = rigid_prefix(template_folder, template_name, sess)
+            resources.append(registerRigid(session_files[sess], target, prefix))
+            warped.append(prefix + "Warped.nii.gz")
+        # Average of the registered sessions, intensities normalized
+        average_cmd = "AverageImages 3 " + template + " 1 " + " ".join(warped)
+        logging.info('AverageImages command: "{0}".'.format(average_cmd))
+        resources.append(run_cmd(average_cmd, outputs=[template]))
+        target = template
+
+    with open(template[:-len('.nii.gz')] + '.json', 'w') as outfile:
+        j = {
+            'Origin function': 'buildTemplate with registration_ants.py',
+            'Description': 'Within-subject template, average of the rigidly registered sessions',
+            'Template_filename': template,
+            'Sessions': {sess: session_files[sess] for sess in sessions},
+            'Iterations': TEMPLATE_ITERATIONS,
+            'Time': time.asctime()
+            }
+        json.dump(j, outfile)
+    return resources
+
+
+def registerAntsLongitudinal(input_file:str, output_file:str, template_folder:str, template_name:str, sess:str,
+                             session_files:dict, mni_file:str, ref_file:str, inv:bool=False, interp:str="Linear"):
+    '''Registration between a session and MNI through the within-subject template
+
+        Parameters
+        ----------
+        input_file :
+            File to register, in the space of the session (MNI if inv is set)
+        output_file :
+            File registered to MNI (to the space of the session if inv is set)
+        template_folder :
+            Folder path where to save the template of the subject and its transforms
+        template_name :
+            Name of the template (i.e. one per image type)
+        sess :
+            Session of input_file
+        session_files :
+            Image of each session of the subject the template is built from (session -> file), sess included
+        mni_file :
+            MNI template
+        ref_file :
+            File in the target space (mni_file, or the image of the session if inv is set)
+        inv :
+            Specify if you want to register from MNI to the session
+        interp :
+            Type of interpolation method to use - Please refer to "antsApplyTransforms --help"
+
+        Returns
+        ----------
+        Resources used by the commands that were run (see tools/command.py), empty if none was run
+    '''
+    if not os.path.exists(template_folder):
+        os.makedirs(template_folder)
+
+    resources = buildTemplate(session_files, template_folder, template_name)
+    template = template_file(template_folder, template_name)
+
+    rigid = rigid_prefix(template_folder, template_name, sess)
+    if is_valid(rigid + "0GenericAffine.mat"):
+        print("Session already registered to the template")
+    else:
+        # Session added after the template was built
+        resources.append(registerRigid(session_files[sess], template, rigid))
 
+    warp = mni_prefix(template_folder, template_name)
+    antsRegistrationSyN_cmd = synCommand('full', template, mni_file, warp)
+    if is_valid(warp + "1Warp.nii.gz"):
+        print("antsRegistrationSyN of the template already run")
+    else:
+        print(antsRegistrationSyN_cmd)
+        logging.info('antsRegistrationSyN command: "{0}".'.format(antsRegistrationSyN_cmd))
+        resources.append(run_cmd(antsRegistrationSyN_cmd, outputs=[warp + "1Warp.nii.gz", warp + "1InverseWarp.nii.gz",
+                                                                   warp + "0GenericAffine.mat"]))
+
+    # Session -> template -> MNI, or the inverse, in one resampling
+    if inv:
+        transforms = " -t [" + rigid + "0GenericAffine.mat, 1 ] -t [" + warp + "0GenericAffine.mat, 1 ] -t " + \
+            warp + "1InverseWarp.nii.gz"
+    else:
+        transforms = " -t " + warp + "1Warp.nii.gz -t " + warp + "0GenericAffine.mat -t " + rigid + "0GenericAffine.mat"
+    antsApplyTransforms_cmd = "antsApplyTransforms -d 3" + transforms + " -r " + ref_file + " -i " + input_file + \
+        " -o " + output_file + " -n " + interp
+
+    if is_valid(output_file):
+        print("File already registered")
+    else:
+        print(antsApplyTransforms_cmd)
+        logging.info('antsApplyTransforms command: "{0}".'.format(antsApplyTransforms_cmd))
+        resources.append(run_cmd(antsApplyTransforms_cmd, outputs=[output_file]))
 
-    return
+    return merge_resources(*resources)
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Quality metrics of the ANTs registrations (tools/registration_ants.py), computed in-process with numpy
+# on images of the same grid, i.e. the fixed image and the moving image registered to it
+# (<warp>Warped.nii.gz of antsRegistrationSyN.sh).
+# The normalised mutual information (H(fixed) + H(moving)) / H(fixed, moving) does not assume the
+# intensities of both images to be related linearly (T1w against a b0): 1 for independent images,
+# 2 for images that determine each other. It is computed in the mask of the fixed image (i.e. the
+# brain extracted mean b0), the background would otherwise dominate the joint histogram.
+# The Dice of the foreground masks of both images (FOREGROUND_FRACTION of their robust maximum) catches a
+# registered brain shifted or scaled out of the fixed one, and the determinant of the Jacobian of the
+# warp (<warp>1Warp.nii.gz, displacement field on the fixed grid) its local volume changes: a negative
+# determinant is a folding of the warp.
+
+import nibabel as nib
+import numpy as np
+
+# Bins of each axis of the joint histogram
+NMI_BINS = 32
+
+# Foreground of an image: above this fraction of its 99th percentile
+FOREGROUND_FRACTION = 0.1
+
+
+def entropy(p):
+    p = p[p > 0]
+    return -np.sum(p * np.log(p))
+
+
+def nmi(fixed, moving, mask=None, bins:int=NMI_BINS):
+    ''' Normalised mutual information of two arrays of the same shape, over mask (fixed > 0 if None)
+
+        Returns
+        ----------
+        NMI between 1 and 2, NaN if the mask is empty or both images are constant in it
+    '''
+    if mask is None:
+        mask = fixed > 0
+    if not np.any(mask):
+        return float('nan')
+    joint, _, _ = np.histogram2d(fixed[mask].ravel(), moving[mask].ravel(), bins=bins)
+    p = joint / joint.sum()
+    joint_entropy = entropy(p)
+    if joint_entropy == 0:
+        return float('nan')
+    return float((entropy(p.sum(axis=1)) + entropy(p.sum(axis=0))) / joint_entropy)
+
+
+def load_volume(filename:str):
+    ''' First volume of an image as float32, with the image '''
+    img = nib.load(filename)
+    data = np.asanyarray(img.dataobj, dtype=np.float32)
+    return data.reshape(img.shape[:3] + (-1,))[..., 0], img
+
+
+def image_nmi(fixed_file:str, moving_file:str, bins:int=NMI_BINS):
+    ''' NMI of an image registered to a fixed image, over the non-zero voxels of the fixed image '''
+    fixed, _ = load_volume(fixed_file)
+    moving, _ = load_volume(moving_file)
+    if fixed.shape != moving.shape:
+        raise ValueError('"{0}" {1} is not on the grid of "{2}" {3}.'.format(moving_file, moving.shape, fixed_file, fixed.shape))
+    return nmi(fixed, moving, bins=bins)
+
+
+def foreground(data, fraction:float=FOREGROUND_FRACTION):
+    ''' Mask of the voxels above fraction of the 99th percentile of the non-zero voxels '''
+    values = data[data > 0]
+    if not len(values):
+        return np.zeros(data.shape, dtype=bool)
+    return data > fraction * np.percentile(values, 99)
+
+
+def dice(a, b):
+    ''' Dice coefficient of two masks, NaN if both are empty '''
+    total = np.count_nonzero(a) + np.count_nonzero(b)
+    return float(2 * np.count_nonzero(a & b) / total) if total else float('nan')
+
+
+def jacobian_determinant(warp_file:str):
+    ''' Determinant of the Jacobian of x -> x + u(x), u being an ANTs displacement field (ITK: physical LPS
+        displacements, shape X x Y x Z x 1 x 3), on the grid of the field '''
+    img = nib.load(warp_file)
+    u = np.asanyarray(img.dataobj, dtype=np.float32).reshape(img.shape[:3] + (3,))
+    # LPS -> RAS, the frame of the affine of the nifti header
+    u = u * np.array([-1, -1, 1], dtype=np.float32)
+    # du/dx = du/di . di/dx, di/dx being the inverse of the voxel to world matrix
+    world_to_voxel = np.linalg.inv(img.affine[:3, :3]).astype(np.float32)
+    gradient = np.stack(np.gradient(u, axis=(0, 1, 2)), axis=-1)
+    jacobian = gradient @ world_to_voxel + np.eye(3, dtype=np.float32)
+    del gradient
+    return np.linalg.det(jacobian)
+
+
+def warp_metrics(fixed_file:str, warped_file:str, warp_file:str=None):
+    ''' Quality metrics of a registration
+
+        Parameters
+        ----------
+        fixed_file :
+            Fixed image of the registration
+        warped_file :
+            Moving image registered to the fixed image
+        warp_file :
+            Displacement field of the registration, None to skip the Jacobian metrics
+
+        Returns
+        ----------
+        Dict of the NMI, of the Dice of the foregrounds and of the statistics of the Jacobian
+        determinant in the foreground of the fixed image
+    '''
+    fixed, _ = load_volume(fixed_file)
+    warped, _ = load_volume(warped_file)
+    if fixed.shape != warped.shape:
+        raise ValueError('"{0}" {1} is not on the grid of "{2}" {3}.'.format(
+            warped_file, warped.shape, fixed_file, fixed.shape))
+    mask = foreground(fixed)
+    metrics = {'NMI': nmi(fixed, warped, mask), 'Dice': dice(mask, foreground(warped))}
+    del warped
+    if warp_file is not None:
+        det = jacobian_determinant(warp_file)
+        if det.shape != mask.shape:
+            raise ValueError('"{0}" {1} is not on the grid of "{2}" {3}.'.format(
+                warp_file, det.shape, fixed_file, mask.shape))
+        det = det[mask] if np.any(mask) else det.ravel()
+        metrics.update({
+            'Jacobian mean': float(det.mean()), 'Jacobian std': float(det.std()),
+            'Jacobian min': float(det.min()), 'Jacobian max': float(det.max()),
+            'Folding fraction': float(np.count_nonzero(det <= 0) / det.size)})
+    return metrics
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Cohort report of the resources recorded by tools/command.py in the sidecar jsons ('Resources' entry):
+# per step percentiles of wall time, CPU time, peak memory and I/O, and the share of the total wall
+# time taken by each step. Used to see where the hours go and to size the jobs (cores, memory, walltime).
+#
+#     python -m tools.resource_report --data_path /data/PlasMA/wp_51T --out resources.csv
+
+import argparse
+import json
+import logging
+import os
+import re
+import numpy as np
+import pandas as pd
+
+from tools.command import RESOURCE_KEYS
+
+
+def buildArgsParser():
+    p = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter,
+        epilog="")
+    p._optionals.title = "Generic options"
+
+    p.add_argument('--data_path', default='/mnt/Hummel-Data/TI/mri/51T', dest='data_path',
+        help="Subjects folder path, the sidecars are searched in its derivatives folder. ['%(default)s']")
+    p.add_argument('--group_by', default='command', choices=['command', 'description'], dest='group_by',
+        help="Step definition: executable of the command or description of the sidecar. ['%(default)s']")
+    p.add_argument('--percentiles', type=float, nargs='+', default=[50, 90, 95], dest='percentiles',
+        help="Percentiles reported for each metric. ['%(default)s']")
+    p.add_argument('--out', default=None, dest='out',
+        help="Csv file the report is written to.")
+
+    log_g = p.add_argument_group('Logging options')
+    log_g.add_argument(
+        '-v', action='store_true', dest='isVerbose',
+        help='If set, produces verbose output.')
+
+    return p
+
+
+def collect_resources(data_path:str):
+    ''' One row per sidecar json with a 'Resources' entry found under data_path/derivatives '''
+    rows = []
+    for root, _, files in os.walk(os.path.join(data_path, 'derivatives')):
+        for file in files:
+            if not file.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(root, file)) as f:
+                    j = json.load(f)
+            except (ValueError, OSError) as e:
+                logging.warning('Unreadable sidecar "{0}": {1}'.format(os.path.join(root, file), e))
+                continue
+            if not isinstance(j, dict) or not j.get('Resources'):
+                continue
+            subj = re.search(r'sub-[^/_-]+', root)
+            sess = re.search(r'ses-[^/_-]+', root)
+            row = {
+                'subject': subj.group(0) if subj else '',
+                'session': sess.group(0) if sess else '',
+                'command': j['Resources'].get('Command', ''),
+                'description': j.get('Description', ''),
+                'sidecar': os.path.join(root, file),
+                }
+            row.update({key: j['Resources'].get(key, np.nan) for key in RESOURCE_KEYS})
+            rows.append(row)
+    return pd.DataFrame(rows, columns=['subject', 'session', 'command', 'description', 'sidecar'] + RESOURCE_KEYS)
+
+
+def step_report(df:pd.DataFrame, group_by:str='command', percentiles:list=(50, 90, 95)):
+    ''' Per step number of runs, total hours, share of the total wall time and percentiles of each metric '''
+    df = df.copy()
+    df['CPU time (s)'] = df['User time (s)'] + df['System time (s)']
+    metrics = ['Wall time (s)', 'CPU time (s)', 'Max RSS (MB)', 'Read (MB)', 'Written (MB)']
+
+    grouped = df.groupby(group_by)
+    report = pd.DataFrame({
+        'runs': grouped.size(),
+        'total wall (h)': grouped['Wall time (s)'].sum() / 3600,
+        'share of wall (%)': 100 * grouped['Wall time (s)'].sum() / df['Wall time (s)'].sum(),
+        })
+    for metric in metrics:
+        for q in percentiles:
+            report[metric + ' p' + '{0:g}'.format(q)] = grouped[metric].quantile(q / 100)
+        report[metric + ' max'] = grouped[metric].max()
+    return report.sort_values('total wall (h)', ascending=False)
+
+
+def session_report(df:pd.DataFrame, percentiles:list=(50, 90, 95)):
+    ''' Percentiles over sessions of the total wall time (h) and of the largest peak memory (MB) '''
+    sessions = df.groupby(['subject', 'session']).agg({'Wall time (s)': 'sum', 'Max RSS (MB)': 'max'})
+    sessions['Wall time (s)'] /= 3600
+    sessions = sessions.rename(columns={'Wall time (s)': 'wall (h)'})
+    return sessions.quantile([q / 100 for q in percentiles] + [1.0]).rename(
+        index=lambda q: 'p{0:g}'.format(100 * q) if q < 1 else 'max')
+
+
+if __name__ == "__main__":
+    parser = buildArgsParser()
+    args = parser.parse_args()
+
+    if args.isVerbose:
+        logging.basicConfig(level=logging.DEBUG)
+
+    df = collect_resources(args.data_path)
+    if df.empty:
+        print('No sidecar with resources found in ' + os.path.join(args.data_path, 'derivatives'))
+    else:
+        report = step_report(df, args.group_by, args.percentiles)
+        with pd.option_context('display.max_columns', None, 'display.width', 200, 'display.precision', 2):
+            print(report[['runs', 'total wall (h)', 'share of wall (%)'] +
+                         [c for c in report.columns if c.startswith('Wall') or c.startswith('Max RSS')]])
+            print()
+            print('Per session ({0} sessions):'.format(df.groupby(['subject', 'session']).ngroups))
+            print(session_report(df, args.percentiles))
+        if args.out:
+            report.to_csv(args.out)
@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Storage budget of the intermediates: the degibbs, APPA b0 and eddy outputs of 02_dwi_preprocessing, the
+# trash folders, the cropped grid of 06_dwi_processing... are only read by the step that wrote them, yet
+# stay next to the final files of every session. Each artefact of RETENTION lists the steps that still
+# read it (consumers): once the producer and all the consumers are done for a session, the artefact is
+# deleted, or recompressed at gzip level 9 when it is kept for quality control.
+# A step is done for a session when all its steps are done in the run ledger (tools/run_ledger.py), or, for
+# a session run before the ledger, when its final outputs are valid (STEP_OUTPUTS of tools/manifest.py).
+# The steps that are not recorded per session in the ledger have their own check (STEP_DONE): the low-b
+# subset is written and read by the tensor fit of 06_compute_scalar_maps only, done once the FA and MD maps
+# are valid whatever the lesion branch (--l) of the script did, and the ANTs warped images are read by the
+# cohort step 08_registration_qc, done for a session once the metrics of each of its warps are up to date
+# (<warp>_qc.json).
+# The temporary outputs of runs killed mid-write (tools/outputs.py) are removed after TMP_MAX_AGE hours.
+#
+# Without --apply only the report is printed (reclaimable space per session and step):
+#
+#     python -m tools.retention --data_path /mnt/Hummel-Data/TI/mri/51T --subj all --sess all
+#     python -m tools.retention --data_path /mnt/Hummel-Data/TI/mri/51T --subj all --sess all --apply
+
+import argparse
+import glob
+import gzip
+import json
+import logging
+import os
+import re
+import shutil
+import time
+
+from tools.manifest import Manifest, STEP_OUTPUTS
+from tools.outputs import TMP_PREFIX, tmp_path, commit, is_valid
+from tools.run_ledger import runs, record_run
+
+# Intermediates of each step, relative to the session folder derivatives/01_dwi/<subj>/<sess>
+RETENTION = [
+    {'name': 'degibbs', 'producer': '02_dwi_preprocessing', 'consumers': [], 'action': 'delete',
+     'files': ['dwi/preproc/{subj}_{sess}_dir-AP_degibbsDwi.nii.gz',
+               'dwi/preproc/{subj}_{sess}_dir-PA_degibbsDwi.nii.gz']},
+    {'name': 'APPA b0s', 'producer': '02_dwi_preprocessing', 'consumers': [], 'action': 'delete',
+     'files': ['dwi/preproc/{subj}_{sess}_dir-APPA_b0s.nii.gz']},
+    {'name': 'eddy', 'producer': '02_dwi_preprocessing', 'consumers': [], 'action': 'delete',
+     'files': ['dwi/preproc/{subj}_{sess}_eddy.nii.gz']},
+    {'name': 'eddy mask', 'producer': '02_dwi_preprocessing', 'consumers': [], 'action': 'compress',
+     'files': ['dwi/preproc/{subj}_{sess}_dir-APPA_meanB0.nii.gz',
+               'dwi/preproc/{subj}_{sess}_dir-APPA_meanB0brain.nii.gz']},
+    {'name': 'dwi trash', 'producer': '02_dwi_preprocessing', 'consumers': [], 'action': 'delete',
+     'files': ['dwi/preproc/trash/*']},
+    {'name': 'anat trash', 'producer': '05_anat_registration_dwi', 'consumers': [], 'action': 'delete',
+     'files': ['anat/trash/*']},
+    {'name': 'ants warped', 'producer': '05_anat_registration_dwi', 'consumers': ['08_registration_qc'],
+     'action': 'compress',
+     'files': ['warps/*Warped.nii.gz']},
+    {'name': 'crop', 'producer': '06_dwi_processing', 'consumers': [], 'action': 'delete',
+     'files': ['dwi/preproc/crop/*']},
+    {'name': 'low-b subset', 'producer': '06_compute_scalar_maps tensor fit', 'consumers': [], 'action': 'delete',
+     'files': ['dwi/proc/{subj}_{sess}_dwi_bmax*.nii.gz', 'dwi/proc/{subj}_{sess}_dwi_bmax*.bval',
+               'dwi/proc/{subj}_{sess}_dwi_bmax*.bvec', 'dwi/proc/{subj}_{sess}_dwi_bmax*.json']},
+]
+
+# Age (hours) after which a temporary output is taken for the leftover of a killed run
+TMP_MAX_AGE = 48
+
+COMPRESS_LEVEL = 9
+
+
+def buildArgsParser():
+    p = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter,
+        epilog="")
+    p._optionals.title = "Generic options"
+
+    p.add_argument('--subj', nargs='+', default=['all'], dest='subj', help="Subject index. ['%(default)s']")
+    p.add_argument('--sess', nargs='+', default=['all'], dest='sess', help="Session folder name. ['%(default)s']")
+    p.add_argument('--data_path', default='/mnt/Hummel-Data/TI/mri/51T', dest='data_path',
+        help="Subjects folder path. ['%(default)s']")
+    p.add_argument('--tmp_age', type=float, default=TMP_MAX_AGE, dest='tmp_age',
+        help="Age (hours) after which the temporary outputs are removed. ['%(default)s']")
+    p.add_argument('--apply', action='store_true', dest='isApply',
+        help='If set, deletes / recompresses the artefacts whose consumers are done, otherwise only reports.')
+
+    log_g = p.add_argument_group('Logging options')
+    log_g.add_argument(
+        '-v', action='store_true', dest='isVerbose',
+        help='If set, produces verbose output.')
+
+    return p
+
+
+def tensor_fit_done(data_path:str, manifest:Manifest, subj:str, sess:str):
+    ''' Whether the tensor fit of 06_compute_scalar_maps wrote valid FA and MD maps for the session '''
+    proc_base = os.path.join(data_path, 'derivatives', '01_dwi', subj, sess, 'dwi', 'proc', subj + '_' + sess + '_dwi')
+    return is_valid(proc_base + '_FA.nii.gz') and is_valid(proc_base + '_MD.nii.gz')
+
+
+def warps_checked(data_path:str, manifest:Manifest, subj:str, sess:str):
+    ''' Whether 08_registration_qc has the up to date metrics of every ANTs warp of the session '''
+    warp_folder = os.path.join(data_path, 'derivatives', '01_dwi', subj, sess, 'warps')
+    for warped in glob.glob(os.path.join(warp_folder, '*Warped.nii.gz')):
+        if warped.endswith('InverseWarped.nii.gz'):
+            continue
+        warp_file = warped[:-len('Warped.nii.gz')]
+        if not os.path.isfile(warp_file + '1Warp.nii.gz'):
+            continue
+        try:
+            with open(warp_file + '_qc.json') as f:
+                inputs = json.load(f)['Inputs']
+        except (OSError, ValueError, KeyError):
+            return False
+        # Stamp of the warped image when its metrics were computed (stamp of 08_registration_qc.py)
+        stamps = [i[1:] for i in inputs if os.path.basename(i[0]) == os.path.basename(warped)]
+        if stamps != [[os.path.getsize(warped), os.path.getmtime(warped)]]:
+            return False
+    return True
+
+
+# Done check of the steps that are not recorded per session in the ledger
+STEP_DONE = {
+    '06_compute_scalar_maps tensor fit': tensor_fit_done,
+    '08_registration_qc': warps_checked,
+}
+
+
+def step_done(data_path:str, manifest:Manifest, status:dict, script:str, subj:str, sess:str):
+    ''' Whether script is done for the session: all its steps done in the ledger, or its outputs valid '''
+    if script in STEP_DONE:
+        return STEP_DONE[script](data_path, manifest, subj, sess)
+    steps = status.get((script, subj, sess))
+    if steps:
+        return all(s == 'done' for s in steps)
+    return bool(STEP_OUTPUTS.get(script)) and manifest.is_complete(script, subj, sess)
+
+
+def is_compressed(path:str):
+    ''' Whether a gzip file is already at the highest compression level (XFL flag of its header) '''
+    with open(path, 'rb') as f:
+        header = f.read(10)
+    return len(header) == 10 and header[8] == 2
+
+
+def recompress(path:str):
+    ''' Rewrite a gzip file at COMPRESS_LEVEL, returns the bytes saved '''
+    before = os.path.getsize(path)
+    tmp_file = tmp_path(path)
+    try:
+        with gzip.open(path, 'rb') as src, gzip.open(tmp_file, 'wb', compresslevel=COMPRESS_LEVEL) as dst:
+            shutil.copyfileobj(src, dst, 16 * 1024 ** 2)
+        shutil.copystat(path, tmp_file)
+        commit(tmp_file, path)
+    finally:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+    return before - os.path.getsize(path)
+
+
+def session_artefacts(data_path:str, manifest:Manifest, status:dict, subj:str, sess:str):
+    ''' Artefacts of RETENTION found for a session, with their size and whether they can be reclaimed '''
+    session_folder = os.path.join(data_path, 'derivatives', '01_dwi', subj, sess)
+    artefacts = []
+    for rule in RETENTION:
+        files = sorted(set(f for pattern in rule['files']
+                           for f in glob.glob(os.path.join(session_folder, pattern.format(subj=subj, sess=sess)))
+                           if os.path.isfile(f)))
+        if rule['action'] == 'compress':
+            files = [f for f in files if not is_compressed(f)]
+        if not files:
+            continue
+        waiting = [s for s in [rule['producer']] + rule['consumers']
+                   if not step_done(data_path, manifest, status, s, subj, sess)]
+        artefacts.append({'subject': subj, 'session': sess, 'step': rule['producer'], 'name': rule['name'],
+                          'action': rule['action'], 'files': files, 'size': sum(os.path.getsize(f) for f in files),
+                          'waiting': waiting})
+    return artefacts
+
+
+def stale_tmp_files(data_path:str, max_age:float):
+    ''' Temporary outputs (tools/outputs.py) older than max_age hours under data_path/derivatives '''
+    pattern = re.compile(re.escape(TMP_PREFIX) + r'\d+_')
+    now = time.time()
+    for root, dirs, files in os.walk(os.path.join(data_path, 'derivatives')):
+        for name in dirs + files:
+            path = os.path.join(root, name)
+            if pattern.match(name) and now - os.path.getmtime(path) > max_age * 3600:
+                yield path
+
+
+def reclaim(data_path:str, artefact:dict):
+    ''' Delete or recompress the files of an artefact, returns the bytes freed '''
+    freed = 0
+    for f in artefact['files']:
+        if artefact['action'] == 'delete':
+            freed += os.path.getsize(f)
+            os.remove(f)
+        else:
+            freed += recompress(f)
+    record_run(data_path, 'retention', artefact['name'], artefact['subject'], artefact['session'], 'done',
+               outputs=artefact['files'])
+    logging.info('{0} {1}: {2} {3}, {4:.0f} MB freed.'.format(
+        artefact['subject'], artefact['session'], artefact['action'], artefact['name'], freed / 1024 ** 2))
+    return freed
+
+
+if __name__ == "__main__":
+    parser = buildArgsParser()
+    args = parser.parse_args()
+
+    if args.isVerbose:
+        logging.basicConfig(level=logging.DEBUG)
+
+    data_path = args.data_path
+    manifest = Manifest(data_path)
+    status = {}
+    for row in runs(data_path):
+        status.setdefault((row['script'], row['subject'], row['session']), []).append(row['status'])
+
+    totals = {}
+    print('{0:16} {1:14} {2:34} {3:14} {4:8} {5:>10}  {6}'.format(
+        'subject', 'session', 'step', 'artefact', 'action', 'MB', 'status'))
+    for subj, sess in manifest.select(args.subj, args.sess, 'dwi'):
+        for artefact in session_artefacts(data_path, manifest, status, subj, sess):
+            ready = not artefact['waiting']
+            print('{0:16} {1:14} {2:34} {3:14} {4:8} {5:10.1f}  {6}'.format(
+                subj, sess, artefact['step'], artefact['name'], artefact['action'], artefact['size'] / 1024 ** 2,
+                'ready' if ready else 'waiting for ' + ', '.join(artefact['waiting'])))
+            total = totals.setdefault(artefact['step'], [0, 0])
+            total[0] += artefact['size']
+            # The gain of a recompression is only known once it is done
+            if ready and args.isApply:
+                total[1] += reclaim(data_path, artefact)
+            elif ready and artefact['action'] == 'delete':
+                total[1] += artefact['size']
+
+    stale = list(stale_tmp_files(data_path, args.tmp_age))
+    size = sum(os.path.getsize(f) for f in stale if os.path.isfile(f))
+    totals['temporary outputs'] = [size, size]
+    if args.isApply:
+        for f in stale:
+            if os.path.isdir(f):
+                shutil.rmtree(f)
+            else:
+                os.remove(f)
+
+    print('')
+    print('{0:34} {1:>12} {2:>14}'.format('step', 'MB', 'freed' if args.isApply else 'reclaimable'))
+    for step, (size, reclaimable) in totals.items():
+        print('{0:34} {1:12.1f} {2:14.1f}'.format(step, size / 1024 ** 2, reclaimable / 1024 ** 2))
@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# ROI studies of the roi-to-roi analysis (roi_analysis/11 to 14), one json file per study in
+# roi_analysis/studies instead of the lists written in each script:
+#   - atlases : images in MNI space (relative to data_path/derivatives/01_mni, or absolute) registered to
+#               the dwi space of every session by 11_register_rois_MNI2B0.py, through the T1 ("t1") or the
+#               brain extracted T1 ("t1_brain"). "output" is the registered file relative to
+#               derivatives/01_tracts/<subj>/<sess>, without the "_<space>_ants.nii.gz" suffix.
+#   - rois    : nodes of the parcellation, in the order of its labels. A roi is a label of an atlas
+#               (i.e. a cluster index) or, without label, the whole atlas (i.e. a striatum roi). A voxel
+#               of several rois goes to the one with the highest "priority" (0 by default), to the last
+#               one of the list for equal priorities (see paint_order).
+#   - pairs   : tracts extracted by 13_dwi_extract_tracts_tckedit.py, "all" for every pair of rois.
+#   - views   : subsets of the connectivity matrix formated by 14_formate_data.py, the pairs with one of
+#               "nodes" (all the pairs if not given) and none of "exclude".
+# An atlas or a roi used by several studies is the same for all of them (same name, same definition):
+# it is registered once per session and the tracts of all the studies come from one pass over the
+# tractogram (13_dwi_extract_tracts_tckedit.py). A new hypothesis is a new file in roi_analysis/studies.
+#
+#     python 13_dwi_extract_tracts_tckedit.py --subj all --sess all --study fMRI_study
+
+import itertools
+import json
+import os
+
+STUDY_FOLDER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'roi_analysis', 'studies')
+ATLAS_FOLDER = os.path.join('derivatives', '01_mni')
+
+# Reference of the MNI to T1 registration: (warp name, T1 file relative to data_path)
+REFERENCES = {
+    't1': ('MNI2Tw1_ants', '{subj}/{sess}/anat/{subj}_{sess}_T1w.nii.gz'),
+    't1_brain': ('MNI2Tw1brain_ants', 'derivatives/01_dwi/{subj}/{sess}/anat/{subj}_{sess}_acq-mprage_T1wbrain.nii.gz'),
+}
+
+
+def study_names():
+    ''' Studies of STUDY_FOLDER '''
+    return sorted(os.path.splitext(f)[0] for f in os.listdir(STUDY_FOLDER) if f.endswith('.json'))
+
+
+def load_study(name:str):
+    ''' Read and check a study, name being a file of STUDY_FOLDER (without .json) or a json file
+
+        Returns
+        ----------
+        Study dict, with the defaults filled in and "pairs" as a list of (roi, roi) tuples
+    '''
+    path = name if name.endswith('.json') else os.path.join(STUDY_FOLDER, name + '.json')
+    with open(path) as f:
+        study = json.load(f)
+    study.setdefault('name', os.path.splitext(os.path.basename(path))[0])
+    study.setdefault('description', '')
+    study.setdefault('pairs', 'all')
+    study.setdefault('views', {})
+
+    def error(message):
+        return ValueError('Study "{0}" ({1}): {2}'.format(study['name'], path, message))
+
+    for atlas_name, atlas in study.get('atlases', {}).items():
+        if 'file' not in atlas:
+            raise error('atlas "{0}" has no file'.format(atlas_name))
+        atlas.setdefault('reference', 't1_brain')
+        atlas.setdefault('output', 'atlases/{subj}_{sess}_' + atlas_name)
+        if atlas['reference'] not in REFERENCES:
+            raise error('atlas "{0}": reference must be one of {1}'.format(atlas_name, ', '.join(REFERENCES)))
+
+    names = [roi.get('name') for roi in study.get('rois', [])]
+    if not names or None in names or len(set(names)) != len(names):
+        raise error('rois must be a non-empty list of rois with distinct names')
+    for roi in study['rois']:
+        if roi.get('atlas') not in study.get('atlases', {}):
+            raise error('roi "{0}" refers to an unknown atlas "{1}"'.format(roi['name'], roi.get('atlas')))
+        if 'label' in roi and not isinstance(roi['label'], int):
+            raise error('roi "{0}": label must be an integer'.format(roi['name']))
+        if not isinstance(roi.get('priority', 0), int):
+            raise error('roi "{0}": priority must be an integer'.format(roi['name']))
+
+    if study['pairs'] == 'all':
+        study['pairs'] = list(itertools.combinations(names, 2))
+    study['pairs'] = [tuple(pair) for pair in study['pairs']]
+    for pair in study['pairs']:
+        if len(pair) != 2 or pair[0] == pair[1] or not set(pair) <= set(names):
+            raise error('pair {0} is not a pair of distinct rois of the study'.format(list(pair)))
+
+    for view_name, view in study['views'].items():
+        view.setdefault('output', view_name + '.csv')
+        view.setdefault('nodes', [])
+        view.setdefault('exclude', [])
+        if not set(view['nodes'] + view['exclude']) <= set(names):
+            raise error('view "{0}" refers to rois that are not in the study'.format(view_name))
+    return study
+
+
+def load_studies(names:list):
+    ''' Studies of the --study argument ("all" for every study of STUDY_FOLDER), checked against each other '''
+    studies = [load_study(name) for name in (study_names() if 'all' in names else names)]
+    atlases, rois, views = {}, {}, {}
+    for study in studies:
+        for atlas_name, atlas in study['atlases'].items():
+            if atlases.setdefault(atlas_name, atlas) != atlas:
+                raise ValueError('Atlas "{0}" of study "{1}" differs from the one of another study.'.format(
+                    atlas_name, study['name']))
+        for roi in study['rois']:
+            if rois.setdefault(roi['name'], roi) != roi:
+                raise ValueError('Roi "{0}" of study "{1}" differs from the one of another study.'.format(
+                    roi['name'], study['name']))
+        for view_name, view in study['views'].items():
+            if views.setdefault(view['output'], study['name']) != study['name']:
+                raise ValueError('Output "{0}" of study "{1}" is written by another study.'.format(
+                    view['output'], study['name']))
+    return studies
+
+
+def atlases(studies:list):
+    ''' Atlases of the studies, each once '''
+    return {name: atlas for study in studies for name, atlas in study['atlases'].items()}
+
+
+def rois(studies:list):
+    ''' Rois of the studies, each once, in the order of the studies '''
+    return list({roi['name']: roi for study in studies for roi in study['rois']}.values())
+
+
+def labels(study:dict):
+    ''' Roi names, in the order of the labels of the parcellation (label i + 1 for labels[i]) '''
+    return [roi['name'] for roi in study['rois']]
+
+
+def paint_order(rois:list):
+    ''' Indices of rois in the order their masks are written in a parcellation, the last one written
+        keeping a shared voxel: increasing priority, then the order of the list '''
+    return sorted(range(len(rois)), key=lambda i: (rois[i].get('priority', 0), i))
+
+
+def tract_folder(data_path:str, subj:str, sess:str):
+    return os.path.join(data_path, "derivatives", "01_tracts", subj, sess)
+
+
+def study_folder(data_path:str, subj:str, sess:str, study:dict):
+    return os.path.join(tract_folder(data_path, subj, sess), 'roi2roi', study['name'])
+
+
+def atlas_source(data_path:str, atlas:dict):
+    ''' Atlas file in MNI space '''
+    return os.path.join(data_path, ATLAS_FOLDER, atlas['file'])
+
+
+def atlas_file(data_path:str, subj:str, sess:str, atlas:dict, space:str='dwi'):
+    ''' Atlas registered to "Tw1" or "dwi" space '''
+    output = atlas['output'].format(subj=subj, sess=sess)
+    return os.path.join(tract_folder(data_path, subj, sess), output + '_' + space + '_ants.nii.gz')
+
+
+def roi_mask(data_path:str, subj:str, sess:str, study:dict, roi:dict):
+    ''' Binary mask of a roi in dwi space: the registered atlas, or its label extracted by 12_create_parc.py '''
+    if 'label' not in roi:
+        return atlas_file(data_path, subj, sess, study['atlases'][roi['atlas']])
+    return os.path.join(study_folder(data_path, subj, sess, study), 'masks',
+                        subj + '_' + sess + "_roi_" + roi['name'] + '_mask.nii.gz')
+
+
+def parcellation_file(data_path:str, subj:str, sess:str, study:dict):
+    return os.path.join(study_folder(data_path, subj, sess, study), 'masks', subj + "_" + sess + "_global_mask.nii.gz")
+
+
+def connectome_file(data_path:str, subj:str, sess:str, study:dict):
+    return os.path.join(study_folder(data_path, subj, sess, study), subj + "_" + sess + "_connect_matrix.csv")
+
+
+def tract_file(data_path:str, subj:str, sess:str, study:dict, pair:tuple, suffix:str='.tck'):
+    ''' Tract of a pair of rois (suffix ".tck") or its SIFT2 weights (suffix "_sift2.txt") '''
+    return os.path.join(study_folder(data_path, subj, sess, study), 'tracts_tckedit',
+                        subj + "_" + sess + "_" + pair[0] + "-" + pair[1] + suffix)
@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Cohort run ledger, replacing the fail_list_<script>_<datetime>.txt files.
+# A single SQLite file per data folder records for each (script, step, subject, session) the status of
+# the last run (running, done, failed or skipped), the number of attempts, the error and end of stderr,
+# the duration and the outputs written.
+# The ledger is on a local disk, in LEDGER_FOLDER (or the folder of the environment variable LEDGER_ENV),
+# named after the absolute data path: the locks of SQLite are not reliable over NFS/SMB, and a ledger on
+# the /mnt/Hummel-Data share could be corrupted or lose rows when several runs write it at once. The
+# runs of a cohort that record in the same ledger have to be on the same machine. A ledger of a previous
+# version (derivatives/run_ledger.sqlite of the data folder) is copied to the local folder on first use.
+# The numbered scripts run each session through run_step and select the sessions to run with
+# select_sessions, so that --only-failed / --only-pending re-run only the sessions that need it:
+#
+#     python 02_dwi_preprocessing.py --subj all --sess all --only-failed
+#     python -m tools.run_ledger --data_path /mnt/Hummel-Data/TI/mri/51T --status failed
+#
+# A step whose upstream steps failed or were skipped for a session is skipped at once (SessionFailedError)
+# instead of running on missing inputs. Re-running the failed step successfully clears the failure.
+
+import argparse
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import time
+
+from tools import command
+from tools.command import CommandError
+
+LEDGER_NAME = 'run_ledger.sqlite'
+LEDGER_FOLDER = os.path.join(os.path.expanduser('~'), '.cache', 'dwi_pipeline', 'ledgers')
+LEDGER_ENV = 'DWI_LEDGER_FOLDER'
+
+# Direct dependencies between the steps (script names without extension)
+DEPENDENCIES = {
+    '02_dwi_preprocessing': [],
+    '03_lesionTransplantation_anat': [],
+    '04_freesurfer': [],
+    '05_anat_registration_dwi': ['02_dwi_preprocessing', '04_freesurfer'],
+    '05_lesion_registration': ['05_anat_registration_dwi'],
+    '05_T1w2MNI_reg': ['05_anat_registration_dwi'],
+    '06_dwi_processing': ['05_anat_registration_dwi'],
+    '06_compute_scalar_maps': ['02_dwi_preprocessing'],
+    '11_register_rois_MNI2B0': ['05_anat_registration_dwi'],
+    '12_create_parc': ['11_register_rois_MNI2B0'],
+    '13_dwi_extract_tracts_tckedit': ['06_dwi_processing', '06_compute_scalar_maps', '12_create_parc'],
+    '13_seed_based': ['06_dwi_processing', '06_compute_scalar_maps', '11_register_rois_MNI2B0'],
+}
+
+
+class SessionFailedError(RuntimeError):
+    ''' An upstream step failed for this session '''
+
+
+def buildArgsParser():
+    p = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter,
+        epilog="")
+    p._optionals.title = "Generic options"
+
+    p.add_argument('--data_path', default='/mnt/Hummel-Data/TI/mri/51T', dest='data_path',
+        help="Subjects folder path, whose ledger is read (see ledger_file). ['%(default)s']")
+    p.add_argument('--script', default=None, dest='script',
+        help="Only the runs of this script (i.e. 02_dwi_preprocessing).")
+    p.add_argument('--status', default=None, choices=['running', 'done', 'failed', 'skipped'], dest='status',
+        help="Only the runs with this status.")
+
+    log_g = p.add_argument_group('Logging options')
+    log_g.add_argument(
+        '-v', action='store_true', dest='isVerbose',
+        help='If set, produces verbose output.')
+
+    return p
+
+
+def ledger_file(data_path:str):
+    ''' Local ledger of data_path: <LEDGER_FOLDER>/<absolute data path, "_" for the separators>_run_ledger.sqlite '''
+    folder = os.environ.get(LEDGER_ENV) or LEDGER_FOLDER
+    name = os.path.abspath(data_path).strip(os.sep).replace(os.sep, '_')
+    return os.path.join(folder, name + '_' + LEDGER_NAME)
+
+
+def legacy_ledger_file(data_path:str):
+    ''' Ledger of the previous versions, in the derivatives folder of data_path '''
+    return os.path.join(data_path, 'derivatives', LEDGER_NAME)
+
+
+def ledger_exists(data_path:str):
+    return os.path.isfile(ledger_file(data_path)) or os.path.isfile(legacy_ledger_file(data_path))
+
+
+def connect(data_path:str):
+    ''' Connection to the ledger of data_path, created if needed '''
+    filename = ledger_file(data_path)
+    if not os.path.exists(os.path.dirname(filename)):
+        os.makedirs(os.path.dirname(filename))
+    legacy_file = legacy_ledger_file(data_path)
+    if not os.path.exists(filename) and os.path.isfile(legacy_file):
+        logging.info('Ledger "{0}" copied to "{1}".'.format(legacy_file, filename))
+        shutil.copy2(legacy_file, filename)
+    # Several scripts may run at once on the cohort: wait for the lock instead of failing
+    con = sqlite3.connect(filename, timeout=60)
+    con.row_factory = sqlite3.Row
+    con.execute('''CREATE TABLE IF NOT EXISTS runs (
+        script TEXT, step TEXT, subject TEXT, session TEXT,
+        status TEXT, attempts INTEGER DEFAULT 0, error TEXT, stderr TEXT,
+        duration REAL, outputs TEXT, updated TEXT,
+        PRIMARY KEY (script, step, subject, session))''')
+    return con
+
+
+def runs(data_path:str, script:str=None, status:str=None):
+    ''' Rows of the ledger (dicts), optionally of one script and/or one status '''
+    if not ledger_exists(data_path):
+        return []
+    query, params = 'SELECT * FROM runs WHERE 1', []
+    if script is not None:
+        query += ' AND script = ?'
+        params.append(script)
+    if status is not None:
+        query += ' AND status = ?'
+        params.append(status)
+    with connect(data_path) as con:
+        rows = con.execute(query + ' ORDER BY script, subject, session, step', params).fetchall()
+    con.close()
+    return [dict(row) for row in rows]
+
+
+def record_run(data_path:str, script:str, step:str, subj:str, sess:str, status:str, error:Exception=None,
+               duration:float=None, outputs:list=(), attempt:bool=False):
+    ''' Write the status of a step for a session, attempt counts a new run of the step '''
+    message, stderr = None, None
+    if error is not None:
+        message = str(error).split('\n')[0]
+        if isinstance(error, CommandError):
+            stderr = error.stderr
+    with connect(data_path) as con:
+        con.execute('INSERT OR IGNORE INTO runs (script, step, subject, session) VALUES (?, ?, ?, ?)',
+                    (script, step, subj, sess))
+        con.execute('''UPDATE runs SET status = ?, attempts = attempts + ?, error = ?, stderr = ?, duration = ?,
+                       outputs = ?, updated = ? WHERE script = ? AND step = ? AND subject = ? AND session = ?''',
+                    (status, int(attempt), message, stderr, duration, json.dumps(list(outputs)), time.asctime(),
+                     script, step, subj, sess))
+    con.close()
+
+
+def upstream_steps(step:str):
+    ''' All the steps step depends on, directly or not '''
+    found = []
+    todo = list(DEPENDENCIES.get(step, []))
+    while todo:
+        dep = todo.pop()
+        if dep not in found:
+            found.append(dep)
+            todo.extend(DEPENDENCIES.get(dep, []))
+    return found
+
+
+def check_upstream(data_path:str, subj:str, sess:str, script:str):
+    ''' Raise SessionFailedError if a step the given script depends on failed for this session '''
+    upstream = upstream_steps(script)
+    if not upstream or not ledger_exists(data_path):
+        return
+    with connect(data_path) as con:
+        failed = con.execute('''SELECT script, error FROM runs WHERE subject = ? AND session = ?
+                                AND status IN ('failed', 'skipped') AND script IN ({0})'''.format(
+                                ','.join('?' * len(upstream))), [subj, sess] + upstream).fetchall()
+    con.close()
+    if failed:
+        message = '{0} skipped for {1} {2}: {3} failed ({4})'.format(
+            script, subj, sess, ', '.join(sorted(set(row['script'] for row in failed))), failed[0]['error'])
+        logging.warning(message)
+        raise SessionFailedError(message)
+
+
+def is_selected(status:list, only_failed:bool=False, only_pending:bool=False):
+    ''' Whether a session whose steps have the given statuses has to be run
+
+        Without selector every session is run. --only-failed selects the sessions with a failed
+        or skipped step, --only-pending the sessions never run or interrupted (running),
+        both together the union of the two.
+    '''
+    if not (only_failed or only_pending):
+        return True
+    failed = any(s in ('failed', 'skipped') for s in status)
+    pending = not status or any(s == 'running' for s in status)
+    return (only_failed and failed) or (only_pending and pending)
+
+
+def select_sessions(data_path:str, script:str, pairs:list, only_failed:bool=False, only_pending:bool=False):
+    ''' (subject, session) pairs to run for script according to the selectors '''
+    if not (only_failed or only_pending):
+        return pairs
+    status = {}
+    for row in runs(data_path, script):
+        status.setdefault((row['subject'], row['session']), []).append(row['status'])
+    selected = [pair for pair in pairs if is_selected(status.get(pair, []), only_failed, only_pending)]
+    logging.info('{0}: {1} of {2} sessions selected from the ledger.'.format(script, len(selected), len(pairs)))
+    return selected
+
+
+def run_step(data_path:str, script:str, subj:str, sess:str, function, *args, step:str=None, **kwargs):
+    ''' Run function(*args, **kwargs) for a session and record the run in the ledger
+
+        Parameters
+        ----------
+        data_path :
+            Subjects folder path, holding the ledger
+        script :
+            Script name without extension, key of DEPENDENCIES
+        subj, sess :
+            Session of the run
+        function :
+            Processing function of the script
+        step :
+            Name of the step in the ledger, the function name by default
+
+        Returns
+        ----------
+        True if the step succeeded, False if it failed or was skipped (the error is in the ledger)
+    '''
+    step = step or function.__name__
+    try:
+        check_upstream(data_path, subj, sess, script)
+    except SessionFailedError as e:
+        record_run(data_path, script, step, subj, sess, 'skipped', e)
+        return False
+
+    record_run(data_path, script, step, subj, sess, 'running', attempt=True)
+    del command.OUTPUTS[:]
+    start = time.time()
+    try:
+        function(*args, **kwargs)
+    except Exception as e:
+        logging.error('{0} failed for {1} {2}: {3}'.format(step, subj, sess, e))
+        record_run(data_path, script, step, subj, sess, 'failed', e, time.time() - start, command.OUTPUTS)
+        return False
+    record_run(data_path, script, step, subj, sess, 'done', None, time.time() - start, command.OUTPUTS)
+    return True
+
+
+if __name__ == "__main__":
+    parser = buildArgsParser()
+    args = parser.parse_args()
+
+    if args.isVerbose:
+        logging.basicConfig(level=logging.DEBUG)
+
+    for row in runs(args.data_path, args.script, args.status):
+        print('{script:30} {step:28} {subject:16} {session:14} {status:8} {attempts:3} {duration:>9} {error}'.format(
+            **dict(row, duration='{0:.1f}s'.format(row['duration']) if row['duration'] is not None else '',
+                   error=row['error'] or '')))
@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Staging of the sessions on a local disk (i.e. NVMe scratch) around the I/O heavy steps, so that eddy,
+# tckgen or tcksift2 read and write local files instead of the /mnt/Hummel-Data share.
+# With --scratch, the declared inputs of a session (STAGED_STEPS, folders relative to data_path) are copied
+# to <scratch>/<subj>_<sess>, which mirrors the layout of data_path, and the step is run with this folder
+# as data_path. The inputs of the next session are copied while the current one is computing and the
+# declared outputs are written back to the share in the background once the step is over: the compute
+# only waits on the network for the first session. A written back file is copied to a temporary name,
+# checked against the size of the local file and renamed, the local copy of the session is removed once
+# all its outputs are back. A failed write-back is recorded in the run ledger (step "write_back").
+#
+#     python 06_dwi_processing.py --subj all --sess all --scratch /scratch/$USER/dwi
+
+import concurrent.futures
+import logging
+import os
+import shutil
+import time
+
+from tools.run_ledger import record_run
+
+# Inputs and outputs of the staged steps: folders relative to data_path
+STAGED_STEPS = {
+    '02_dwi_preprocessing': {
+        'inputs': ['{subj}/{sess}/dwi',
+                   'derivatives/01_dwi/{subj}/{sess}/dwi/preproc'],
+        'outputs': ['derivatives/01_dwi/{subj}/{sess}/dwi/preproc']},
+    '05_anat_registration_dwi': {
+        'inputs': ['{subj}/{sess}/anat',
+                   '{subj}/{sess}/dwi',
+                   'derivatives/01_freesurfer/{subj}-{sess}/mri',
+                   'derivatives/01_dwi/{subj}/{sess}/anat',
+                   'derivatives/01_dwi/{subj}/{sess}/dwi/preproc',
+                   'derivatives/01_dwi/{subj}/{sess}/warps'],
+        'outputs': ['derivatives/01_dwi/{subj}/{sess}/anat',
+                    'derivatives/01_dwi/{subj}/{sess}/dwi/preproc',
+                    'derivatives/01_dwi/{subj}/{sess}/warps']},
+    '06_dwi_processing': {
+        'inputs': ['derivatives/01_dwi/{subj}/{sess}/dwi/preproc',
+                   'derivatives/01_dwi/{subj}/{sess}/dwi/proc'],
+        'outputs': ['derivatives/01_dwi/{subj}/{sess}/dwi/preproc',
+                    'derivatives/01_dwi/{subj}/{sess}/dwi/proc']},
+    '06_compute_scalar_maps': {
+        'inputs': ['derivatives/01_dwi/{subj}/{sess}/anat',
+                   'derivatives/01_dwi/{subj}/{sess}/dwi/preproc',
+                   'derivatives/01_dwi/{subj}/{sess}/dwi/proc',
+                   'derivatives/01_dwi/{subj}/{sess}/warps'],
+        'outputs': ['derivatives/01_dwi/{subj}/{sess}/dwi/proc',
+                    'derivatives/01_dwi/{subj}/{sess}/lesion',
+                    'derivatives/01_dwi/{subj}/{sess}/warps']},
+}
+
+
+def sync_tree(src:str, dst:str, verify:bool=False):
+    ''' Copy the files of src missing or different (size, mtime) in dst, returns the number of bytes copied
+
+        With verify, each file is written to a temporary name, checked against the size of the source
+        and renamed, so that a partially written file never appears under its final name.
+    '''
+    copied = 0
+    for root, _, files in os.walk(src):
+        target_root = os.path.join(dst, os.path.relpath(root, src))
+        if not os.path.exists(target_root):
+            os.makedirs(target_root)
+        for file in files:
+            source, target = os.path.join(root, file), os.path.join(target_root, file)
+            stat = os.stat(source)
+            try:
+                target_stat = os.stat(target)
+                if target_stat.st_size == stat.st_size and int(target_stat.st_mtime) == int(stat.st_mtime):
+                    continue
+            except OSError:
+                pass
+            if verify:
+                tmp_file = os.path.join(target_root, '.' + file + '.staging')
+                shutil.copy2(source, tmp_file)
+                if os.path.getsize(tmp_file) != stat.st_size:
+                    os.remove(tmp_file)
+                    raise IOError('Incomplete copy of "{0}" to "{1}"'.format(source, target))
+                os.replace(tmp_file, target)
+            else:
+                shutil.copy2(source, target)
+            copied += stat.st_size
+    return copied
+
+
+class Stager:
+    ''' Prefetch, local run folder and write-back of the sessions of a step, a no-op without scratch '''
+
+    def __init__(self, data_path:str, scratch:str, script:str):
+        self.data_path = data_path
+        self.scratch = scratch if scratch and script in STAGED_STEPS else None
+        self.script = script
+        if scratch and self.scratch is None:
+            logging.warning('{0} is not staged (not in STAGED_STEPS): run on "{1}".'.format(script, data_path))
+        self.prefetch_pool = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.write_back_pool = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.write_backs = {}
+
+    def path(self, subj:str, sess:str):
+        ''' data_path given to the step for a session '''
+        if self.scratch is None:
+            return self.data_path
+        return os.path.join(self.scratch, subj + '_' + sess)
+
+    def _folders(self, key:str, subj:str, sess:str):
+        return [folder.format(subj=subj, sess=sess) for folder in STAGED_STEPS[self.script][key]]
+
+    def _prefetch(self, subj:str, sess:str):
+        start, copied = time.time(), 0
+        for folder in self._folders('inputs', subj, sess):
+            source = os.path.join(self.data_path, folder)
+            if os.path.isdir(source):
+                copied += sync_tree(source, os.path.join(self.path(subj, sess), folder))
+        logging.info('{0} {1}: {2:.0f} MB staged in {3:.1f} s.'.format(subj, sess, copied / 1024 ** 2, time.time() - start))
+
+    def _write_back(self, subj:str, sess:str):
+        start, copied = time.time(), 0
+        for folder in self._folders('outputs', subj, sess):
+            local = os.path.join(self.path(subj, sess), folder)
+            if os.path.isdir(local):
+                copied += sync_tree(local, os.path.join(self.data_path, folder), verify=True)
+        shutil.rmtree(self.path(subj, sess))
+        logging.info('{0} {1}: {2:.0f} MB written back in {3:.1f} s.'.format(subj, sess, copied / 1024 ** 2, time.time() - start))
+
+    def sessions(self, pairs:list):
+        ''' Iterate over pairs, the inputs of a session being staged while the previous one is computing '''
+        pairs = list(pairs)
+        if self.scratch is None:
+            yield from pairs
+            return
+        prefetch = {}
+        for i, (subj, sess) in enumerate(pairs):
+            if i == 0:
+                prefetch[0] = self.prefetch_pool.submit(self._prefetch, subj, sess)
+            if i + 1 < len(pairs):
+                prefetch[i + 1] = self.prefetch_pool.submit(self._prefetch, *pairs[i + 1])
+            try:
+                prefetch.pop(i).result()
+            except Exception as e:
+                logging.error('Staging of {0} {1} failed: {2}'.format(subj, sess, e))
+                record_run(self.data_path, self.script, 'prefetch', subj, sess, 'failed', e)
+                shutil.rmtree(self.path(subj, sess), ignore_errors=True)
+                continue
+            record_run(self.data_path, self.script, 'prefetch', subj, sess, 'done')
+            yield subj, sess
+
+    def write_back(self, subj:str, sess:str):
+        ''' Write the outputs of a session back to the share in the background '''
+        if self.scratch is not None:
+            self.write_backs[(subj, sess)] = self.write_back_pool.submit(self._write_back, subj, sess)
+
+    def close(self):
+        ''' Wait for the write-backs, a failed one is recorded in the ledger and its local copy kept '''
+        self.prefetch_pool.shutdown()
+        for (subj, sess), future in self.write_backs.items():
+            try:
+                future.result()
+                record_run(self.data_path, self.script, 'write_back', subj, sess, 'done')
+            except Exception as e:
+                logging.error('Write-back of {0} {1} failed, local copy kept in "{2}": {3}'.format(
+                    subj, sess, self.path(subj, sess), e))
+                record_run(self.data_path, self.script, 'write_back', subj, sess, 'failed', e)
+        self.write_back_pool.shutdown()
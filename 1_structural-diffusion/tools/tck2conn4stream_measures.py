@@ -8,37 +8,24 @@ from copy import copy
 from genericpath import isfile
 import logging
 import os
-import nibabel as nib
 import numpy as np
-import pandas as pd
-from pandas import array
-from turtle import isvisible
 import itertools
 from datetime import datetime
 import json
-import subprocess
 import time
 import csv
+from tools.command import run_cmd
+from tools.outputs import is_valid
+from tools import roi_study
+from tools.weights import read_weights
 
-# to uncommant if want visualization and graph
-#import matplotlib.pyplot as plt
-#import matplotlib as mpl
+# pandas, nibabel and matplotlib are imported by the functions using them: the extraction scripts
+# import this module without needing them
 
 
 def extract_weights_sum(weights_file):
-    # opening the file in read mode
-    weights_to_read = open(weights_file, "r")
-                    
-    # reading the file
-    weights = weights_to_read.read()
-                    
-    # replacing end of line('/n') with ' ' and
-    # splitting the text it further when '.' is seen.
-    weights_list_tmp = weights.split(" ")
-                    
-    # close the file
-    weights_to_read.close()
-    weights_list = [float(i) for i in weights_list_tmp[:-1]]
+    # reading the file, from its binary cache after the first read (tools/weights.py)
+    weights_list = read_weights(weights_file)
 
     # sum 
     weights_stream_sum = np.sum(weights_list)
@@ -46,14 +33,13 @@ def extract_weights_sum(weights_file):
     return weights_stream_sum
 
 def get_sum_of_weights(subj:str, sess:str, data_path:str, tracts:list, current_folder:str, isVerbose:bool, isForce:bool):
-    rois = ['Loc_NA_Postcentral_L', 'Loc_NA_Cerebellum', 'Thal_IL_R', 'Precentral_L', 'Supp_Motor_Area_R']
-    striat = ['v_d_Ca_L', 'v_d_Ca_R', 'vm_dl_PU_L', 'vm_dl_PU_R']
-    tot= striat + rois
+    # Rois of the pairs (study['pairs'] of tools/roi_study.py), in their order of appearance
+    tot = list(dict.fromkeys(roi for tract in tracts for roi in tract))
 
     # Define streamlines file
     tract_folder_path = os.path.join(current_folder, "tracts_tckedit")
     
-    sum_of_weight = np.zeros([9,9])
+    sum_of_weight = np.zeros([len(tot), len(tot)])
         
     for tract in tracts :
         weights_file = os.path.join(tract_folder_path, subj + "_" + sess + '_' + tract[0] + '-'+ tract[1] + '_sift2.txt')
@@ -66,6 +52,7 @@ def get_sum_of_weights(subj:str, sess:str, data_path:str, tracts:list, current_f
         else : 
             print('problem of file location')
 
+    import pandas as pd
     output_path = current_folder
     df = pd.DataFrame(sum_of_weight, columns=tot)
     df.to_csv(os.path.join(output_path, subj + "_" + sess + '_' + 'metrics_sumofweights.csv'), index = False)
@@ -100,7 +87,9 @@ def extract_stream_metrics(subjects:list, session:list, data_path:str, tracts:li
         isForce :
             Boolean indicating if files have to be overwritten
     '''
-    
+    import nibabel as nib
+    import pandas as pd
+
     subj_vec = []
     sess_vec = []
     tracts_vec = []
@@ -135,19 +124,8 @@ def extract_stream_metrics(subjects:list, session:list, data_path:str, tracts:li
                     weights_file = os.path.join(tract_folder_path, \
                         subj + "_" + sess + '_' + tract + '_sift2.txt')
 
-                    # opening the file in read mode
-                    weights_to_read = open(weights_file, "r")
-                    
-                    # reading the file
-                    weights = weights_to_read.read()
-                    
-                    # replacing end of line('/n') with ' ' and
-                    # splitting the text it further when '.' is seen.
-                    weights_list_tmp = weights.split(" ")
-                    
-                    # close the file
-                    weights_to_read.close()
-                    weights_list = [float(i) for i in weights_list_tmp[:-1]]
+                    # reading the file, from its binary cache after the first read (tools/weights.py)
+                    weights_list = read_weights(weights_file)
 
                     # Define output FA file
                     FA_val = os.path.join(output_path, 'FA_csv', \
@@ -163,7 +141,7 @@ def extract_stream_metrics(subjects:list, session:list, data_path:str, tracts:li
                         " " + FA_val + " -stat_tck mean -force"
                     logging.info('tcksample command: "{0}".'.format(tcksample_cmd))
                     print(tcksample_cmd)
-                    subprocess.call(tcksample_cmd, shell=True)
+                    run_cmd(tcksample_cmd, check=False)  # a failed tract is reported as out of bound below
 
                     with open(FA_val, newline='') as csvfile:
                         try :
@@ -245,31 +223,20 @@ def tckfortract(subj:str, sess:str, data_path:str, tracts:list, current_folder:s
         if not os.path.exists(os.path.join(current_folder,'test_tck2connectom')):
             os.mkdir(os.path.join(current_folder,'test_tck2connectom'))
         
-        if os.path.isfile(connectome) and not isForce: 
+        if is_valid(connectome) and not isForce: 
             logging.info('connectom already done: "{0}".'.format(connectome))
         else:
             tck2connectome_cmd = 'tck2connectome ' + tck_file + ' ' + parcellation_file+ ' ' + connectome + ' -tck_weights_in ' +  sift_file + ' -force' 
 
             logging.info('tck2connectome command: "{0}".'.format(tck2connectome_cmd))
-            subprocess.call(tck2connectome_cmd, shell=True)
+            run_cmd(tck2connectome_cmd, outputs=[connectome])
         
 ### ---------------visualization-----------------
 # Don't work because don't have Matplotlib on the server - Run them locally! 
 
-def connectivity_matrix(df, lim_sup=6000, title = 'connectivity matrix') : 
-    
-    connectivity = np.zeros([9,9])
-
-    for i, row in enumerate(df.to_numpy()):
-        if isinstance(row[0], str): row = row[0].split(' ')
-            
-        for j, el in enumerate(row): 
-            connectivity[i,j] = el
-
-    #load the labels
-    df_lab = pd.read_csv('sub-51T01_ses-baseline_global_mask.csv')
-
-    labels = [lab[1] for lab in df_lab.to_numpy()]
+def connectivity_matrix(connectivity, labels:list, lim_sup=6000, title = 'connectivity matrix') : 
+    import matplotlib as mpl
+    import matplotlib.pyplot as plt
 
 
     # To saturate the heatmap
@@ -305,11 +272,11 @@ def connectivity_matrix(df, lim_sup=6000, title = 'connectivity matrix') :
     fig.tight_layout()
     plt.show()
 
-def print_connect_matrix(subj:str, sess:str, data_path:str, tracts:list, isVerbose:bool, isForce:bool):
-    file= os.path.join(data_path, '01_tracts', subj, sess,'roi2roi','fMRI_study', subj + "_" + sess + '_connect_matrix.csv')
-    df = pd.read_csv(file)
+def print_connect_matrix(subj:str, sess:str, data_path:str, study:dict, isVerbose:bool, isForce:bool):
+    file= roi_study.connectome_file(data_path, subj, sess, study)
+    connectivity = np.loadtxt(file, ndmin=2)
 
-    connectivity_matrix(df, lim_sup = 5000, title = f'Connectivity matrix: {subj}, {sess}')
+    connectivity_matrix(connectivity, roi_study.labels(study), lim_sup = 5000, title = f'Connectivity matrix: {subj}, {sess}, {study["name"]}')
     
 
 
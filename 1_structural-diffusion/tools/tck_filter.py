@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Inclusion filter of several seeds in one pass over a tractogram, instead of one "tckedit -include" and
+# one "tck2connectome" per seed (two reads of the whole tractogram per seed).
+# The seed masks (same grid) are merged in one bitset volume, bit k set in the voxels of seed k. The
+# points of the tractogram are read in chunks, looked up in that volume and OR-ed per streamline: a
+# streamline is included in seed k when one of its points is in the seed (tckedit -include), and counted
+# in the metric of seed k when both its end points are (the single-node connectome of tck2connectome,
+# with the end voxels instead of its 4 mm radial search). The tract, the SIFT2 weights and the sum of
+# the weights of every seed come out of the same read. The weights of the tractogram are memory-mapped
+# from their binary cache (tools/weights.py).
+#
+# The tck files are read and written as MRtrix does (tck header, float triplets, NaN triplet after each
+# streamline, Inf triplet closing the file, zero-padded count updated when the file is closed).
+
+import logging
+import os
+
+import numpy as np
+import nibabel as nib
+
+from tools.outputs import tmp_path, commit
+from tools.weights import read_weights
+
+# Points read at once: ~50 MB of float32 triplets
+CHUNK_POINTS = 2 ** 22
+
+BIT_TYPES = (np.uint8, np.uint16, np.uint32, np.uint64)
+
+
+def read_header(tck_file:str):
+    ''' Fields of a tck header, with the data offset and the numpy dtype of the points '''
+    with open(tck_file, 'rb') as f:
+        header = b''
+        while b'\nEND\n' not in header:
+            block = f.read(4096)
+            if not block:
+                raise IOError('"{0}" is not a tck file (no END in the header).'.format(tck_file))
+            header += block
+    lines = header.split(b'\nEND\n')[0].decode('latin-1').split('\n')
+    if lines[0] != 'mrtrix tracks':
+        raise IOError('"{0}" is not a tck file.'.format(tck_file))
+    fields = [tuple(s.strip() for s in line.split(':', 1)) for line in lines[1:] if ':' in line]
+    values = dict(fields)
+    datatype = values.get('datatype', 'Float32LE')
+    dtype = np.dtype(('<' if datatype.endswith('LE') else '>') + ('f8' if datatype.startswith('Float64') else 'f4'))
+    offset = int(values['file'].split()[1])
+    return fields, offset, dtype
+
+
+class TckWriter:
+    ''' Streamlines appended to a temporary tck file, committed under its name by close() '''
+
+    def __init__(self, filename:str, fields:list, dtype):
+        self.filename = filename
+        self.tmp_file = tmp_path(filename)
+        self.dtype = dtype
+        self.count = 0
+        keep = [(key, value) for key, value in fields if key not in ('file', 'count')]
+        text = 'mrtrix tracks\n' + ''.join('{0}: {1}\n'.format(key, value) for key, value in keep)
+        self.count_offset = len(text) + len('count: ')
+        text += 'count: {0:010d}\n'.format(0)
+        # The offset of the data is written in the header itself
+        offset = len(text) + len('file: . \nEND\n')
+        while len(text) + len('file: . {0}\nEND\n'.format(offset)) != offset:
+            offset = len(text) + len('file: . {0}\nEND\n'.format(offset))
+        self.f = open(self.tmp_file, 'wb')
+        self.f.write((text + 'file: . {0}\nEND\n'.format(offset)).encode('latin-1'))
+
+    def write(self, points, count:int):
+        ''' points: rows of count streamlines, each followed by its NaN triplet '''
+        self.f.write(points.astype(self.dtype, copy=False).tobytes())
+        self.count += count
+
+    def close(self):
+        self.f.write(np.full(3, np.inf, dtype=self.dtype).tobytes())
+        self.f.seek(self.count_offset)
+        self.f.write('{0:010d}'.format(self.count).encode('latin-1'))
+        self.f.close()
+        commit(self.tmp_file, self.filename)
+
+    def discard(self):
+        if not self.f.closed:
+            self.f.close()
+        if os.path.exists(self.tmp_file):
+            os.remove(self.tmp_file)
+
+
+def write_weights(filename:str, weights):
+    ''' Weights written as tckedit does: space separated, one line '''
+    tmp_file = tmp_path(filename)
+    try:
+        with open(tmp_file, 'w') as f:
+            f.write(''.join('{0:.10g} '.format(w) for w in weights) + '\n')
+        commit(tmp_file, filename)
+    finally:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+
+
+def seed_volume(seed_files:list):
+    ''' Bitset volume of the seeds (bit k for seed_files[k]) and its affine '''
+    if not 0 < len(seed_files) <= 64:
+        raise ValueError('1 to 64 seeds can be filtered at once, {0} given.'.format(len(seed_files)))
+    bit_type = next(t for t in BIT_TYPES if np.iinfo(t).bits >= len(seed_files))
+    ref = nib.load(seed_files[0])
+    volume = np.zeros(ref.shape[:3], dtype=bit_type)
+    for k, seed_file in enumerate(seed_files):
+        img = nib.load(seed_file)
+        if img.shape[:3] != ref.shape[:3] or not np.allclose(img.affine, ref.affine, atol=1e-4):
+            raise ValueError('Seed "{0}" is not on the grid of "{1}".'.format(seed_file, seed_files[0]))
+        volume[np.asanyarray(img.dataobj) > 0] |= bit_type(1 << k)
+    return volume, ref.affine
+
+
+def read_chunks(tck_file:str, chunk_points:int=CHUNK_POINTS):
+    ''' Points of whole streamlines, chunk by chunk, each streamline followed by its NaN triplet '''
+    fields, offset, dtype = read_header(tck_file)
+    carry = np.empty((0, 3), dtype=dtype)
+    with open(tck_file, 'rb') as f:
+        f.seek(offset)
+        while True:
+            points = np.fromfile(f, dtype=dtype, count=3 * chunk_points)
+            points = np.concatenate([carry, points[:len(points) // 3 * 3].reshape(-1, 3)])
+            end = np.flatnonzero(np.isinf(points[:, 0]))
+            if len(end):
+                points = points[:end[0]]
+            delimiters = np.flatnonzero(np.isnan(points[:, 0]))
+            last = delimiters[-1] + 1 if len(delimiters) else 0
+            if last:
+                yield points[:last]
+            carry = points[last:]
+            if len(end) or f.tell() >= os.fstat(f.fileno()).st_size:
+                break
+    if len(carry):
+        logging.warning('"{0}": {1} points after the last complete streamline ignored.'.format(tck_file, len(carry)))
+
+
+def seed_filter(tck_file:str, weights_file:str, seed_files:list, tck_outputs:list, weights_outputs:list):
+    ''' Streamlines of tck_file through each seed, from one read of the tractogram
+
+        Parameters
+        ----------
+        tck_file, weights_file :
+            Tractogram and its SIFT2 weights
+        seed_files :
+            Binary masks of the seeds, on the same grid
+        tck_outputs, weights_outputs :
+            Tract (streamlines with a point in the seed) and weights of each seed, None to skip one
+
+        Returns
+        ----------
+        Sum of the weights of the streamlines with both end points in the seed, per seed
+    '''
+    volume, affine = seed_volume(seed_files)
+    inverse = np.linalg.inv(affine)
+    weights = read_weights(weights_file)
+    fields, _, dtype = read_header(tck_file)
+    writers = [TckWriter(f, fields, dtype) if f else None for f in tck_outputs]
+    included = [[] for _ in seed_files]
+    metrics = np.zeros(len(seed_files))
+    bit_type = volume.dtype.type
+    first = 0
+    try:
+        for points in read_chunks(tck_file):
+            delimiter = np.isnan(points[:, 0])
+            n = np.count_nonzero(delimiter)
+            # Streamline of each point (its NaN triplet included)
+            ids = np.cumsum(delimiter) - delimiter
+
+            voxels = np.rint(points @ inverse[:3, :3].T + inverse[:3, 3])
+            inside = ~delimiter & np.all((voxels >= 0) & (voxels < volume.shape), axis=1)
+            point_bits = np.zeros(len(points), dtype=volume.dtype)
+            point_bits[inside] = volume[tuple(voxels[inside].astype(np.intp).T)]
+
+            bits = np.zeros(n, dtype=volume.dtype)
+            np.bitwise_or.at(bits, ids, point_bits)
+            ends = np.flatnonzero(delimiter)
+            starts = np.r_[0, ends[:-1] + 1]
+            end_bits = np.where(starts < ends, point_bits[starts] & point_bits[np.maximum(ends - 1, 0)], 0)
+            chunk_weights = weights[first:first + n]
+            if len(chunk_weights) < n:
+                raise ValueError('"{0}" has fewer weights than "{1}" has streamlines.'.format(weights_file, tck_file))
+
+            for k in range(len(seed_files)):
+                bit = bit_type(1 << k)
+                metrics[k] += chunk_weights[(end_bits & bit) != 0].sum()
+                keep = (bits & bit) != 0
+                included[k].append(first + np.flatnonzero(keep))
+                if writers[k] is not None:
+                    writers[k].write(points[keep[ids]], np.count_nonzero(keep))
+            first += n
+
+        if first != len(weights):
+            raise ValueError('"{0}" has {1} weights for {2} streamlines in "{3}".'.format(
+                weights_file, len(weights), first, tck_file))
+        for k, writer in enumerate(writers):
+            if writer is not None:
+                writer.close()
+            if weights_outputs[k]:
+                write_weights(weights_outputs[k], weights[np.concatenate(included[k])])
+    finally:
+        for writer in writers:
+            if writer is not None:
+                writer.discard()
+    logging.info('{0}: {1} streamlines, {2} per seed.'.format(tck_file, first, [len(np.concatenate(i)) for i in included]))
+    return list(metrics)
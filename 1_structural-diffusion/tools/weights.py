@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Reader of the SIFT2 weights files (tcksift2 -out_weights, tckedit -tck_weights_out): one float per
+# streamline as text, 10M values for the whole-brain "_sift.txt". The text is parsed once with numpy and
+# kept next to it as a binary "<name>.npy" cache, with a "<name>.npy.json" sidecar holding the size and
+# mtime of the text file it was made from. The later reads map the cache (np.load mmap_mode='r'): summing
+# or indexing the weights no longer parses nor even reads the whole file. A text file written again
+# (other size or mtime) is parsed again.
+#
+#     weights = read_weights(sift_file)
+#     total = weights.sum()
+
+import json
+import logging
+import os
+import time
+import warnings
+
+import numpy as np
+
+from tools.outputs import tmp_path, commit
+
+
+def cache_file(weights_file:str):
+    return os.path.splitext(weights_file)[0] + '.npy'
+
+
+def parse_weights(weights_file:str):
+    ''' Values of a weights file, the comment lines ("#") skipped '''
+    with open(weights_file) as f:
+        text = ''.join(line for line in f if not line.startswith('#')).strip()
+    if not text:
+        return np.zeros(0)
+    with warnings.catch_warnings():
+        # A value that is not a number stops the parsing with a warning
+        warnings.simplefilter('error')
+        try:
+            return np.fromstring(text, sep=' ')
+        except (ValueError, DeprecationWarning) as e:
+            raise ValueError('"{0}" is not a weights file: {1}'.format(weights_file, e))
+
+
+def source_stamp(weights_file:str):
+    stat = os.stat(weights_file)
+    return {'Size': stat.st_size, 'Mtime': stat.st_mtime_ns}
+
+
+def write_cache(weights_file:str, weights):
+    ''' Save the cache of a weights file and its sidecar, the sidecar last so that it only describes a complete cache '''
+    filename = cache_file(weights_file)
+    tmp_file = tmp_path(filename)
+    try:
+        np.save(tmp_file, weights)
+        commit(tmp_file, filename)
+    finally:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+    tmp_json = tmp_path(filename + '.json')
+    with open(tmp_json, 'w') as outfile:
+        j = {
+            'Origin function': 'tools.weights.read_weights',
+            'Description': 'Binary cache of the weights file',
+            'Weights_filename': weights_file,
+            'Source': source_stamp(weights_file),
+            'Time': time.asctime()
+            }
+        json.dump(j, outfile)
+    os.replace(tmp_json, filename + '.json')
+
+
+def cached(weights_file:str):
+    ''' Whether the cache of a weights file was made from its current content '''
+    try:
+        with open(cache_file(weights_file) + '.json') as f:
+            return json.load(f).get('Source') == source_stamp(weights_file)
+    except (OSError, ValueError):
+        return False
+
+
+def read_weights(weights_file:str, mmap:bool=True):
+    ''' Weights of a weights file, from its binary cache (written on the first read)
+
+        Parameters
+        ----------
+        weights_file :
+            Text weights file
+        mmap :
+            If set, the cache is memory-mapped (read-only array), otherwise read in memory
+
+        Returns
+        ----------
+        float64 array, one weight per streamline
+    '''
+    if cached(weights_file):
+        try:
+            weights = np.load(cache_file(weights_file), mmap_mode='r' if mmap else None)
+            if weights.ndim == 1:
+                return weights
+        except (OSError, ValueError) as e:
+            logging.warning('Cache of "{0}" not read, parsed again: {1}'.format(weights_file, e))
+
+    weights = parse_weights(weights_file)
+    try:
+        write_cache(weights_file, weights)
+    except OSError as e:
+        # i.e. read-only folder: parsed on every read
+        logging.warning('Cache of "{0}" not written: {1}'.format(weights_file, e))
+    return weights